@@ -54,6 +54,11 @@ except:
 
 import axidraw_svg_reorder
 
+try:
+    import plot_utils_np  # Vectorized planning routines; requires NumPy
+except ImportError:
+    plot_utils_np = None
+
 from lxml import etree
 
 try:
@@ -109,6 +114,18 @@ class AxiDraw(inkex.Effect):
         self.warnings = {}
         
         self.jasper_log = []
+
+        # When compile_mode is set, a preview run also records the exact
+        # sequence of EBB commands that a real plot would send, in
+        # compiled_commands. See plot_compile() and plot_run_compiled().
+        self.compile_mode = False
+        self.compiled_commands = []
+
+        # Changes made to the document by plotting: generated elements that
+        # were added (preview layer, WCB resume data) and the nodes they
+        # replaced, as (parent, index, node) with index None for additions.
+        # See discard_overlay().
+        self.overlay = []
         
     def set_defaults(self):
         # Set default values of certain parameters
@@ -347,6 +364,7 @@ class AxiDraw(inkex.Effect):
                     if self.copies_to_plot != 0 and not self.b_stopped:  # Delay if we're between copies, not after the last or paused.
                         if self.options.preview:
                             self.pt_estimate += 100
+                            self.compile_pause(100)
                         else:
                             time.sleep(0.100)  # Use short intervals to improve responsiveness
                             self.PauseResumeCheck()  # Detect button press while paused between plots
@@ -398,6 +416,7 @@ class AxiDraw(inkex.Effect):
                     if self.copies_to_plot != 0 and not self.b_stopped:
                         if self.options.preview:
                             self.pt_estimate += 100
+                            self.compile_pause(100)
                         else:
                             time.sleep(0.100)  # Use short intervals to improve responsiveness
                             self.PauseResumeCheck()  # Detect button press while paused between plots
@@ -466,7 +485,7 @@ class AxiDraw(inkex.Effect):
                 self.svg_application_old = str(wcb_node.get('application'))
                 self.svg_data_read = True
             except TypeError:
-                self.svg.remove(wcb_node)  # An error before this point leaves svg_data_read as False.
+                self.overlay_remove(wcb_node)  # An error before this point leaves svg_data_read as False.
                 # Also remove the node, to prevent adding a duplicate WCB node later.
             try:
                 # Check for additonal, optional attributes:
@@ -478,9 +497,10 @@ class AxiDraw(inkex.Effect):
     def UpdateSVGWCBData(self, a_node_list):
         if not self.svg_data_written:
             for node in self.svg.xpath('//svg:WCB', namespaces=inkex.NSS):
-                self.svg.remove(node)
+                self.overlay_remove(node)
         
-            wcb_data = etree.SubElement(self.svg, 'WCB')
+            wcb_data = etree.Element('WCB')
+            self.overlay_append(self.svg, wcb_data)
         
             wcb_data.set('layer', str(self.svg_layer))
             wcb_data.set('node', str(self.svg_node_count))
@@ -496,6 +516,34 @@ class AxiDraw(inkex.Effect):
 
             self.svg_data_written = True
 
+    def overlay_append(self, parent, node):
+        # Add a generated element to the document, recording it so that
+        # discard_overlay() can take it out again.
+        parent.append(node)
+        self.overlay.append((parent, None, node))
+
+    def overlay_remove(self, node):
+        # Remove an element from the document, recording where it was so
+        # that discard_overlay() can put it back.
+        parent = node.getparent()
+        self.overlay.append((parent, parent.index(node), node))
+        parent.remove(node)
+
+    def discard_overlay(self):
+        """
+        Return the document to its state as given to plot_setup(), taking
+        out the preview layer and WCB resume data added by plot runs and
+        restoring any elements that those replaced. Call this after
+        get_output() (or plot_run(True)) when the document is reused, so
+        that it does not have to be copied for each run.
+        """
+        for parent, index, node in reversed(self.overlay):
+            if index is None:
+                parent.remove(node)
+            else:
+                parent.insert(index, node)
+        self.overlay = []
+
     def setup_command(self):
         """
         Execute commands from the setup modes
@@ -641,11 +689,14 @@ class AxiDraw(inkex.Effect):
             self.queryEBBVoltage()
             unused = ebb_motion.QueryPRGButton(self.serial_port)  # Initialize button-press detection
 
-        if not hasattr(self, 'backup_original'):
-            self.backup_original = copy.deepcopy(self.document)
-
-        # Modifications to SVG -- including re-ordering and text substitution
-        #   may be made at this point, and will not be preserved.
+        # Plotting reads the document without modifying it; the only changes
+        #   made to it are the generated elements (preview layer and WCB
+        #   resume data) added after plotting. Those from any earlier run are
+        #   discarded first, so each run starts from the source document.
+        #   Re-ordering rearranges the tree, so it works on a copy that is
+        #   dropped once the plot is done.
+        self.discard_overlay()
+        source_document = self.document
         
         # Re-order paths for speed
         if self.options.reordering > 0:
@@ -653,8 +704,11 @@ class AxiDraw(inkex.Effect):
             asr.getoptions([])
             asr.options.reordering = self.options.reordering
             asr.auto_rotate = self.options.auto_rotate
-            asr.document = self.document 
+            asr.document = copy.deepcopy(self.document)
             asr.effect() # Run the reordering
+            if self.spew_debugdata:
+                self.text_log('Reordering pen-up travel: {0:.2f} in, was {1:.2f} in'.format(
+                    asr.air_total_sorted, asr.air_total_default))
             self.document = asr.document # Retrieve modified document
             self.svg  = self.document.getroot()
 
@@ -718,23 +772,13 @@ class AxiDraw(inkex.Effect):
                 self.plotSegmentWithVelocity(f_x, f_y, 0, 0)
 
             """
-            Revert back to original SVG document, prior to adding preview layers.
-             and prior to saving updated "WCB" progress data in the file.
-             No changes to the SVG document prior to this point will be saved.
-            
-             Doing so allows us to use routines that alter the SVG
-             prior to this point -- e.g., plot re-ordering for speed 
-             or font substitutions.
+            Return to the source SVG document (if we plotted a re-ordered
+             copy), prior to adding preview layers and prior to saving
+             updated "WCB" progress data in the file.
             """
 
-            try:
-                # If we have a good "backup_original",
-                # revert to _that_, rather than the true original
-                self.document = copy.deepcopy(self.backup_original)
-                self.svg = self.document.getroot()
-            except AttributeError:
-                self.document = copy.deepcopy(self.original_document)
-                self.svg = self.document.getroot()
+            self.document = source_document
+            self.svg = self.document.getroot()
 
             if not self.b_stopped:
                 if self.options.mode in ["plot", "layers", "res_home", "res_plot"]:
@@ -761,12 +805,12 @@ class AxiDraw(inkex.Effect):
 
             if self.options.preview:
                 # Remove old preview layers, whenever preview mode is enabled
-                for node in self.svg:
+                for node in list(self.svg):
                     if node.tag == inkex.addNS('g', 'svg') or node.tag == 'g':
                         if node.get(inkex.addNS('groupmode', 'inkscape')) == 'layer':
                             layer_name = node.get(inkex.addNS('label', 'inkscape'))
                             if layer_name == '% Preview':
-                                self.svg.remove(node)
+                                self.overlay_remove(node)
 
             if self.options.rendering > 0:  # Render preview. Only possible when in preview mode.
                 preview_transform = simpletransform.parseTransform(
@@ -786,7 +830,7 @@ class AxiDraw(inkex.Effect):
                 self.previewSLU.set(inkex.addNS('groupmode', 'inkscape'), 'layer')
                 self.previewSLU.set(inkex.addNS('label', 'inkscape'), '% Pen-up transit')
 
-                self.svg.append(self.previewLayer)
+                self.overlay_append(self.svg, self.previewLayer)
 
                 # Preview stroke width: 1/1000 of page width or height, whichever is smaller
                 if self.svg_width < self.svg_height:
@@ -1505,7 +1549,9 @@ class AxiDraw(inkex.Effect):
                             parameter_int = int(float(temp_num_string))
 
                             if key == "+d":
-                                if parameter_int > 0:
+                                if parameter_int > 0 and self.compile_mode:
+                                    self.compile_pause(parameter_int)
+                                elif parameter_int > 0:
                                     # Delay requested before plotting this layer. Delay times are in milliseconds.
                                     time_remaining = float(parameter_int) / 1000.0  # Convert to seconds
 
@@ -1612,10 +1658,15 @@ class AxiDraw(inkex.Effect):
 
             # p is now a list of lists of cubic beziers [control pt1, control pt2, endpoint]
             # where the start-point is the last point in the previous segment.
+
+            # Divide each path into a set of straight segments:
+            if plot_utils_np is not None:
+                plot_utils_np.subdivide_cubic_paths(p, axidraw_conf.bezier_segmentation_tolerance)
+
             for sp in p: # for subpaths in the path:
 
-                # Divide each path into a set of straight segments:
-                plot_utils.subdivideCubicPath(sp, axidraw_conf.bezier_segmentation_tolerance)
+                if plot_utils_np is None:
+                    plot_utils.subdivideCubicPath(sp, axidraw_conf.bezier_segmentation_tolerance)
 
                 """
                 Pre-parse the subdivided paths:
@@ -1724,7 +1775,10 @@ class AxiDraw(inkex.Effect):
                     continue
 
                 for subpath in subpath_list:
-                    plot_utils.supersample(subpath, axidraw_conf.segment_supersample_tolerance)
+                    if plot_utils_np is not None:
+                        plot_utils_np.supersample(subpath, axidraw_conf.segment_supersample_tolerance)
+                    else:
+                        plot_utils.supersample(subpath, axidraw_conf.segment_supersample_tolerance)
 
                     n_index = 0
                     single_path = []
@@ -1754,18 +1808,15 @@ class AxiDraw(inkex.Effect):
 
     def plan_trajectory(self, input_path):
         """
-        Plan the trajectory for a full path, accounting for linear acceleration.
+        Plan the trajectory for a full path, accounting for linear acceleration,
+        and plot the resulting segments.
         Inputs: Ordered (x,y) pairs to cover.
-        Output: A list of segments to plot, of the form (Xfinal, Yfinal, v_initial, v_final)
-        [Aside: We may eventually migrate to the form (Xfinal, Yfinal, Vix, Viy, Vfx,Vfy)]
 
-        Important note: This routine uses *inch* units (inches of distance, velocities of inches/second, etc.),
-        and works in the basis of the XY axes, not the native axes of the motors.
+        Uses the vectorized planner in plot_utils_np when NumPy is available,
+        and plan_trajectory_segments otherwise (or when spewing debug data).
         """
 
-        spew_trajectory_debug_data = self.spew_debugdata  # Suggested values: False or self.spew_debugdata
-
-        if spew_trajectory_debug_data:
+        if self.spew_debugdata:
             self.text_log('\nplan_trajectory()\n')
 
         if self.b_stopped:
@@ -1773,8 +1824,63 @@ class AxiDraw(inkex.Effect):
         if self.f_curr_x is None:
             return
 
+        limits = self.trajectory_limits()
+        if plot_utils_np is not None and not self.spew_debugdata:
+            segments = self.plan_trajectory_segments_np(input_path, limits)
+        else:
+            segments = self.plan_trajectory_segments(input_path, limits)
+
+        for x_dest, y_dest, v_i, v_f in segments:
+            self.plotSegmentWithVelocity(x_dest, y_dest, v_i, v_f)
+
+    def trajectory_limits(self):
+        """
+        Limits used when planning a trajectory at the current pen state:
+        (speed_limit, accel_rate, min_dist, delta), in inch units.
+        """
+        speed_limit = self.speed_pendown  # speed_limit is maximum travel rate (in/s), in XY plane.
+        if self.pen_up:
+            speed_limit = self.speed_penup  # Unlikely case, but handle it anyway...
+
+        if self.pen_up:
+            accel_rate = axidraw_conf.accel_rate_pu * self.options.accel / 100.0
+        else:
+            accel_rate = axidraw_conf.accel_rate * self.options.accel / 100.0
+
+        if self.options.resolution == 1:  # High-resolution mode
+            min_dist = axidraw_conf.max_step_dist_hr  # Skip segments likely to be shorter than one step
+        else:
+            min_dist = axidraw_conf.max_step_dist_lr  # Skip segments likely to be shorter than one step
+
+        delta = axidraw_conf.cornering / 5000  # Corner rounding/tolerance factor
+        return speed_limit, accel_rate, min_dist, delta
+
+    def plan_trajectory_segments_np(self, input_path, limits=None):
+        """
+        Vectorized equivalent of plan_trajectory_segments(); requires NumPy.
+        """
+        if limits is None:
+            limits = self.trajectory_limits()
+        speed_limit, accel_rate, min_dist, delta = limits
+        return plot_utils_np.trajectory_segments(input_path, min_dist,
+                                                 speed_limit, accel_rate, delta)
+
+    def plan_trajectory_segments(self, input_path, limits=None):
+        """
+        Plan the trajectory for a full path, accounting for linear acceleration.
+        Inputs: Ordered (x,y) pairs to cover, and optionally the limits from
+        trajectory_limits() (computed here if not given).
+        Output: A list of segments to plot, of the form (Xfinal, Yfinal, v_initial, v_final)
+        [Aside: We may eventually migrate to the form (Xfinal, Yfinal, Vix, Viy, Vfx,Vfy)]
+
+        Important note: This routine uses *inch* units (inches of distance, velocities of inches/second, etc.),
+        and works in the basis of the XY axes, not the native axes of the motors.
+        """
+
+        spew_trajectory_debug_data = self.spew_debugdata  # Suggested values: False or self.spew_debugdata
+
         if len(input_path) < 2: # Invalid path segment
-            return
+            return []
 
         # Handle simple segments (lines) that do not require any complex planning:
         if len(input_path) < 3:
@@ -1783,8 +1889,7 @@ class AxiDraw(inkex.Effect):
                 self.text_log('plotSegmentWithVelocity({}, {}, {}, {})'.format(
                     input_path[1][0], input_path[1][1], 0, 0))
             # Get X & Y Destination coordinates from last element, input_path[1]:
-            self.plotSegmentWithVelocity(input_path[1][0], input_path[1][1], 0, 0)
-            return
+            return [(input_path[1][0], input_path[1][1], 0, 0)]
 
         # For other trajectories, we need to go deeper.
         traj_length = len(input_path)
@@ -1795,9 +1900,9 @@ class AxiDraw(inkex.Effect):
                 self.text_log('x: {0:1.3f},  y: {1:1.3f}'.format(xy[0], xy[1]))
             self.text_log('\ntraj_length: ' + str(traj_length))
 
-        speed_limit = self.speed_pendown  # speed_limit is maximum travel rate (in/s), in XY plane.
-        if self.pen_up:
-            speed_limit = self.speed_penup  # Unlikely case, but handle it anyway...
+        if limits is None:
+            limits = self.trajectory_limits()
+        speed_limit, accel_rate, min_dist, delta = limits
 
         if spew_trajectory_debug_data:
             self.text_log('\nspeed_limit (plan_trajectory) ' + str(speed_limit) + ' inches per second')
@@ -1811,11 +1916,6 @@ class AxiDraw(inkex.Effect):
         traj_dists.append(0.0)  # First value, at time t = 0
         traj_vels.append(0.0)  # First value, at time t = 0
 
-        if self.options.resolution == 1:  # High-resolution mode
-            min_dist = axidraw_conf.max_step_dist_hr  # Skip segments likely to be shorter than one step
-        else:
-            min_dist = axidraw_conf.max_step_dist_lr  # Skip segments likely to be shorter than one step
-
         last_index = 0
         for i in xrange(1, traj_length):
             # Construct basic arrays of position and distances, skipping zero length (and nearly zero length) segments.
@@ -1850,14 +1950,13 @@ class AxiDraw(inkex.Effect):
         if traj_length < 2:
             if spew_trajectory_debug_data:
                 self.text_log('\nSkipped a path element that did not have any well-defined segments.')
-            return
+            return []
 
         # Handle simple segments (lines) that do not require any complex planning (after removing zero-length elements):
         if traj_length < 3:
             if spew_trajectory_debug_data:
                 self.text_log('\nDrawing straight line, not a curve.')
-            self.plotSegmentWithVelocity(trimmed_path[0][0], trimmed_path[0][1], 0, 0)
-            return
+            return [(trimmed_path[0][0], trimmed_path[0][1], 0, 0)]
 
         if spew_trajectory_debug_data:
             self.text_log('\nAfter removing any zero-length segments, we are left with: ')
@@ -1867,12 +1966,6 @@ class AxiDraw(inkex.Effect):
                     trimmed_path[i][0], trimmed_path[i][1], traj_dists[i + 1]))
                 self.text_log('  And... traj_dists[i+1]: {0:1.3f}'.format(traj_dists[i + 1]))
 
-        # Acceleration/deceleration rates:
-        if self.pen_up:
-            accel_rate = axidraw_conf.accel_rate_pu * self.options.accel / 100.0
-        else:
-            accel_rate = axidraw_conf.accel_rate * self.options.accel / 100.0
-
         # Maximum acceleration time: Time needed to accelerate from full stop to maximum speed:
         # v = a * t, so t_max = vMax / a
         t_max = speed_limit / accel_rate
@@ -1955,8 +2048,6 @@ class AxiDraw(inkex.Effect):
         still have a solution for getting to the endpoint at zero speed.
         """
 
-        delta = axidraw_conf.cornering / 5000  # Corner rounding/tolerance factor-- not sure how high this should be set.
-
         for i in xrange(1, traj_length - 1):
             dcurrent = traj_dists[i]  # Length of the segment leading up to this vertex
 
@@ -2071,8 +2162,8 @@ class AxiDraw(inkex.Effect):
         #                 self.text_log( 'traj_vels[i]: %1.3f' %(traj_vels[i]))
         #                 self.text_log( 'traj_vels[i+1]: %1.3f\n' %(traj_vels[i+1]))
 
-        for i in xrange(0, traj_length - 1):
-            self.plotSegmentWithVelocity(trimmed_path[i][0], trimmed_path[i][1], traj_vels[i], traj_vels[i + 1])
+        return [(trimmed_path[i][0], trimmed_path[i][1], traj_vels[i], traj_vels[i + 1])
+                for i in xrange(0, traj_length - 1)]
 
     def plotSegmentWithVelocity(self, x_dest, y_dest, v_i, v_f):
         """
@@ -2676,6 +2767,7 @@ class AxiDraw(inkex.Effect):
                                         x_new_t, y_new_t))
                         # print(f'CMD {move_steps2} {move_steps1} {move_time}')
                         self.jasper_log.append(f'SM,{move_time},{move_steps2},{move_steps1}')
+                        self.compile_command(f'SM,{move_time},{move_steps1},{move_steps2}')
                     else:
                         ebb_motion.doXYMove(self.serial_port, move_steps2, move_steps1, move_time)
                         if move_time > 50:
@@ -2772,6 +2864,20 @@ class AxiDraw(inkex.Effect):
                 if not self.virtual_pen_up:  # Switch from virtual to real pen
                     self.pen_lower()
 
+    def compile_command(self, command):
+        # Record one low-level EBB command (without its trailing carriage
+        # return) in the compiled plan, if we are compiling.
+        if self.compile_mode:
+            self.compiled_commands.append(command)
+
+    def compile_pause(self, n_pause):
+        # Record a timed pause of n_pause ms in the compiled plan, split
+        # into zero-distance moves as in ebb_motion.doTimedPause.
+        while self.compile_mode and n_pause > 0:
+            td = max(1, min(750, int(n_pause)))
+            self.compile_command(f'SM,{td},0,0')
+            n_pause -= td
+
     def serial_connect(self):
         named_port = None
         
@@ -2832,6 +2938,7 @@ class AxiDraw(inkex.Effect):
             if not self.options.preview:
                 ebb_motion.sendEnableMotors(self.serial_port, 1)  # 16X microstepping
             self.jasper_log.append(f'EM,{self.options.resolution},{self.options.resolution}')
+            self.compile_command(f'EM,{self.options.resolution},{self.options.resolution}')
             self.StepScaleFactor = 2.0 * axidraw_conf.native_res_factor
             self.speed_pendown = local_speed_pendown * axidraw_conf.speed_lim_xy_hr / 110.0  # Speed given as maximum inches/second in XY plane
             self.speed_penup = self.options.speed_penup * axidraw_conf.speed_lim_xy_hr / 110.0  # Speed given as maximum inches/second in XY plane
@@ -2843,6 +2950,7 @@ class AxiDraw(inkex.Effect):
             if not self.options.preview:
                 ebb_motion.sendEnableMotors(self.serial_port, 2)  # 8X microstepping
             self.jasper_log.append(f'EM,{self.options.resolution},{self.options.resolution}')
+            self.compile_command(f'EM,{self.options.resolution},{self.options.resolution}')
             self.StepScaleFactor = axidraw_conf.native_res_factor
             # In low-resolution mode, allow faster pen-up moves. Keep maximum pen-down speed the same.
             self.speed_penup = self.options.speed_penup * axidraw_conf.speed_lim_xy_lr / 110.0  # Speed given as maximum inches/second in XY plane
@@ -2852,21 +2960,27 @@ class AxiDraw(inkex.Effect):
 
         # ebb_motion.PBOutConfig( self.serial_port, 3, 0 )    # Configure I/O Pin B3 as an output, low
 
+    def pen_raise_time(self):
+        # Time, in ms, to raise the pen from its down position, including
+        # the pen-up delay.
+        if self.use_custom_layer_pen_height:
+            pen_down_pos = self.layer_pen_pos_down
+        else:
+            pen_down_pos = self.options.pen_pos_down
+
+        v_distance = float(self.options.pen_pos_up - pen_down_pos)
+        v_time = int((1000.0 * v_distance) / (3 * self.options.pen_rate_raise))
+        if v_time < 0:  # Handle case that pen_pos_down is above pen_pos_up
+            v_time = -v_time
+        v_time += self.options.pen_delay_up
+        if v_time < 0:  # Do not allow negative delay times
+            v_time = 0
+        return v_time
+
     def pen_raise(self):
         self.virtual_pen_up = True  # Virtual pen keeps track of state for resuming plotting.
         if not self.resume_mode and not self.pen_up:  # skip if pen is already up, or if we're resuming.
-            if self.use_custom_layer_pen_height:
-                pen_down_pos = self.layer_pen_pos_down
-            else:
-                pen_down_pos = self.options.pen_pos_down
-
-            v_distance = float(self.options.pen_pos_up - pen_down_pos)
-            v_time = int((1000.0 * v_distance) / (3 * self.options.pen_rate_raise))
-            if v_time < 0:  # Handle case that pen_pos_down is above pen_pos_up
-                v_time = -v_time
-            v_time += self.options.pen_delay_up
-            if v_time < 0:  # Do not allow negative delay times
-                v_time = 0
+            v_time = self.pen_raise_time()
             if self.options.preview:
                 self.updateVCharts(0, 0, 0)
                 self.vel_data_time += v_time
@@ -2880,6 +2994,7 @@ class AxiDraw(inkex.Effect):
                         time.sleep(float(v_time - 10) / 1000.0)  # pause before issuing next command
             self.pen_up = True
             self.jasper_log.append(f'SP,1,{v_time}')
+            self.compile_command(f'SP,1,{v_time}')
         self.path_data_pen_up = -1
 
     def pen_lower(self):
@@ -2911,6 +3026,7 @@ class AxiDraw(inkex.Effect):
                             time.sleep(float(v_time - 10) / 1000.0)  
                 self.pen_up = False
                 self.jasper_log.append(f'SP,0,{v_time}')
+                self.compile_command(f'SP,0,{v_time}')
         self.path_data_pen_up = -1
 
     def ServoSetupWrapper(self):
@@ -2924,6 +3040,13 @@ class AxiDraw(inkex.Effect):
 
         self.ServoSetup()  # Pre-stage the pen up and pen down positions
         if self.options.preview:
+            if self.compile_mode:
+                # A compiled plan runs on a machine whose pen state is
+                # unknown, so it begins with an explicit pen-up move. The
+                # move is only compiled: the preview, its log and its time
+                # estimate stay the same as those of a plain preview.
+                self.compile_command(f'SL,{self.options.pen_pos_up + 1}')
+                self.compile_command(f'SP,1,{self.pen_raise_time()}')
             self.pen_up = True  # A fine assumption when in preview mode
             self.virtual_pen_up = True  #
         else:  # Need to figure out if we're in the pen-up or pen-down state... or neither!
@@ -2982,17 +3105,23 @@ class AxiDraw(inkex.Effect):
         else:
             pen_down_pos = self.options.pen_pos_down
 
-        if not self.options.preview:
+        if not self.options.preview or self.compile_mode:
+            # A compiled preview records the commands without sending or
+            # logging them.
             servo_range = axidraw_conf.servo_max - axidraw_conf.servo_min
             servo_slope = float(servo_range) / 100.0
 
             int_temp = int(round(axidraw_conf.servo_min + servo_slope * self.options.pen_pos_up))
-            ebb_motion.setPenUpPos(self.serial_port, int_temp)
-            self.jasper_log.append(f'SC,4,{int_temp}')
+            if not self.options.preview:
+                ebb_motion.setPenUpPos(self.serial_port, int_temp)
+                self.jasper_log.append(f'SC,4,{int_temp}')
+            self.compile_command(f'SC,4,{int_temp}')
 
             int_temp = int(round(axidraw_conf.servo_min + servo_slope * pen_down_pos))
-            ebb_motion.setPenDownPos(self.serial_port, int_temp)
-            self.jasper_log.append(f'SC,5,{int_temp}')
+            if not self.options.preview:
+                ebb_motion.setPenDownPos(self.serial_port, int_temp)
+                self.jasper_log.append(f'SC,5,{int_temp}')
+            self.compile_command(f'SC,5,{int_temp}')
 
             """ 
             Servo speed units (as set with setPenUpRate) are units of %/second,
@@ -3008,12 +3137,16 @@ class AxiDraw(inkex.Effect):
             """
 
             int_temp = 18 * self.options.pen_rate_raise
-            ebb_motion.setPenUpRate(self.serial_port, int_temp)
-            self.jasper_log.append(f'SC,11,{int_temp}')
+            if not self.options.preview:
+                ebb_motion.setPenUpRate(self.serial_port, int_temp)
+                self.jasper_log.append(f'SC,11,{int_temp}')
+            self.compile_command(f'SC,11,{int_temp}')
 
             int_temp = 18 * self.options.pen_rate_lower
-            ebb_motion.setPenDownRate(self.serial_port, int_temp)
-            self.jasper_log.append(f'SC,12,{int_temp}')
+            if not self.options.preview:
+                ebb_motion.setPenDownRate(self.serial_port, int_temp)
+                self.jasper_log.append(f'SC,12,{int_temp}')
+            self.compile_command(f'SC,12,{int_temp}')
 
     def queryEBBVoltage(self):  # Check that power supply is detected.
         if axidraw_conf.skip_voltage_check:
@@ -3068,28 +3201,50 @@ class AxiDraw(inkex.Effect):
     
     def plot_setup(self, svg_input=None):
         # For use as an imported python module
-        # Initialize AxiDraw options & parse SVG file
+        # Initialize AxiDraw options & parse SVG input. The input may be a
+        # file path, a string of SVG markup, SVG markup as bytes (in the
+        # encoding its XML declaration gives, UTF-8 by default), or an
+        # already-parsed lxml tree or root element. A parsed tree is used
+        # as-is (not copied), so pass a copy if the caller needs to keep it
+        # unmodified.
         file_ok = False
         inkex.localize()
         self.getoptions([])
-        # Parse input file or SVG string
+        self.overlay = []
         if svg_input is None:
             svg_input = plot_utils.trivial_svg
-        try:
-            stream = open(svg_input, 'r')
-            p = etree.XMLParser(huge_tree=True)
-            self.document = etree.parse(stream, parser=p)
-            self.original_document = copy.deepcopy(self.document)
-            stream.close()
+        if isinstance(svg_input, etree._ElementTree):
+            self.document = svg_input
             file_ok = True
-        except IOError:
-            pass # It wasn't a file...
+        elif etree.iselement(svg_input):
+            self.document = etree.ElementTree(svg_input)
+            file_ok = True
+        elif isinstance(svg_input, (bytes, bytearray)):
+            try:
+                p = etree.XMLParser(huge_tree=True)
+                self.document = etree.ElementTree(etree.fromstring(bytes(svg_input), parser=p))
+                file_ok = True
+            except etree.XMLSyntaxError:
+                self.error_log("Unable to parse SVG input.")
+                quit()
+        else:
+            if isinstance(svg_input, os.PathLike):
+                svg_input = os.fspath(svg_input)
+            if not (isinstance(svg_input, str) and svg_input.lstrip().startswith('<')):
+                # Parse input file; SVG markup is never tried as a file name.
+                try:
+                    stream = open(svg_input, 'r')
+                    p = etree.XMLParser(huge_tree=True)
+                    self.document = etree.parse(stream, parser=p)
+                    stream.close()
+                    file_ok = True
+                except IOError:
+                    pass # It wasn't a file...
         if not file_ok:
             try:
                 svg_string = svg_input.encode('utf-8') # Need consistent encoding.
                 p = etree.XMLParser(huge_tree=True, encoding='utf-8')
                 self.document = etree.ElementTree(etree.fromstring(svg_string, parser=p))
-                self.original_document = copy.deepcopy(self.document)
                 file_ok = True
             except:
                 self.error_log("Unable to open SVG input file.")
@@ -3116,6 +3271,111 @@ class AxiDraw(inkex.Effect):
             self.jasper_log = []
             return (self.get_output(), log_to_return)
 
+    def plot_compile(self, output=False):
+        """
+        Plan the document given to plot_setup() without a machine attached
+        and return the complete list of EBB commands (servo setup, motor
+        enable, pen moves and stepper moves, in the order and axis
+        convention in which they are sent) that plotting it would issue.
+        The result can be inspected, cached, and later streamed to the
+        AxiDraw with plot_run_compiled().
+
+        With output=True, returns (preview SVG, command log, commands),
+        extending the result of plot_run(True) for the same run.
+        """
+        self.options.preview = True
+        self.compile_mode = True
+        self.compiled_commands = []
+        try:
+            result = self.plot_run(output)
+        finally:
+            self.compile_mode = False
+        commands = self.compiled_commands
+        self.compiled_commands = []
+        if output:
+            return result + (commands,)
+        return commands
+
+    @staticmethod
+    def compiled_command_duration(command):
+        # Time, in ms, that the EBB spends executing a compiled command.
+        fields = command.split(',')
+        if fields[0] == 'SM':
+            return int(fields[1])
+        if fields[0] == 'SP' and len(fields) > 2:
+            return int(fields[2])
+        return 0
+
+    def plot_run_compiled(self, commands, window=8):
+        """
+        Stream a list of commands made by plot_compile() to the AxiDraw.
+        No planning is done here, and commands are pipelined through an
+        ebb_serial.CommandStream with up to `window` awaiting acknowledgement,
+        so the motion queue is never starved by computation or USB round
+        trips between moves. The EBB holds off acknowledging moves while
+        its motion FIFO is full, which paces the stream.
+
+        The pause button is polled at 100 ms intervals; a press raises
+        the pen and halts the plot. So does an error response from the
+        EBB, and every (command, response) error is logged with error_log
+        and kept in ebb_errors. Returns the number of commands sent, which
+        is less than len(commands) if the plot was halted or no AxiDraw
+        could be connected; b_stopped is then set.
+        """
+        self.text_out = ''  # Text log for basic communication messages
+        self.error_out = ''  # Text log for significant errors
+        self.b_stopped = False
+        self.ebb_errors = []
+        opened_port = self.serial_port is None
+        if opened_port:
+            self.serial_connect()
+            if self.serial_port is None:
+                self.b_stopped = True
+                return 0
+        stream = ebb_serial.CommandStream(self.serial_port, window)
+        stream.query('QB\r')  # Initialize button-press detection
+        pen_up_command = 'SP,1'
+        last_check = 0  # Check the button before sending the first command
+        sent = 0
+        try:
+            for command in commands:
+                if command.startswith('SP,1'):
+                    pen_up_command = command
+                if time.time() - last_check >= 0.1:
+                    last_check = time.time()
+                    str_button = stream.query('QB\r')
+                    try:
+                        pause_state = int(str_button[0])
+                    except (TypeError, ValueError, IndexError):
+                        self.error_log('\nUSB connection to AxiDraw lost.')
+                        pause_state = 2
+                    if pause_state != 0:
+                        if pause_state == 1:
+                            self.error_log('Plot halted by button press.')
+                            self.error_log('Important: Manually home this AxiDraw before plotting next item.')
+                        stream.command(pen_up_command + '\r')
+                        self.b_stopped = True
+                        break
+                if stream.errors:
+                    # Do not keep drawing after the EBB rejected a command
+                    stream.command(pen_up_command + '\r')
+                    self.b_stopped = True
+                    break
+                stream.command(command + '\r')
+                sent += 1
+        finally:
+            stream.command('SM,10,0,0\r')  # Pause a moment for underway commands to finish.
+            stream.close()
+            self.ebb_errors = list(stream.errors)
+            for command, response in self.ebb_errors:
+                self.error_log('EBB error after command {0}: {1}'.format(command, response))
+            if self.ebb_errors:
+                self.b_stopped = True
+            if opened_port and self.options.port is None:
+                ebb_serial.closePort(self.serial_port)
+                self.serial_port = None
+        return sent
+
     def interactive(self):
         # Initialize AxiDraw options
         # For interactive-mode use as an imported python module
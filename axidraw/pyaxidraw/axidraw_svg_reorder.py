@@ -41,14 +41,17 @@ try:
     inkex = from_dependency_import('ink_extensions.inkex')
     simpletransform = from_dependency_import('ink_extensions.simpletransform')
     simplestyle = from_dependency_import('ink_extensions.simplestyle')
+    simplepath = from_dependency_import('ink_extensions.simplepath')
 except:
     import inkex
     import simpletransform
     import simplestyle
+    import simplepath
 
 
 import gettext
 import math
+import time
 import plot_utils        # https://github.com/evil-mad/plotink  Requires version 0.15
 from lxml import etree
 
@@ -78,6 +81,159 @@ default=1,help="How compound paths are handled")
 
 """
 
+class EndpointGrid(object):
+    """
+    Uniform grid over path endpoints, for nearest-endpoint queries during
+    reordering. Each entry is (x, y, key); entries are removed once the
+    path they belong to has been placed. The grid is rebuilt with larger
+    cells as it empties, so that searches stay local.
+    """
+
+    def __init__(self, entries):
+        self.build(entries)
+
+    def build(self, entries):
+        self.count = len(entries)
+        self.built_count = self.count
+        xs = [e[0] for e in entries] or [0.0]
+        ys = [e[1] for e in entries] or [0.0]
+        self.x_min = min(xs)
+        self.y_min = min(ys)
+        span = max(max(xs) - self.x_min, max(ys) - self.y_min, 1e-9)
+        # Aim for about one entry per cell
+        self.cell = max(span / math.ceil(math.sqrt(max(self.count, 1))), 1e-9)
+        self.n_cells = int(span / self.cell) + 1
+        self.cells = {}
+        self.where = {}
+        for x, y, key in entries:
+            c = self.cell_of(x, y)
+            self.cells.setdefault(c, {})[key] = (x, y)
+            self.where[key] = c
+
+    def cell_of(self, x, y):
+        return (int(math.floor((x - self.x_min) / self.cell)),
+                int(math.floor((y - self.y_min) / self.cell)))
+
+    def remove(self, key):
+        c = self.where.pop(key, None)
+        if c is None:
+            return
+        del self.cells[c][key]
+        if not self.cells[c]:
+            del self.cells[c]
+        self.count -= 1
+        if 64 < self.built_count and self.count < self.built_count // 4:
+            self.build([(x, y, k) for bucket in self.cells.values()
+                        for k, (x, y) in bucket.items()])
+
+    def nearest(self, x, y):
+        # Search rings of cells outward from the cell nearest (x, y), which
+        # may lie outside the grid. Stop once the best entry found is closer
+        # than any cell not yet searched can be.
+        if self.count == 0:
+            return None
+        cx, cy = self.cell_of(x, y)
+        cx = min(max(cx, 0), self.n_cells - 1)
+        cy = min(max(cy, 0), self.n_cells - 1)
+        best_key = None
+        best_dist = float('inf')
+        r = 0
+        while True:
+            for i in range(cx - r, cx + r + 1):
+                for j in (range(cy - r, cy + r + 1) if i in (cx - r, cx + r) else (cy - r, cy + r)):
+                    bucket = self.cells.get((i, j))
+                    if not bucket:
+                        continue
+                    for key, (px, py) in bucket.items():
+                        dist = (px - x) * (px - x) + (py - y) * (py - y)
+                        if dist < best_dist:
+                            best_dist = dist
+                            best_key = key
+            # Distance from (x, y) to each side of the searched square
+            # beyond which the grid still has unsearched cells:
+            bounds = []
+            if cx - r > 0:
+                bounds.append(x - (self.x_min + (cx - r) * self.cell))
+            if cx + r < self.n_cells - 1:
+                bounds.append(self.x_min + (cx + r + 1) * self.cell - x)
+            if cy - r > 0:
+                bounds.append(y - (self.y_min + (cy - r) * self.cell))
+            if cy + r < self.n_cells - 1:
+                bounds.append(self.y_min + (cy + r + 1) * self.cell - y)
+            if not bounds:
+                return best_key
+            bound = max(0.0, min(bounds))
+            if best_key is not None and best_dist <= bound * bound:
+                return best_key
+            r += 1
+
+
+def reversed_pathdata(d):
+    """
+    Return path data that draws the same segments as D in reverse order,
+    keeping each line and Bezier segment as it is. Returns None for paths
+    with arcs or closepath commands, which are left in their drawn order.
+    """
+    path = simplepath.parsePath(d)
+    if any(cmd in ('A', 'Z') for cmd, _params in path):
+        return None
+    subpaths = []
+    for cmd, params in path:
+        if cmd == 'M':
+            subpaths.append([params, []])
+        else:
+            subpaths[-1][1].append((cmd, params))
+    reversed_path = []
+    for start, segments in reversed(subpaths):
+        # End point of each segment's predecessor, which the reversed segment ends at
+        ends = [start] + [params[-2:] for _cmd, params in segments[:-1]]
+        reversed_path.append(['M', segments[-1][1][-2:] if segments else start])
+        for (cmd, params), end in zip(reversed(segments), reversed(ends)):
+            if cmd == 'C':
+                reversed_path.append(['C', params[2:4] + params[0:2] + end])
+            elif cmd == 'Q':
+                reversed_path.append(['Q', params[0:2] + end])
+            else:
+                reversed_path.append([cmd, end])
+    return simplepath.formatPath(reversed_path)
+
+
+def reverse_node(node):
+    """
+    Reverse the drawing direction of a path, line, or polyline in place.
+    Returns False (and leaves the node unchanged) for other elements, and
+    for paths that is_reversible() rejects.
+    """
+    if node.tag == inkex.addNS('path', 'svg') or node.tag == 'path':
+        d = reversed_pathdata(node.get('d', ''))
+        if d is None:
+            return False
+        node.set('d', d)
+        return True
+    if node.tag == inkex.addNS('line', 'svg') or node.tag == 'line':
+        x1, y1 = node.get('x1'), node.get('y1')
+        node.set('x1', node.get('x2'))
+        node.set('y1', node.get('y2'))
+        node.set('x2', x1)
+        node.set('y2', y1)
+        return True
+    if node.tag == inkex.addNS('polyline', 'svg') or node.tag == 'polyline':
+        pa = node.get('points', '').replace(',', ' ').split()
+        pairs = [pa[i] + ',' + pa[i + 1] for i in range(0, len(pa) - 1, 2)]
+        node.set('points', ' '.join(reversed(pairs)))
+        return True
+    return False
+
+
+def is_reversible(node):
+    if node.tag in (inkex.addNS('path', 'svg'), 'path'):
+        # Closed and arc paths would change shape when redrawn backwards
+        commands = set(node.get('d', ''))
+        return not commands & set('AaZz')
+    return node.tag in (inkex.addNS('line', 'svg'), 'line',
+                        inkex.addNS('polyline', 'svg'), 'polyline')
+
+
 class ReorderEffect(inkex.Effect):
     """
     Inkscape effect extension.
@@ -97,6 +253,8 @@ class ReorderEffect(inkex.Effect):
         default=1,help="How groups are handled")
         
         self.auto_rotate = True
+        self.allow_reverse = True    # Allow paths to be drawn end-to-start
+        self.improve_time = 0.0      # Time budget (s) for 2-opt improvement; 0 to skip
 
     def effect(self):
         # Main entry point of the program
@@ -385,7 +543,7 @@ class ReorderEffect(inkex.Effect):
                 group_dict[id] = node   # Entry in group_dict is this node 
 
         # Perform the re-ordering:
-        ordered_element_list = self.ReorderNodeList(coord_dict, group_dict)
+        ordered_element_list, _ = self.ReorderNodeList(coord_dict, group_dict)
 
         # Once a better order for the svg elements has been determined,
         # All there is do to is to reintroduce the nodes to the parent in the correct order
@@ -1118,83 +1276,151 @@ class ReorderEffect(inkex.Effect):
 
 
     def ReorderNodeList(self, coord_dict, group_dict):
-        # Re-order the given set of SVG elements, using a simple "greedy" algorithm.
-        # The first object will be the element closest to the origin
-        # After this choice, the algorithm loops through all remaining elements looking for the element whose first x,y
-        # coordinates are closest to the the previous choice's last x,y coordinates
-        # This process continues until all elements have been sorted into ordered_element_list and removed from group_dict    
-        
+        """
+        Re-order the given set of SVG elements with a greedy nearest-neighbor
+        algorithm: starting from the last known pen position, repeatedly
+        choose the element whose entry point is closest to the previous
+        element's exit point. Paths, lines, and polylines may also be
+        entered from their last point, in which case they are reversed.
+        A uniform grid over the endpoints keeps each search local.
+
+        If self.improve_time is nonzero, the greedy order is then refined
+        with 2-opt moves (reversing runs of reversible elements) until no
+        move helps or the time budget runs out.
+
+        Returns the re-ordered list of elements and the pen-up travel
+        distance between them. Non-plottable elements keep their original
+        positions in the list, so hidden or non-drawing elements stay where
+        they were in z-order.
+        Travel totals, before and after sorting, are also accumulated in
+        self.air_total_default and self.air_total_sorted.
+        """
+
+        keys = [key for key in group_dict if coord_dict[key][0]]
+        idle_keys = [(position, key) for position, key in enumerate(group_dict)
+                     if not coord_dict[key][0]]
+
+        x_start = self.x_last
+        y_start = self.y_last
+        x_prev = x_start
+        y_prev = y_start
+        for key in keys:
+            self.air_total_default += math.hypot(coord_dict[key][1] - x_prev,
+                                                 coord_dict[key][2] - y_prev)
+            x_prev = coord_dict[key][3]
+            y_prev = coord_dict[key][4]
+
+        # Grid entries are keyed by (index, reversed).
+        entries = []
+        reversible = []
+        for index, key in enumerate(keys):
+            entries.append((coord_dict[key][1], coord_dict[key][2], (index, False)))
+            can_reverse = self.allow_reverse and is_reversible(group_dict[key])
+            reversible.append(can_reverse)
+            if can_reverse:
+                entries.append((coord_dict[key][3], coord_dict[key][4], (index, True)))
+        grid = EndpointGrid(entries)
+
+        # A tour is a list of (index, reversed) pairs
+        tour = []
+        while grid.count:
+            index, flip = grid.nearest(self.x_last, self.y_last)
+            grid.remove((index, False))
+            grid.remove((index, True))
+            tour.append((index, flip))
+            coords = coord_dict[keys[index]]
+            self.x_last, self.y_last = (coords[1], coords[2]) if flip else (coords[3], coords[4])
+
+        if self.improve_time > 0:
+            tour = self.improve_tour(tour, keys, coord_dict, reversible, x_start, y_start)
+
         ordered_layer_element_list = []
-            
-        # Continue until all elements have been re-ordered
-        while group_dict:
-            
-            nearest_dist = float('inf')
-            for key,node in group_dict.items():    
-                # Is this node non-plottable?
-                # If so, exit loop and append element to ordered_layer_element_list
-                if not coord_dict[key][0]:
-                    # Object is not Plottable
-                    nearest = node 
-                    nearest_id = key 
-                    continue
-                
-                # If we reach this point, node is plottable and needs to be considered in our algo
-                entry_x = coord_dict[key][1] # x-coordinate of first point of the path
-                entry_y = coord_dict[key][2] # y-coordinate of first point of the path
-
-                exit_x = coord_dict[key][3] # x-coordinate of last point of the path
-                exit_y = coord_dict[key][4] # y-coordinate of last point of the path
-
-                object_dist = (entry_x-self.x_last)*(entry_x-self.x_last) + (entry_y-self.y_last) * (entry_y-self.y_last)
-                # This is actually the distance squared; calculating it rather than the pythagorean distance
-                #  saves a square root calculation. Right now, we only care about _which distance is less_
-                #  not the exact value of it, so this is a harmless shortcut.
-                # If this distance is smaller than the previous element's distance, then replace the previous
-                # element's entry with our current element's distance 
-                if nearest_dist >= object_dist:
-                    # We have found an element closer than the previous closest element 
-                    nearest = node
-                    nearest_id = key 
-                    nearest_dist = object_dist
-                    nearest_start_x = entry_x
-                    nearest_start_y = entry_y
-
-            # Now that the closest object has been determined, it is time to add it to the 
-            # optimized list of closest objects
-            ordered_layer_element_list.append(nearest)
-    
-            # To determine the closest object in the next iteration of the loop, 
-            # we must save the last x,y coor of this element
-            # If this element is plottable, then save the x,y coordinates
-            # If this element is non-plottable, then do not save the x,y coordinates
-            if coord_dict[nearest_id][0]:
-            
-                # Also, draw line indicating that we've found a new point.
-                if self.preview_rendering: 
-                    preview_path = []    # pen-up path data for preview 
-
-                    preview_path.append("M{0:.3f} {1:.3f}".format(
-                        self.x_last, self.y_last))
-                    preview_path.append("{0:.3f} {1:.3f}".format(
-                        nearest_start_x, nearest_start_y))
-                    self.p_style.update({'stroke': self.color_index(self.layer_index)})  
-                    path_attrs = {
-                        'style': simplestyle.formatStyle( self.p_style ),
-                        'd': " ".join(preview_path)}
-                        
-                    etree.SubElement( self.preview_layer,
-                        inkex.addNS( 'path', 'svg '), path_attrs, nsmap=inkex.NSS )
+        travel = 0
+        self.x_last = x_start
+        self.y_last = y_start
+        for index, flip in tour:
+            node = group_dict[keys[index]]
+            coords = coord_dict[keys[index]]
+            if flip:
+                reverse_node(node)
+                entry_x, entry_y, exit_x, exit_y = coords[3], coords[4], coords[1], coords[2]
+            else:
+                entry_x, entry_y, exit_x, exit_y = coords[1:5]
+            travel += math.hypot(entry_x - self.x_last, entry_y - self.y_last)
+
+            # Also, draw line indicating that we've found a new point.
+            if self.preview_rendering: 
+                preview_path = []    # pen-up path data for preview 
+
+                preview_path.append("M{0:.3f} {1:.3f}".format(
+                    self.x_last, self.y_last))
+                preview_path.append("{0:.3f} {1:.3f}".format(
+                    entry_x, entry_y))
+                self.p_style.update({'stroke': self.color_index(self.layer_index)})  
+                path_attrs = {
+                    'style': simplestyle.formatStyle( self.p_style ),
+                    'd': " ".join(preview_path)}
+                    
+                etree.SubElement( self.preview_layer,
+                    inkex.addNS( 'path', 'svg '), path_attrs, nsmap=inkex.NSS )
 
-                self.x_last = coord_dict[nearest_id][3]
-                self.y_last = coord_dict[nearest_id][4]
+            ordered_layer_element_list.append(node)
+            self.x_last = exit_x
+            self.y_last = exit_y
 
-            # Remove this element from group_dict to indicate it has been optimized
-            del group_dict[nearest_id]
-    
-        # Once all elements have been removed from the group_dictionary
-        # Return the optimized list of svg elements in the layer
-        return ordered_layer_element_list
+        for position, key in idle_keys:
+            ordered_layer_element_list.insert(position, group_dict[key])
+        group_dict.clear()
+
+        self.air_total_sorted += travel
+        return ordered_layer_element_list, travel
+
+    def improve_tour(self, tour, keys, coord_dict, reversible, x_start, y_start):
+        """
+        2-opt improvement of an open tour that starts at (x_start, y_start).
+        Reversing the run tour[i..j] reverses each element in it, so only
+        runs of reversible elements are considered. Stops when no move
+        shortens the tour, or after self.improve_time seconds.
+        """
+        deadline = time.time() + self.improve_time
+
+        def entry_pt(item):
+            c = coord_dict[keys[item[0]]]
+            return (c[3], c[4]) if item[1] else (c[1], c[2])
+
+        def exit_pt(item):
+            c = coord_dict[keys[item[0]]]
+            return (c[1], c[2]) if item[1] else (c[3], c[4])
+
+        def dist(a, b):
+            return math.hypot(a[0] - b[0], a[1] - b[1])
+
+        n = len(tour)
+        improved = True
+        while improved and time.time() < deadline:
+            improved = False
+            for i in range(n):
+                if time.time() >= deadline:
+                    break
+                if not reversible[tour[i][0]]:
+                    continue
+                prev_exit = exit_pt(tour[i - 1]) if i > 0 else (x_start, y_start)
+                entry_i = entry_pt(tour[i])
+                for j in range(i + 1, n):
+                    if not reversible[tour[j][0]]:
+                        break  # Runs may not contain irreversible elements
+                    exit_j = exit_pt(tour[j])
+                    old = dist(prev_exit, entry_i)
+                    new = dist(prev_exit, exit_j)
+                    if j + 1 < n:
+                        next_entry = entry_pt(tour[j + 1])
+                        old += dist(exit_j, next_entry)
+                        new += dist(entry_i, next_entry)
+                    if new < old - 1e-9:
+                        tour[i:j + 1] = [(index, not flip) for index, flip in reversed(tour[i:j + 1])]
+                        entry_i = entry_pt(tour[i])
+                        improved = True
+        return tour
 
     
     def color_index(self, index):
@@ -33,6 +33,8 @@
 # SOFTWARE.
 
 import gettext
+import threading
+from collections import deque
 
 try:
     from plot_utils_import import from_dependency_import
@@ -378,6 +380,125 @@ def command(port_name, cmd):
 	            inkex.errormsg('Failed after command: {0}'.format(cmd))
 
 
+class CommandStream(object):
+    """
+    Pipelined command sender for an open EBB serial port.
+
+    command() writes without waiting for the "OK", keeping up to `window`
+    commands in flight; a reader thread matches each response line to the
+    oldest outstanding command, in order. Sending blocks only when the
+    window is full, so throughput is set by the EBB's motion FIFO rather
+    than by one USB round trip per command.
+
+    Unexpected responses and timeouts are reported (as by command()) and
+    recorded in `errors` as (command, response) pairs, against the
+    command that caused them. query() waits for its own reply, in order
+    with the stream. Call close() when finished; it waits for all
+    outstanding acknowledgements.
+    """
+
+    # Queries that do not send an extra "OK" line after their data; see query().
+    SINGLE_LINE_QUERIES = ["v", "i", "a", "mr", "pi", "qm"]
+
+    def __init__(self, port_name, window=8, max_retries=100):
+        self.port = port_name
+        self.max_retries = max_retries
+        self.errors = []
+        self.pending = deque()  # [cmd, lines_expected, lines_received, done_event]
+        self.lock = threading.Condition()
+        self.slots = threading.BoundedSemaphore(window)
+        self.closing = False
+        self.reader = threading.Thread(target=self._read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def command(self, cmd):
+        # Send a command, returning once it is written (not acknowledged).
+        self._send(cmd, 1)
+
+    def query(self, cmd):
+        # Send a query and wait for its response, which is returned.
+        if cmd.strip().lower() in CommandStream.SINGLE_LINE_QUERIES:
+            entry = self._send(cmd, 1)
+        else:
+            entry = self._send(cmd, 2)
+        entry[3].wait()
+        return entry[2][0] if entry[2] else ''
+
+    def flush(self):
+        # Wait until every command sent so far has been acknowledged.
+        with self.lock:
+            while self.pending:
+                self.lock.wait()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+        self.reader.join()
+
+    def _send(self, cmd, lines_expected):
+        self.slots.acquire()
+        entry = [cmd, lines_expected, [], threading.Event()]
+        with self.lock:
+            self.pending.append(entry)
+            self.lock.notify_all()
+        try:
+            self.port.write(cmd.encode('ascii'))
+        except:
+            self._finish(entry, '')
+            inkex.errormsg('Failed after command: {0}'.format(cmd))
+        return entry
+
+    def _finish(self, entry, error_response):
+        with self.lock:
+            if self.pending and self.pending[0] is entry:
+                self.pending.popleft()
+            elif entry in self.pending:
+                self.pending.remove(entry)
+            else:
+                return
+            if error_response is not None:
+                self.errors.append((entry[0].strip(), error_response))
+            self.lock.notify_all()
+        entry[3].set()
+        self.slots.release()
+
+    def _read_responses(self):
+        n_retry_count = 0
+        while True:
+            with self.lock:
+                while not self.pending and not self.closing:
+                    self.lock.wait()
+                if not self.pending:
+                    return
+                entry = self.pending[0]
+            try:
+                response = self.port.readline().decode('ascii')
+            except:
+                response = ''
+            if len(response) == 0:
+                n_retry_count += 1
+                if n_retry_count >= self.max_retries:
+                    inkex.errormsg('EBB Serial Timeout after command: {0}'.format(entry[0]))
+                    self._finish(entry, '')
+                    n_retry_count = 0
+                continue
+            n_retry_count = 0
+            entry[2].append(response)
+            if len(entry[2]) < entry[1]:
+                continue
+            if entry[1] == 1 and entry[0].strip().lower() not in CommandStream.SINGLE_LINE_QUERIES \
+                    and not response.strip().startswith("OK"):
+                inkex.errormsg('Error: Unexpected response from EBB.')
+                inkex.errormsg('   Command: {0}'.format(entry[0].strip()))
+                inkex.errormsg('   Response: {0}'.format(response.strip()))
+                self._finish(entry, response.strip())
+            else:
+                self._finish(entry, None)
+
+
 def bootload(port_name):
     # Enter bootloader mode. Do not try to read back data.
     if port_name is not None:
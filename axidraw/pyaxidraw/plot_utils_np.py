@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# plot_utils_np.py
+# Array-based versions of hot plotting routines, for use when NumPy is available.
+#
+# Each routine here produces the same result (within floating-point rounding)
+# as its pure-Python counterpart in axidraw.py or plot_utils.py, which remain
+# the reference implementations and the fallback when NumPy is not installed.
+
+import numpy as np
+
+
+def _min_dist_vertex_indices(points, min_dist):
+    """
+    Indices of the vertices kept when skipping segments shorter than min_dist.
+    Distances are measured from the last _kept_ vertex, so once a short
+    segment is found the remainder is walked sequentially.
+    """
+    deltas = np.diff(points, axis=0)
+    dists = np.hypot(deltas[:, 0], deltas[:, 1])
+    short = dists < min_dist
+    if not short.any():
+        return np.arange(len(points))
+
+    first_short = int(np.argmax(short)) + 1
+    kept = list(range(first_short))
+    last_x, last_y = points[first_short - 1]
+    for i in range(first_short, len(points)):
+        x, y = points[i]
+        if np.hypot(x - last_x, y - last_y) >= min_dist:
+            kept.append(i)
+            last_x, last_y = x, y
+    return np.array(kept)
+
+
+def _min_plus_scan(caps, increments):
+    """
+    Evaluates the recurrence u[0] = caps[0], u[i] = min(caps[i], u[i-1] + increments[i])
+    without a Python loop, via its closed form
+        u[i] = S[i] + min_{k <= i} (caps[k] - S[k]),  S = cumsum(increments).
+    """
+    sums = np.cumsum(increments)
+    return sums + np.minimum.accumulate(caps - sums)
+
+
+def trajectory_segments(input_path, min_dist, speed_limit, accel_rate, delta):
+    """
+    Vectorized equivalent of AxiDraw.plan_trajectory_segments().
+
+    Inputs: ordered (x, y) vertices in inches, the minimum segment length to
+    keep, the XY speed limit (in/s), acceleration rate (in/s^2), and the
+    cornering tolerance factor.
+
+    Output: a list of segments of the form (Xfinal, Yfinal, v_initial, v_final).
+    """
+    if len(input_path) < 2:
+        return []
+    if len(input_path) < 3:
+        return [(input_path[1][0], input_path[1][1], 0, 0)]
+
+    points = np.asarray(input_path, dtype=np.float64)
+    points = points[_min_dist_vertex_indices(points, min_dist)]
+    if len(points) < 2:
+        return []
+    if len(points) < 3:
+        return [(float(points[1][0]), float(points[1][1]), 0, 0)]
+
+    deltas = np.diff(points, axis=0)
+    # The reference planner stores segment lengths in single precision.
+    dists = np.hypot(deltas[:, 0], deltas[:, 1])
+    unit_vectors = deltas / dists[:, np.newaxis]
+    dists = dists.astype(np.float32).astype(np.float64)
+
+    # Cornering limit at each interior vertex, modeling the corner as a
+    # short arc (see plan_trajectory_segments for the derivation).
+    cosine_factor = -np.clip(np.einsum('ij,ij->i', unit_vectors[:-1], unit_vectors[1:]), -1, 1)
+    root_factor = np.sqrt((1 - cosine_factor) / 2)
+    denominator = 1 - root_factor
+    rfactor = np.full(denominator.shape, 100000.0)
+    curved = denominator > 0.0001
+    rfactor[curved] = (delta * root_factor[curved]) / denominator[curved]
+    v_junction = np.sqrt(accel_rate * rfactor)
+
+    # Work in squared velocities, where the kinematic limits are additive:
+    # v_f^2 <= v_i^2 + 2 a d, in both the forward and backward passes.
+    caps = np.empty(len(points))
+    caps[0] = 0.0
+    caps[1:-1] = np.minimum(speed_limit, v_junction) ** 2
+    caps[-1] = 0.0
+    increments = np.empty(len(points))
+    increments[0] = 0.0
+    increments[1:] = 2 * accel_rate * dists
+
+    forward = _min_plus_scan(caps, increments)
+    forward[-1] = 0.0
+
+    # Backward pass: the same scan, run from the end of the path.
+    backward_increments = np.empty(len(points))
+    backward_increments[0] = 0.0
+    backward_increments[1:] = increments[:0:-1]
+    backward = _min_plus_scan(forward[::-1], backward_increments)[::-1]
+
+    vels = np.sqrt(np.maximum(backward, 0)).astype(np.float32).tolist()
+    x_vals = points[1:, 0].tolist()
+    y_vals = points[1:, 1].tolist()
+    return list(zip(x_vals, y_vals, vels[:-1], vels[1:]))
+
+
+def _segment_distances(points, starts, ends):
+    """
+    Distances from each of POINTS (n x 2) to the segment from STARTS to
+    ENDS (arrays broadcastable against POINTS), measured as in
+    ffgeom.Segment.distanceToPoint: to the nearer endpoint when the
+    projection falls outside the segment, otherwise perpendicular.
+    """
+    dx = ends[..., 0] - starts[..., 0]
+    dy = ends[..., 1] - starts[..., 1]
+    c1 = (points[..., 0] - starts[..., 0]) * dx + (points[..., 1] - starts[..., 1]) * dy
+    c2 = dx * dx + dy * dy
+    to_start = np.sqrt((starts[..., 0] - points[..., 0]) ** 2 + (starts[..., 1] - points[..., 1]) ** 2)
+    to_end = np.sqrt((ends[..., 0] - points[..., 0]) ** 2 + (ends[..., 1] - points[..., 1]) ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        perp = np.fabs(dx * (starts[..., 1] - points[..., 1])
+                       - (starts[..., 0] - points[..., 0]) * dy) / np.sqrt(c2)
+    return np.where(c1 <= 0, to_start, np.where(c2 <= c1, to_end, perp))
+
+
+def _furthest_removable_end(points, start, tolerance, max_block=64):
+    """
+    The largest index `end` such that, for every candidate end e with
+    start + 2 <= e <= end, all points strictly between start and e lie
+    within TOLERANCE of the segment (start, e). Candidates are tested in
+    blocks of growing size, each block in a single array operation.
+    """
+    n = len(points)
+    end = start + 1
+    block = 4
+    while end < n - 1:
+        candidates = np.arange(end + 1, min(end + 1 + block, n))
+        between = points[start + 1:candidates[-1]]
+        dists = _segment_distances(between[np.newaxis, :, :],
+                                   points[start][np.newaxis, np.newaxis, :],
+                                   points[candidates][:, np.newaxis, :])
+        # Only points before each candidate end count towards it.
+        mask = np.arange(start + 1, candidates[-1])[np.newaxis, :] < candidates[:, np.newaxis]
+        worst = np.where(mask, dists, 0.0).max(axis=1)
+        failed = np.flatnonzero(~(worst < tolerance))
+        if len(failed):
+            return int(candidates[failed[0]]) - 1
+        end = int(candidates[-1])
+        block = min(2 * block, max_block)
+    return end
+
+
+def supersample(vertices, tolerance):
+    """
+    Array-based equivalent of plot_utils.supersample(): removes, in place,
+    the vertices that lie within TOLERANCE of a straight segment joining
+    their neighbors, with the same greedy order and tolerance semantics.
+    """
+    if len(vertices) <= 2:  # there is nothing to delete
+        return vertices
+
+    points = np.asarray(vertices, dtype=np.float64)
+    n = len(points)
+    # Whether each vertex can start a removal at all, i.e. whether the
+    # vertex after it is within tolerance of the segment skipping it.
+    # Runs of vertices that cannot are kept without further work.
+    can_start = _segment_distances(points[1:-1], points[:-2], points[2:]) < tolerance
+    starts = np.flatnonzero(can_start)
+
+    kept = []
+    start = 0
+    while start < n - 2:
+        next_start = np.searchsorted(starts, start)
+        if next_start == len(starts):
+            break
+        if starts[next_start] > start:
+            kept.extend(range(start, int(starts[next_start])))
+            start = int(starts[next_start])
+            continue
+        kept.append(start)
+        start = _furthest_removable_end(points, start, tolerance)
+    kept.extend(range(start, n))
+    vertices[:] = [vertices[i] for i in kept]
+
+
+def subdivide_cubic_path(sp, flat):
+    """
+    Array-based replacement for plot_utils.subdivideCubicPath(): flattens
+    the cubic subpath SP (a cubicsuperpath list of [control in, point,
+    control out] nodes) in place into straight segments, each within FLAT
+    of the curve. See subdivide_cubic_paths().
+    """
+    subdivide_cubic_paths([sp], flat)
+
+
+def subdivide_cubic_paths(csp, flat):
+    """
+    Flattens every subpath of the cubicsuperpath CSP in place, as
+    subdivide_cubic_path() does for one, evaluating all of them together.
+
+    Rather than splitting curves in half until they are flat, the number
+    of equal steps in t needed for each cubic is computed up front from
+    a bound on its second derivative, |B''| <= 6 max(|P0 - 2 P1 + P2|,
+    |P1 - 2 P2 + P3|). A chord spanning a step of 1/n in t strays at most
+    |B''| / (8 n^2) from the curve, so n = ceil(sqrt(3 L / (4 FLAT))),
+    where L is the larger of those second differences. All sample points
+    are then evaluated in one pass. The resulting nodes have their
+    control points on the vertex itself, i.e. are straight lines.
+    """
+    lengths = np.array([len(sp) for sp in csp])
+    if not len(csp) or lengths.max() < 2:
+        return
+    nodes = np.array([node for sp in csp for node in sp], dtype=np.float64)  # (n, 3, 2)
+    # Cubics join consecutive nodes of the same subpath.
+    last_nodes = np.cumsum(lengths) - 1
+    joined = np.ones(len(nodes) - 1, dtype=bool)
+    joined[last_nodes[:-1]] = False
+    starts = np.flatnonzero(joined)
+    p0 = nodes[starts, 1]
+    p1 = nodes[starts, 2]
+    p2 = nodes[starts + 1, 0]
+    p3 = nodes[starts + 1, 1]
+
+    second_diff = np.maximum(np.hypot(*(p0 - 2 * p1 + p2).T), np.hypot(*(p1 - 2 * p2 + p3).T))
+    steps = np.ceil(np.sqrt(0.75 * second_diff / flat))
+    steps = np.maximum(np.nan_to_num(steps, nan=1.0, posinf=1.0), 1).astype(np.int64)
+    # As in the reference, a cubic whose control points are already within
+    # FLAT of its chord (and so the whole curve, which lies in their hull)
+    # needs no subdivision, however unevenly it is parametrized.
+    hull_dist = np.maximum(_segment_distances(p1, p0, p3), _segment_distances(p2, p0, p3))
+    steps[hull_dist <= flat] = 1
+
+    # Parameter values t = 1/n, 2/n, ..., 1 for each cubic, all in one array.
+    segment = np.repeat(np.arange(len(steps)), steps)
+    ends = np.cumsum(steps)
+    t = ((np.arange(len(segment)) - (ends - steps)[segment] + 1) / steps[segment])[:, np.newaxis]
+    s = 1 - t
+    points = (s * s * s * p0[segment] + 3 * s * s * t * p1[segment]
+              + 3 * s * t * t * p2[segment] + t * t * t * p3[segment])
+    points[ends - 1] = p3  # Land exactly on each endpoint
+
+    # Hand each subpath back its own samples.
+    subpath_of_cubic = np.searchsorted(last_nodes, starts)
+    samples_per_subpath = np.bincount(subpath_of_cubic, weights=steps, minlength=len(csp)).astype(np.int64)
+    vertices = points.tolist()
+    first = 0
+    for sp, count in zip(csp, samples_per_subpath):
+        if len(sp) < 2:
+            continue
+        start_point = list(sp[0][1])
+        sp[:] = [[start_point, start_point, start_point]] + \
+            [[v, v, v] for v in vertices[first:first + count]]
+        first += count
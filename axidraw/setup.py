@@ -30,6 +30,9 @@ setup(
     ],
     extras_require={
         'dev': [],
+        'numpy': [
+            'numpy'
+        ],
         'test': [
             'mock'
         ],
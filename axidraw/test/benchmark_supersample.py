@@ -0,0 +1,41 @@
+"""
+Times plot_utils.supersample against plot_utils_np.supersample on the
+polylines that plotting geometries/streamlines.svg and gel_wave.svg
+produces, and on a long, finely sampled curve. With pyaxidraw installed,
+run from this directory:
+
+    python benchmark_supersample.py
+"""
+import copy
+import math
+import time
+
+from pyaxidraw import axidraw
+
+from test_supersample import collect_polylines
+
+def time_simplifier(simplify, polylines, tolerance, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        inputs = copy.deepcopy(polylines)
+        start = time.perf_counter()
+        for polyline in inputs:
+            simplify(polyline, tolerance)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def report(name, polylines, tolerance):
+    n_vertices = sum(len(p) for p in polylines)
+    reference = time_simplifier(axidraw.plot_utils.supersample, polylines, tolerance)
+    vectorized = time_simplifier(axidraw.plot_utils_np.supersample, polylines, tolerance)
+    print('{0}: {1} polylines, {2} vertices; reference {3:.3f} s, '
+          'NumPy {4:.3f} s ({5:.1f}x)'.format(name, len(polylines), n_vertices,
+                                              reference, vectorized, reference / vectorized))
+
+if __name__ == '__main__':
+    tolerance = axidraw.axidraw_conf.segment_supersample_tolerance
+    for filename in ('streamlines.svg', 'gel_wave.svg'):
+        report(filename, collect_polylines(filename), tolerance)
+    spiral = [[t * math.cos(t) / 100, t * math.sin(t) / 100]
+              for t in (i * 0.001 for i in range(20000))]
+    report('spiral', [spiral], tolerance)
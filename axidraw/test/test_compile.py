@@ -0,0 +1,82 @@
+import unittest
+
+from pyaxidraw import axidraw
+
+from test_ebb_serial import LoopbackEBBPort
+from test_trajectory import load_geometry
+
+# python -m unittest discover -s test in top-level package dir
+
+class CompileTestCase(unittest.TestCase):
+
+    def compile_geometry(self, filename):
+        ad = axidraw.AxiDraw()
+        ad.plot_setup(load_geometry(filename))
+        ad.Secondary = True  # Keep plot reports out of the test output
+        return ad, ad.plot_compile()
+
+    def test_plan_is_complete(self):
+        ad, commands = self.compile_geometry('box.svg')
+        self.assertEqual([c.split(',')[0] for c in commands[:7]],
+                         ['SC', 'SC', 'SC', 'SC', 'SL', 'SP', 'EM'])
+        self.assertTrue(commands[5].startswith('SP,1,'))
+        moves = [[int(v) for v in c.split(',')[2:]] for c in commands if c.startswith('SM')]
+        self.assertEqual(sum(m[0] for m in moves), 0)  # Plot ends back at home
+        self.assertEqual(sum(m[1] for m in moves), 0)
+        # The setup before EM is only compiled; the estimate covers the rest
+        total_time = sum(axidraw.AxiDraw.compiled_command_duration(c) for c in commands[6:])
+        self.assertEqual(total_time, ad.pt_estimate)
+
+    def test_compile_leaves_preview_output_unchanged(self):
+        for filename in ('box.svg', 'mustache.svg'):
+            with self.subTest(geometry=filename):
+                ad = axidraw.AxiDraw()
+                ad.plot_setup(load_geometry(filename))
+                ad.options.preview = True
+                ad.Secondary = True
+                preview_svg, instructions = ad.plot_run(True)
+                compiled = axidraw.AxiDraw()
+                compiled.plot_setup(load_geometry(filename))
+                compiled.Secondary = True
+                compiled_svg, compiled_instructions, commands = compiled.plot_compile(True)
+                self.assertEqual(compiled_instructions, instructions)
+                self.assertEqual(compiled.pt_estimate, ad.pt_estimate)
+                self.assertEqual(compiled_svg, preview_svg)
+                self.assertTrue(instructions[0].startswith('EM,'))
+                # The preview log lists motor steps in the opposite order to the EBB.
+                moves = [c for c in instructions if c.startswith('SM')]
+                swapped = ['SM,{0},{2},{1}'.format(*c.split(',')[1:]) for c in commands if c.startswith('SM')]
+                self.assertEqual(moves, swapped)
+
+    def test_run_compiled_streams_commands(self):
+        _, commands = self.compile_geometry('box.svg')
+        ad = axidraw.AxiDraw()
+        ad.plot_setup()
+        ad.serial_port = LoopbackEBBPort()
+        self.assertEqual(ad.plot_run_compiled(commands), len(commands))
+        sent = [c for c in ad.serial_port.written if c != 'QB']
+        self.assertEqual(sent, commands + ['SM,10,0,0'])
+
+    def test_run_compiled_halts_on_button_press(self):
+        ad = axidraw.AxiDraw()
+        ad.plot_setup()
+        ad.Secondary = True
+        ad.serial_port = LoopbackEBBPort(button_states=[0, 0, 1])
+        commands = ['SP,1,60', 'SP,0,60'] + ['SM,60,10,10'] * 20
+        sent = ad.plot_run_compiled(commands)
+        self.assertTrue(ad.b_stopped)
+        self.assertLess(sent, len(commands))
+        self.assertEqual(ad.serial_port.written[-2:], ['SP,1,60', 'SM,10,0,0'])
+
+    def test_run_compiled_halts_on_ebb_error(self):
+        ad = axidraw.AxiDraw()
+        ad.plot_setup()
+        ad.Secondary = True
+        ad.serial_port = LoopbackEBBPort(errors=['SM,60,5,5'])
+        commands = ['SP,1,60', 'SP,0,60'] + ['SM,60,10,10'] * 5 + ['SM,60,5,5'] + ['SM,60,10,10'] * 20
+        sent = ad.plot_run_compiled(commands)
+        self.assertTrue(ad.b_stopped)
+        self.assertLess(sent, len(commands))
+        self.assertEqual(ad.ebb_errors, [('SM,60,5,5', '!8 Err: Unknown command')])
+        self.assertIn('EBB error after command SM,60,5,5', ad.error_out)
+        self.assertEqual(ad.serial_port.written[-2:], ['SP,1,60', 'SM,10,0,0'])
@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+import unittest
+
+from pyaxidraw import ebb_serial
+
+# python -m unittest discover -s test in top-level package dir
+
+class LoopbackEBBPort:
+    """
+    Emulates an EBB on the far side of a serial port. Commands are handled
+    in order on a device thread after `latency` seconds; each is
+    acknowledged with OK, except those listed in `errors`, which get an
+    error reply. A move is not acknowledged until the move before it has
+    finished, as with the EBB's motion FIFO. QB queries answer from
+    `button_states`, then 0.
+    """
+    def __init__(self, latency=0.0, errors=(), button_states=()):
+        self.latency = latency
+        self.errors = set(errors)
+        self.button_states = list(button_states)
+        self.written = []
+        self.max_outstanding = 0
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        self.incoming = queue.Queue()
+        self.outgoing = queue.Queue()
+        device = threading.Thread(target=self._run_device)
+        device.daemon = True
+        device.start()
+
+    def write(self, data):
+        cmd = data.decode('ascii').strip()
+        with self.lock:
+            self.written.append(cmd)
+            self.outstanding += 1
+            self.max_outstanding = max(self.max_outstanding, self.outstanding)
+        self.incoming.put((time.time() + self.latency, cmd))
+
+    def readline(self):
+        try:
+            line = self.outgoing.get(timeout=0.01)
+        except queue.Empty:
+            return b''
+        return line.encode('ascii')
+
+    def _run_device(self):
+        busy_until = 0
+        while True:
+            arrival, cmd = self.incoming.get()
+            time.sleep(max(0, arrival - time.time()))
+            fields = cmd.split(',')
+            if fields[0] == 'QB':
+                state = self.button_states.pop(0) if self.button_states else 0
+                self.outgoing.put('{0}\r\n'.format(state))
+            if fields[0] == 'SM':
+                time.sleep(max(0, busy_until - time.time()))
+                busy_until = time.time() + int(fields[1]) / 1000.0
+            with self.lock:
+                self.outstanding -= 1
+            if cmd in self.errors:
+                self.outgoing.put('!8 Err: Unknown command\r\n')
+            else:
+                self.outgoing.put('OK\r\n')
+
+class CommandStreamTestCase(unittest.TestCase):
+
+    def test_sends_in_order_within_window(self):
+        port = LoopbackEBBPort(latency=0.002)
+        stream = ebb_serial.CommandStream(port, window=4)
+        commands = ['SM,1,{0},0'.format(i) for i in range(50)]
+        for cmd in commands:
+            stream.command(cmd + '\r')
+        stream.close()
+        self.assertEqual(port.written, commands)
+        self.assertLessEqual(port.max_outstanding, 4)
+        self.assertGreater(port.max_outstanding, 1)
+        self.assertEqual(stream.errors, [])
+
+    def test_pipelining_hides_round_trip_latency(self):
+        latency = 0.01
+        commands = ['SM,1,1,1'] * 20
+        port = LoopbackEBBPort(latency=latency)
+        start = time.time()
+        stream = ebb_serial.CommandStream(port, window=8)
+        for cmd in commands:
+            stream.command(cmd + '\r')
+        stream.close()
+        self.assertLess(time.time() - start, latency * len(commands) / 2)
+
+    def test_errors_reported_against_command(self):
+        port = LoopbackEBBPort(errors=['SM,1,5,0'])
+        stream = ebb_serial.CommandStream(port)
+        for i in range(10):
+            stream.command('SM,1,{0},0\r'.format(i))
+        stream.close()
+        self.assertEqual(stream.errors, [('SM,1,5,0', '!8 Err: Unknown command')])
+
+    def test_query_returns_reply_in_stream_order(self):
+        port = LoopbackEBBPort(button_states=[1])
+        stream = ebb_serial.CommandStream(port)
+        stream.command('SM,1,1,1\r')
+        self.assertEqual(stream.query('QB\r').strip(), '1')
+        self.assertEqual(stream.query('QB\r').strip(), '0')
+        stream.close()
+        self.assertEqual(stream.errors, [])
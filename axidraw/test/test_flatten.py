@@ -0,0 +1,73 @@
+import copy
+import os
+import unittest
+
+from lxml import etree
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from pyaxidraw import axidraw
+
+from test_trajectory import GEOMETRIES_DIR
+
+# python -m unittest discover -s test in top-level package dir
+
+def load_subpaths(filename):
+    subpaths = []
+    for node in etree.parse(os.path.join(GEOMETRIES_DIR, filename)).iter('{http://www.w3.org/2000/svg}path'):
+        subpaths.extend(axidraw.cubicsuperpath.parsePath(node.get('d')))
+    return subpaths
+
+@unittest.skipIf(axidraw.plot_utils_np is None, 'NumPy is not installed')
+class FlattenTestCase(unittest.TestCase):
+
+    def assert_within_tolerance(self, original, flattened, flat):
+        polyline = np.array([node[1] for node in flattened])
+        self.assertEqual(polyline[0].tolist(), original[0][1])
+        self.assertEqual(polyline[-1].tolist(), original[-1][1])
+        a = polyline[:-1]
+        d = polyline[1:] - a
+        for prev, node in zip(original[:-1], original[1:]):
+            t = np.linspace(0, 1, 50)[:, np.newaxis]
+            s = 1 - t
+            p0, p1, p2, p3 = (np.array(v) for v in (prev[1], prev[2], node[0], node[1]))
+            curve = s ** 3 * p0 + 3 * s * s * t * p1 + 3 * s * t * t * p2 + t ** 3 * p3
+            # Distance from each curve sample to the nearest polyline segment
+            dd = np.maximum((d * d).sum(axis=1), 1e-300)
+            u = np.clip(((curve[:, np.newaxis] - a) * d).sum(axis=2) / dd, 0, 1)
+            nearest = a + u[:, :, np.newaxis] * d
+            dist = np.hypot(*(nearest - curve[:, np.newaxis]).transpose(2, 0, 1)).min(axis=1)
+            self.assertLessEqual(dist.max(), flat * 1.0001)
+
+    def test_flattened_paths_stay_within_tolerance(self):
+        flat = 0.05
+        for filename in ('mustache.svg', 'cat_uistperer.svg', 'soft_stache.svg'):
+            with self.subTest(geometry=filename):
+                subpaths = load_subpaths(filename)
+                flattened = copy.deepcopy(subpaths)
+                axidraw.plot_utils_np.subdivide_cubic_paths(flattened, flat)
+                self.assertEqual(len(flattened), len(subpaths))
+                for original, result in zip(subpaths, flattened):
+                    self.assert_within_tolerance(original, result, flat)
+
+    def test_vertex_count_comparable_to_reference(self):
+        subpaths = load_subpaths('cat_uistperer.svg')
+        reference = copy.deepcopy(subpaths)
+        for sp in reference:
+            axidraw.plot_utils.subdivideCubicPath(sp, 0.02)
+        flattened = copy.deepcopy(subpaths)
+        axidraw.plot_utils_np.subdivide_cubic_paths(flattened, 0.02)
+        n_reference = sum(len(sp) for sp in reference)
+        self.assertLess(sum(len(sp) for sp in flattened), 1.2 * n_reference)
+
+    def test_straight_and_single_node_subpaths(self):
+        csp = axidraw.cubicsuperpath.parsePath('M 0 0 L 10 0 L 10 10 M 5 5 M 0 0 C 0 10 10 10 10 0')
+        flattened = copy.deepcopy(csp)
+        axidraw.plot_utils_np.subdivide_cubic_paths(flattened, 0.01)
+        self.assertEqual([node[1] for node in flattened[0]], [[0, 0], [10, 0], [10, 10]])
+        self.assertEqual(flattened[1], csp[1])
+        self.assertGreater(len(flattened[2]), 10)
+        self.assert_within_tolerance(csp[2], flattened[2], 0.01)
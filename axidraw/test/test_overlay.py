@@ -0,0 +1,53 @@
+import unittest
+
+from lxml import etree
+
+from pyaxidraw import axidraw
+
+from test_trajectory import load_geometry
+
+# python -m unittest discover -s test in top-level package dir
+
+def preview_layers(document):
+    return [node for node in document.getroot()
+            if node.get('{http://www.inkscape.org/namespaces/inkscape}label') == '% Preview']
+
+class OverlayTestCase(unittest.TestCase):
+
+    def preview(self, ad, reordering=0):
+        ad.options.preview = True
+        ad.options.rendering = 3
+        ad.options.reordering = reordering
+        ad.Secondary = True
+        return ad.plot_run(True)
+
+    def test_repeated_previews_keep_one_preview_layer(self):
+        ad = axidraw.AxiDraw()
+        ad.plot_setup(load_geometry('mustache.svg'))
+        first, _ = self.preview(ad)
+        second, _ = self.preview(ad)
+        self.assertEqual(first, second)
+        self.assertEqual(len(preview_layers(ad.document)), 1)
+
+    def test_discard_overlay_restores_source(self):
+        document = load_geometry('mustache.svg')
+        root = document.getroot()
+        etree.SubElement(root, 'WCB', layer='3', node='0', lastpath='0', lastpathnc='0',
+                         lastknownposx='0', lastknownposy='0', pausedposx='0', pausedposy='0')
+        source = etree.tostring(document)
+        ad = axidraw.AxiDraw()
+        ad.plot_setup(document)
+        for reordering in (0, 1, 0):
+            self.preview(ad, reordering)
+        self.assertNotEqual(etree.tostring(document), source)
+        ad.discard_overlay()
+        self.assertIs(ad.document, document)
+        self.assertEqual(etree.tostring(document), source)
+
+    def test_reordering_leaves_source_order(self):
+        ad = axidraw.AxiDraw()
+        ad.plot_setup(load_geometry('cat_uistperer.svg'))
+        ids = [node.get('id') for node in ad.document.iter()]
+        self.preview(ad, reordering=2)
+        ad.discard_overlay()
+        self.assertEqual([node.get('id') for node in ad.document.iter()], ids)
@@ -0,0 +1,44 @@
+import contextlib
+import io
+import pathlib
+import unittest
+
+from lxml import etree
+
+from pyaxidraw import axidraw
+
+from test_trajectory import GEOMETRIES_DIR, load_geometry
+
+# python -m unittest discover -s test in top-level package dir
+
+class PlotSetupTestCase(unittest.TestCase):
+
+    def setup_document(self, svg_input):
+        ad = axidraw.AxiDraw()
+        ad.plot_setup(svg_input)
+        return etree.tostring(ad.document)
+
+    def test_markup_inputs_parse_alike(self):
+        markup = etree.tostring(load_geometry('box.svg'), encoding='unicode')
+        expected = self.setup_document(markup)
+        self.assertEqual(self.setup_document(markup.encode('utf-8')), expected)
+        self.assertEqual(self.setup_document(bytearray(markup.encode('utf-8'))), expected)
+        self.assertEqual(self.setup_document(etree.fromstring(markup)), expected)
+
+    def test_path_like_input_is_opened(self):
+        path = pathlib.Path(GEOMETRIES_DIR) / 'box.svg'
+        self.assertEqual(self.setup_document(path), self.setup_document(str(path)))
+
+    def test_bytes_honor_xml_declaration(self):
+        markup = ('<?xml version="1.0" encoding="ISO-8859-1"?>'
+                  '<svg xmlns="http://www.w3.org/2000/svg" width="10mm" height="10mm">'
+                  '<title>café</title></svg>')
+        document = self.setup_document(markup.encode('iso-8859-1'))
+        self.assertIn('café'.encode('ascii', 'xmlcharrefreplace'), document)
+
+    def test_malformed_bytes_are_rejected(self):
+        ad = axidraw.AxiDraw()
+        stderr = io.StringIO()
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(stderr):
+            ad.plot_setup(b'<svg')
+        self.assertIn('Unable to parse SVG input.', stderr.getvalue())
@@ -0,0 +1,100 @@
+import math
+import random
+import unittest
+
+from lxml import etree
+
+from pyaxidraw import axidraw_svg_reorder, plot_utils
+
+# python -m unittest discover -s test in top-level package dir
+
+def random_lines_svg(n, seed=1):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n):
+        x, y = rng.uniform(0, 1000), rng.uniform(0, 700)
+        paths.append('<path id="p{0}" d="M {1:.2f} {2:.2f} L {3:.2f} {4:.2f}"/>'.format(
+            i, x, y, x + rng.uniform(-20, 20), y + rng.uniform(-20, 20)))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="280mm" height="196mm"'
+            ' viewBox="0 0 1000 700">' + ''.join(paths) + '</svg>')
+
+def reorder(svg, **attributes):
+    asr = axidraw_svg_reorder.ReorderEffect()
+    asr.getoptions([])
+    asr.options.reordering = 1
+    for name, value in attributes.items():
+        setattr(asr, name, value)
+    asr.document = etree.ElementTree(etree.fromstring(svg))
+    asr.effect()
+    return asr
+
+class ReorderTestCase(unittest.TestCase):
+
+    def test_keeps_every_element(self):
+        asr = reorder(random_lines_svg(300))
+        ids = [node.get('id') for node in asr.document.getroot()]
+        self.assertEqual(sorted(ids), sorted('p{0}'.format(i) for i in range(300)))
+
+    def test_reduces_pen_up_travel(self):
+        asr = reorder(random_lines_svg(300))
+        self.assertLess(asr.air_total_sorted, asr.air_total_default / 5)
+
+    def test_reverses_paths_to_shorten_travel(self):
+        svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="10in" height="10in" viewBox="0 0 10 10">'
+               '<path id="a" d="M 0 0 L 5 0"/><path id="b" d="M 9 1 L 5 1"/></svg>')
+        asr = reorder(svg)
+        d = asr.document.getroot()[1].get('d')
+        self.assertEqual(plot_utils.pathdata_first_point(d), [5.0, 1.0])
+        self.assertEqual(plot_utils.pathdata_last_point(d), [9.0, 1.0])
+        self.assertAlmostEqual(asr.air_total_sorted, 1.0)
+
+        asr = reorder(svg, allow_reverse=False)
+        self.assertEqual(asr.document.getroot()[1].get('d'), 'M 9 1 L 5 1')
+        self.assertAlmostEqual(asr.air_total_sorted, math.hypot(4, 1))
+
+    def test_reverse_keeps_segment_types(self):
+        svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="10in" height="10in" viewBox="0 0 10 10">'
+               '<path id="a" d="M 0 0 L 5 0"/>'
+               '<path id="b" d="M 9 3 Q 7 2 6 1 C 6 2 5 2 5 1"/></svg>')
+        asr = reorder(svg)
+        self.assertEqual(asr.document.getroot()[1].get('d'),
+                         'M5.0 1.0C5.0 2.0 6.0 2.0 6.0 1.0Q7.0 2.0 9.0 3.0')
+
+    def test_closed_and_arc_paths_are_not_reversed(self):
+        closed = 'M 9 1 L 5 1 L 5 2 Z'
+        arc = 'M 9 3 A 2 2 0 0 1 5 3'
+        svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="10in" height="10in" viewBox="0 0 10 10">'
+               '<path id="a" d="M 0 0 L 5 0"/><path id="b" d="' + closed + '"/>'
+               '<path id="c" d="' + arc + '"/></svg>')
+        asr = reorder(svg)
+        paths = {node.get('id'): node.get('d') for node in asr.document.getroot()}
+        self.assertEqual(paths['b'], closed)
+        self.assertEqual(paths['c'], arc)
+
+    def test_non_plottable_elements_keep_their_position(self):
+        svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="10in" height="10in" viewBox="0 0 10 10">'
+               '<path id="a" d="M 9 9 L 8 8"/><path id="hidden" style="display:none" d="M 1 1 L 2 2"/>'
+               '<path id="b" d="M 5 5 L 4 4"/><path id="c" d="M 0 0 L 1 1"/></svg>')
+        asr = reorder(svg)
+        ids = [node.get('id') for node in asr.document.getroot()]
+        self.assertEqual(ids, ['c', 'hidden', 'b', 'a'])
+
+    def test_improvement_pass_does_not_lengthen_travel(self):
+        greedy = reorder(random_lines_svg(300))
+        improved = reorder(random_lines_svg(300), improve_time=0.5)
+        self.assertLessEqual(improved.air_total_sorted, greedy.air_total_sorted + 1e-9)
+
+    def test_nearest_endpoint(self):
+        rng = random.Random(2)
+        points = [(rng.uniform(-5, 5), rng.uniform(0, 1), i) for i in range(500)]
+        grid = axidraw_svg_reorder.EndpointGrid(points)
+        for _ in range(100):
+            x, y = rng.uniform(-8, 8), rng.uniform(-3, 4)
+            key = grid.nearest(x, y)
+            expected = min(points, key=lambda p: (p[0] - x) ** 2 + (p[1] - y) ** 2)
+            self.assertEqual(key, expected[2])
+        for _, _, key in points[:450]:
+            grid.remove(key)
+        self.assertEqual(grid.count, 50)
+        expected = min(points[450:], key=lambda p: p[0] ** 2 + p[1] ** 2)
+        self.assertEqual(grid.nearest(0, 0), expected[2])
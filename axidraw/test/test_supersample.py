@@ -0,0 +1,59 @@
+import copy
+import random
+import unittest
+from unittest import mock
+
+from pyaxidraw import axidraw
+
+from test_trajectory import load_geometry
+
+# python -m unittest discover -s test in top-level package dir
+
+def collect_polylines(filename):
+    """
+    Plots FILENAME in preview mode with the reference simplifier, and
+    returns copies of the polylines it was given.
+    """
+    polylines = []
+    reference = axidraw.plot_utils.supersample
+
+    def record(vertices, tolerance):
+        polylines.append(copy.deepcopy(vertices))
+        return reference(vertices, tolerance)
+
+    ad = axidraw.AxiDraw()
+    ad.plot_setup(load_geometry(filename))
+    ad.options.preview = True
+    ad.Secondary = True
+    with mock.patch.object(axidraw, 'plot_utils_np', None), \
+            mock.patch.object(axidraw.plot_utils, 'supersample', record):
+        ad.plot_run()
+    return polylines
+
+@unittest.skipIf(axidraw.plot_utils_np is None, 'NumPy is not installed')
+class SupersampleTestCase(unittest.TestCase):
+
+    def assert_same_vertices(self, polyline, tolerance):
+        expected = copy.deepcopy(polyline)
+        axidraw.plot_utils.supersample(expected, tolerance)
+        actual = copy.deepcopy(polyline)
+        axidraw.plot_utils_np.supersample(actual, tolerance)
+        self.assertEqual(expected, actual)
+
+    def test_matches_reference_on_geometries(self):
+        for filename in ('streamlines.svg', 'gel_wave.svg'):
+            with self.subTest(geometry=filename):
+                polylines = collect_polylines(filename)
+                self.assertTrue(polylines)
+                for polyline in polylines:
+                    self.assert_same_vertices(polyline, axidraw.axidraw_conf.segment_supersample_tolerance)
+
+    def test_matches_reference_on_noisy_lines(self):
+        rng = random.Random(3)
+        for tolerance in (0.001, 0.01, 0.1):
+            for _ in range(20):
+                n = rng.randint(0, 300)
+                polyline = [[i * 0.01, rng.gauss(0, 0.01)] for i in range(n)]
+                # Include repeated vertices and reversals
+                polyline += [list(v) for v in reversed(polyline[-rng.randint(0, n + 1):])]
+                self.assert_same_vertices(polyline, tolerance)
@@ -0,0 +1,66 @@
+import os
+import unittest
+
+from lxml import etree
+
+from pyaxidraw import axidraw
+
+# python -m unittest discover -s test in top-level package dir
+
+GEOMETRIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', '..', 'geometries')
+
+class ComparingAxiDraw(axidraw.AxiDraw):
+    """
+    Runs both trajectory planners on every path that is planned during a
+    plot and records the pairs of results.
+    """
+    def plan_trajectory(self, input_path):
+        self.compared_segments.append((
+            self.plan_trajectory_segments(input_path),
+            self.plan_trajectory_segments_np(input_path)))
+        axidraw.AxiDraw.plan_trajectory(self, input_path)
+
+def load_geometry(filename):
+    svg = etree.parse(os.path.join(GEOMETRIES_DIR, filename)).getroot()
+    # Geometries are stored without page sizes; the client wraps them in
+    # a page the size of the work envelope before sending them to be plotted.
+    if svg.get('width') is None or svg.get('height') is None:
+        svg.set('width', '280mm')
+        svg.set('height', '180mm')
+    return etree.ElementTree(svg)
+
+@unittest.skipIf(axidraw.plot_utils_np is None, 'NumPy is not installed')
+class TrajectoryTestCase(unittest.TestCase):
+
+    def assert_segments_match(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for exp_seg, act_seg in zip(expected, actual):
+            self.assertAlmostEqual(exp_seg[0], act_seg[0], places=9)
+            self.assertAlmostEqual(exp_seg[1], act_seg[1], places=9)
+            for exp_v, act_v in zip(exp_seg[2:], act_seg[2:]):
+                self.assertAlmostEqual(exp_v, act_v, delta=1e-4 * max(1.0, exp_v))
+
+    def test_matches_reference_planner_on_geometries(self):
+        filenames = sorted(f for f in os.listdir(GEOMETRIES_DIR) if f.endswith('.svg'))
+        self.assertTrue(filenames)
+        for filename in filenames:
+            with self.subTest(geometry=filename):
+                ad = ComparingAxiDraw()
+                ad.compared_segments = []
+                ad.plot_setup(load_geometry(filename))
+                ad.options.preview = True
+                ad.Secondary = True  # Keep plot reports out of the test output
+                ad.plot_run()
+                for expected, actual in ad.compared_segments:
+                    self.assert_segments_match(expected, actual)
+
+    def test_skips_near_zero_segments(self):
+        ad = axidraw.AxiDraw()
+        ad.plot_setup()
+        ad.update_options()
+        ad.pen_up = False
+        path = [[0.0, 0.0], [1.0, 0.0], [1.0, 0.0001], [1.0, 0.0002],
+                [1.0, 1.0], [0.5, 1.5], [0.0, 0.0]]
+        self.assert_segments_match(ad.plan_trajectory_segments(path),
+                                   ad.plan_trajectory_segments_np(path))
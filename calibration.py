@@ -0,0 +1,158 @@
+import os
+import pickle
+import threading
+import numpy as np
+
+# Shared by cp_interpreter and scripts/pair.py, which run from different
+# working directories, so anchored at the top-level dir.
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CALIBRATION_PATH = os.path.join(ROOT_DIR, 'volatile', 'calibration.npy')
+# Pickles written by earlier versions, imported once into the store
+LEGACY_HOMOGRAPHY_PATH = os.path.join(ROOT_DIR, 'volatile', 'homography.pckl')
+LEGACY_ENVELOPE_SETTINGS_PATH = os.path.join(ROOT_DIR, 'scripts',\
+                                             'envelope_settings.pckl')
+
+# One record per camera/projector rig. Fields that have not been
+# calibrated are left as zeros, so e.g. rig['homography'].any() tells
+# whether a homography is available. Envelope sizes are in cm, projector
+# and camera image sizes in pixels as (height, width).
+CALIBRATION_DTYPE = np.dtype([
+    ('name', 'U32'),
+    ('revision', '<i4'),
+    ('homography', '<f8', (3, 3)),
+    ('envelope_hw', '<f8', (2,)),
+    ('projector_hw', '<i4', (2,)),
+    ('camera_hw', '<i4', (2,)),
+    ('camera_matrix', '<f8', (3, 3)),
+    ('dist_coeffs', '<f8', (5,)),
+])
+
+class CalibrationStore:
+    """
+    Calibration data for named camera/projector rigs, kept in a single
+    .npy file holding a structured array of CALIBRATION_DTYPE records plus
+    a leading format-version record. Nothing is read until a rig is first
+    asked for, and the file is then memory-mapped rather than loaded, so
+    opening a store costs nothing at startup.
+
+    Each save rewrites the file atomically and bumps the rig's revision.
+
+    If the file does not exist yet, a homography in the legacy pickles at
+    LEGACY_HOMOGRAPHY_PATH or LEGACY_ENVELOPE_SETTINGS_PATH is imported
+    into the 'default' rig and written out on first use.
+    """
+    FORMAT_VERSION = 1
+    VERSION_RECORD_NAME = '#version'
+
+    def __init__(self, path=CALIBRATION_PATH,\
+                 legacy_homography_path=LEGACY_HOMOGRAPHY_PATH,\
+                 legacy_envelope_settings_path=LEGACY_ENVELOPE_SETTINGS_PATH):
+        self.path = path
+        self.legacy_homography_path = legacy_homography_path
+        self.legacy_envelope_settings_path = legacy_envelope_settings_path
+        self.records = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _load_legacy_homography(path, index=None):
+        # Returns the 3x3 homography pickled at PATH, or None
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            if index is not None:
+                value = value[index]
+            h = np.array(value, dtype=np.float64)
+        except (OSError, EOFError, IndexError, TypeError, ValueError,\
+                pickle.UnpicklingError):
+            return None
+        return h if h.shape == (3, 3) else None
+
+    def _migrate(self):
+        # homography.pckl holds (homography, dimensions); the envelope
+        # settings pickle holds the homography alone.
+        h = CalibrationStore._load_legacy_homography(\
+                self.legacy_homography_path, 0)
+        if h is None:
+            h = CalibrationStore._load_legacy_homography(\
+                    self.legacy_envelope_settings_path)
+        records = np.zeros(0, CALIBRATION_DTYPE)
+        if h is None:
+            return records
+        records = np.zeros(1, CALIBRATION_DTYPE)
+        records[0]['name'] = 'default'
+        records[0]['revision'] = 1
+        records[0]['homography'] = h
+        self._write(records)
+        return records
+
+    def _write(self, records):
+        version = np.zeros(1, CALIBRATION_DTYPE)
+        version['name'] = CalibrationStore.VERSION_RECORD_NAME
+        version['revision'] = CalibrationStore.FORMAT_VERSION
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.concatenate((version, records)))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _load(self):
+        if self.records is not None:
+            return self.records
+        if not os.path.exists(self.path):
+            self.records = self._migrate()
+            return self.records
+        records = np.load(self.path, mmap_mode='r')
+        if records.dtype != CALIBRATION_DTYPE or len(records) == 0 \
+                or records[0]['name'] != CalibrationStore.VERSION_RECORD_NAME \
+                or records[0]['revision'] != CalibrationStore.FORMAT_VERSION:
+            raise ValueError(f'Unsupported calibration file format: {self.path}')
+        self.records = records[1:]
+        return self.records
+
+    @property
+    def rig_names(self):
+        with self.lock:
+            return [str(name) for name in self._load()['name']]
+
+    def get(self, rig='default'):
+        """
+        Returns the calibration record for RIG, or None if it has never
+        been saved. Fields are indexed by name, e.g. rig['homography'].
+        """
+        with self.lock:
+            records = self._load()
+            matches = np.flatnonzero(records['name'] == rig)
+            if len(matches) == 0:
+                return None
+            return records[matches[0]]
+
+    def save(self, rig='default', **fields):
+        """
+        Sets the given fields of RIG, creating it if needed, and writes the
+        store back to disk. Returns the updated record.
+        """
+        with self.lock:
+            records = np.array(self._load())
+            matches = np.flatnonzero(records['name'] == rig)
+            if len(matches) == 0:
+                record = np.zeros(1, CALIBRATION_DTYPE)
+                record['name'] = rig
+                records = np.concatenate((records, record))
+                idx = len(records) - 1
+            else:
+                idx = matches[0]
+            for name, value in fields.items():
+                records[idx][name] = value
+            records[idx]['revision'] += 1
+            self._write(records)
+            self.records = None
+            return records[idx].copy()
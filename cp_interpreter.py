@@ -3,11 +3,525 @@ from PIL import Image
 import numpy as np
 from pyaxidraw import axidraw
 from machine import Machine
+from calibration import CalibrationStore, CALIBRATION_PATH
+from scripts.camera import WorkEnvTracker, calc_work_env_homog,\
+                           calc_undistort_maps
+import os
 import sys
-import pickle
+import json
+import queue
+import tempfile
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+FACE_CASCADE_PATH = 'haarcascade_frontalface_default.xml'
+
+def load_face_cascade(path=FACE_CASCADE_PATH):
+    face_cascade = cv2.CascadeClassifier(path)
+    if face_cascade.empty():
+        raise IOError(f'Could not load face classifier from {path}.')
+    # The first detection pays for setting up the classifier's internal
+    # buffers, so run one now rather than on the first real request.
+    face_cascade.detectMultiScale(np.zeros((64, 64), np.uint8))
+    return face_cascade
+
+def detect_faces(face_cascade, img, prepass_width=None):
+    """
+    Returns face bounding boxes in IMG as an N x 4 array of (x, y, width,
+    height). If PREPASS_WIDTH is given and IMG is wider, candidates are
+    first found in a copy downscaled to that width, and the full-resolution
+    search is confined to a region around each candidate.
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img_h, img_w = gray.shape
+    if prepass_width is None or img_w <= prepass_width:
+        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+        return np.array(faces, dtype=np.int32).reshape(-1, 4)
+    scale = img_w / prepass_width
+    small = cv2.resize(gray, (prepass_width, round(img_h / scale)),\
+                       interpolation=cv2.INTER_AREA)
+    # Fewer neighbors here, since candidates are confirmed below.
+    candidates = face_cascade.detectMultiScale(small, 1.1, 3)
+    faces = []
+    for (x, y, w, h) in candidates:
+        margin = 0.25 * max(w, h)
+        x0 = max(int((x - margin) * scale), 0)
+        y0 = max(int((y - margin) * scale), 0)
+        x1 = min(int((x + w + margin) * scale), img_w)
+        y1 = min(int((y + h + margin) * scale), img_h)
+        min_side = int(0.7 * min(w, h) * scale)
+        max_side = int(1.4 * max(w, h) * scale)
+        found = face_cascade.detectMultiScale(gray[y0:y1, x0:x1], 1.1, 4,\
+                    minSize=(min_side, min_side), maxSize=(max_side, max_side))
+        for (fx, fy, fw, fh) in found:
+            center_x, center_y = x0 + fx + fw / 2, y0 + fy + fh / 2
+            # Regions around nearby candidates overlap, so skip faces
+            # already found from another candidate.
+            if not any(ox <= center_x <= ox + ow and oy <= center_y <= oy + oh\
+                       for (ox, oy, ow, oh) in faces):
+                faces.append((x0 + fx, y0 + fy, fw, fh))
+    return np.array(faces, dtype=np.int32).reshape(-1, 4)
+
+# Each worker process in a face detection pool loads its own classifier.
+_worker_face_cascade = None
+
+def _init_face_worker(path):
+    global _worker_face_cascade
+    _worker_face_cascade = load_face_cascade(path)
+
+def _detect_faces_in_worker(img, prepass_width):
+    return detect_faces(_worker_face_cascade, img, prepass_width)
+
+class FrameGrabber:
+    """
+    Pulls frames from a cv2.VideoCapture on a background thread so that
+    readers get the newest frame immediately instead of a stale one left in
+    the driver's buffer. The last DEPTH frames are kept, newest last, as
+    (sequence number, timestamp, frame) tuples.
+
+    The capture is drained as fast as the camera delivers, but frames are
+    only decoded and buffered at up to FPS per second (every frame if FPS
+    is None). A frame that leaves the buffer without having been read
+    counts as dropped.
+    """
+    def __init__(self, video_capture, fps=None, depth=4):
+        self.video_capture = video_capture
+        self.fps = fps
+        self.frames = deque(maxlen=depth)
+        self.condition = threading.Condition()
+        self.last_read_seq = 0
+        self.frames_captured = 0
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+        self.read_failures = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        next_due = 0
+        while self.running:
+            if not self.video_capture.grab():
+                with self.condition:
+                    self.read_failures += 1
+                time.sleep(0.01)
+                continue
+            now = time.time()
+            if self.fps and now < next_due:
+                with self.condition:
+                    self.frames_skipped += 1
+                continue
+            ret, frame = self.video_capture.retrieve()
+            if not ret:
+                with self.condition:
+                    self.read_failures += 1
+                continue
+            if self.fps:
+                next_due = max(next_due + 1.0 / self.fps, now)
+            with self.condition:
+                self.frames_captured += 1
+                if len(self.frames) == self.frames.maxlen \
+                        and self.frames[0][0] > self.last_read_seq:
+                    self.frames_dropped += 1
+                self.frames.append((self.frames_captured, now, frame))
+                self.condition.notify_all()
+
+    def latest(self, newer_than=0, timeout=1.0):
+        """
+        Returns the newest (sequence number, timestamp, frame), waiting up to
+        TIMEOUT seconds for one with a sequence number above NEWER_THAN.
+        Raises RuntimeError if no such frame arrives in time.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.frames or self.frames[-1][0] <= newer_than:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.running:
+                    raise RuntimeError('No frame received from the camera.')
+                self.condition.wait(remaining)
+            entry = self.frames[-1]
+            self.last_read_seq = max(self.last_read_seq, entry[0])
+            return entry
+
+    @property
+    def stats(self):
+        with self.condition:
+            return {
+                'captured': self.frames_captured,
+                'skipped': self.frames_skipped,
+                'dropped': self.frames_dropped,
+                'read_failures': self.read_failures,
+                'buffered': len(self.frames),
+                'depth': self.frames.maxlen,
+                'fps': self.fps,
+            }
+
+class WarpCache:
+    """
+    Applies perspective warps with cv2.remap, using fixed-point remap tables
+    that are computed once for each homography and output size and kept
+    for the most recent MAX_ENTRIES of them. The result matches
+    cv2.warpPerspective(img, h, dsize) with linear interpolation.
+
+    Given camera intrinsics, the same tables also correct lens distortion
+    before the homography is applied, so that costs no extra pass.
+    """
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_maps(h, dsize, camera_matrix=None, dist_coeffs=None):
+        if camera_matrix is not None:
+            return calc_undistort_maps(camera_matrix, dist_coeffs, dsize, h)
+        # warpPerspective samples the source at inv(h) * (x, y, 1) for each
+        # output pixel (x, y).
+        w, h_px = dsize
+        h_inv = np.linalg.inv(h)
+        xs, ys = np.meshgrid(np.arange(w, dtype=np.float64),\
+                             np.arange(h_px, dtype=np.float64))
+        src = np.dstack((xs, ys, np.ones_like(xs))) @ h_inv.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            map_x = src[..., 0] / src[..., 2]
+            map_y = src[..., 1] / src[..., 2]
+        # Points that map to infinity fall outside the source image.
+        bad = ~(np.isfinite(map_x) & np.isfinite(map_y))
+        map_x[bad] = -1
+        map_y[bad] = -1
+        return cv2.convertMaps(map_x.astype(np.float32),\
+                               map_y.astype(np.float32), cv2.CV_16SC2)
+
+    def maps(self, h, dsize, camera_matrix=None, dist_coeffs=None):
+        key = (np.asarray(h, dtype=np.float64).tobytes(), tuple(dsize))
+        if camera_matrix is not None:
+            key += (np.asarray(camera_matrix, dtype=np.float64).tobytes(),\
+                    np.asarray(dist_coeffs, dtype=np.float64).tobytes())
+        with self.lock:
+            maps = self.entries.get(key)
+            if maps is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return maps
+            self.misses += 1
+        maps = WarpCache.make_maps(h, dsize, camera_matrix, dist_coeffs)
+        with self.lock:
+            self.entries[key] = maps
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return maps
+
+    def warp(self, img, h, dsize, camera_matrix=None, dist_coeffs=None):
+        map1, map2 = self.maps(h, dsize, camera_matrix, dist_coeffs)
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+class ContourPipeline:
+    """
+    Finds the work envelope and candidate contours in camera frames,
+    keeping the image buffers of each stage between frames.
+
+    The work envelope is followed from frame to frame by a WorkEnvTracker,
+    which runs first. Edge and contour detection over the whole frame runs
+    only when the tracker loses the envelope, or when the view inside the
+    envelope changes. Otherwise the previous candidate contours, which are
+    in envelope coordinates, are reused with the newly tracked envelope.
+
+    A frame whose thumbnail, shrunk THUMB_SCALE times, has no pixel more
+    than CHANGE_THRESHOLD gray levels from the last processed one skips the
+    tracker too. The view inside the envelope is compared at full size
+    after warping it upright, and changes only where a pixel falls more
+    than CHANGE_THRESHOLD outside the range of its 3x3 neighbourhood in the
+    last view, which absorbs sub-pixel tracking error but not a shift of a
+    few pixels.
+
+    timings holds the seconds spent in each stage for the last frame that
+    was not skipped.
+    """
+    THUMB_SCALE = 4
+    DECIMATE_MAX_DIST = 100
+
+    def __init__(self, min_contour_len=100, change_threshold=12):
+        self.min_contour_len = min_contour_len
+        self.change_threshold = change_threshold
+        self.gray = None
+        self.blurred = None
+        self.edges = None
+        self.work_env_tracker = WorkEnvTracker()
+        self.thumb = None
+        self.last_thumb = None
+        self.env_view = None
+        self.last_env_view = None
+        self.env_low = None
+        self.env_high = None
+        self.last_key = None
+        self.result = None
+        self.timings = {}
+        self.frames_processed = 0
+        self.frames_skipped = 0
+        self.contours_reused = 0
+
+    def _allocate(self, img):
+        img_h, img_w = img.shape[:2]
+        if self.gray is None or self.gray.shape != (img_h, img_w):
+            scale = ContourPipeline.THUMB_SCALE
+            self.gray = np.empty((img_h, img_w), np.uint8)
+            self.blurred = np.empty((img_h, img_w), np.uint8)
+            self.edges = np.empty((img_h, img_w), np.uint8)
+            self.thumb = np.empty((img_h // scale, img_w // scale), np.uint8)
+            self.last_thumb = None
+            self.last_env_view = None
+
+    def _frame_changed(self):
+        # Area averaging is much faster over a whole number of source
+        # pixels per thumbnail pixel, so drop the remainder at the edges.
+        thumb_h, thumb_w = self.thumb.shape
+        scale = ContourPipeline.THUMB_SCALE
+        cropped = self.gray[:thumb_h * scale, :thumb_w * scale]
+        cv2.resize(cropped, (thumb_w, thumb_h), dst=self.thumb,\
+                   interpolation=cv2.INTER_AREA)
+        if self.last_thumb is not None and cv2.absdiff(self.thumb,\
+                self.last_thumb).max() <= self.change_threshold:
+            return False
+        self.last_thumb = self.thumb.copy()
+        return True
+
+    def _envelope_changed(self, work_env_homog, envelope_hw_px):
+        env_h, env_w = envelope_hw_px
+        if self.env_view is None or self.env_view.shape != (env_h, env_w):
+            self.env_view = np.empty((env_h, env_w), np.uint8)
+            self.env_low = np.empty((env_h, env_w), np.uint8)
+            self.env_high = np.empty((env_h, env_w), np.uint8)
+            self.last_env_view = None
+        cv2.warpPerspective(self.gray, work_env_homog, (env_w, env_h),\
+                            dst=self.env_view, flags=cv2.INTER_LINEAR,\
+                            borderMode=cv2.BORDER_REPLICATE)
+        if self.last_env_view is None:
+            return True
+        cv2.erode(self.last_env_view, None, dst=self.env_low)
+        cv2.dilate(self.last_env_view, None, dst=self.env_high)
+        # Saturating subtraction leaves only the amount outside the range
+        return cv2.subtract(self.env_view, self.env_high).max() \
+                > self.change_threshold \
+            or cv2.subtract(self.env_low, self.env_view).max() \
+                > self.change_threshold
+
+    @staticmethod
+    def _closed_lengths(points, starts, counts):
+        # Arc length of each closed contour in a concatenated point array
+        following = np.arange(1, len(points) + 1)
+        following[starts + counts - 1] = starts
+        steps = points[following] - points
+        return np.add.reduceat(np.hypot(steps[:, 0], steps[:, 1]), starts)
+
+    def run(self, img, envelope_hw_px):
+        """
+        Returns (contours in envelope coordinates, work envelope contour in
+        image coordinates) for the BGR image IMG. Raises ValueError if no
+        work envelope is found.
+        """
+        self._allocate(img)
+        timings = {}
+        t = time.perf_counter()
+        def lap(stage):
+            nonlocal t
+            now = time.perf_counter()
+            timings[stage] = now - t
+            t = now
+
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        lap('gray')
+        key = tuple(envelope_hw_px)
+        if not self._frame_changed() and key == self.last_key \
+                and self.result is not None:
+            self.frames_skipped += 1
+            return self.result
+        lap('compare')
+
+        decimated = None
+        def detect():
+            nonlocal decimated
+            if decimated is None:
+                cv2.GaussianBlur(self.gray, (11, 11), 1, dst=self.blurred,\
+                                 sigmaY=1)
+                lap('blur')
+                cv2.Canny(self.blurred, 50, 80, edges=self.edges)
+                lap('edges')
+                contours = cv2.findContours(self.edges, cv2.RETR_TREE,\
+                                            cv2.CHAIN_APPROX_SIMPLE)[-2]
+                lap('contours')
+                decimated = [cv2.approxPolyDP(c,\
+                                 ContourPipeline.DECIMATE_MAX_DIST, True)\
+                             for c in contours]
+                lap('decimate')
+            return decimated
+
+        work_env_contour = self.work_env_tracker.update(self.gray, detect)
+        work_env_homog = calc_work_env_homog(img, work_env_contour,\
+                                             envelope_hw_px)
+        lap('envelope')
+        env_changed = self._envelope_changed(work_env_homog, envelope_hw_px)
+        lap('compare_envelope')
+        self.timings = timings
+        self.frames_processed += 1
+        if decimated is None and not env_changed and key == self.last_key:
+            self.contours_reused += 1
+            self.result = (self.result[0], work_env_contour)
+            return self.result
+
+        detect()
+        trans_contours = []
+        if decimated:
+            counts = np.array([len(c) for c in decimated])
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            points = np.concatenate(decimated).reshape(-1, 2)\
+                       .astype(np.float32)
+            keep = ContourPipeline._closed_lengths(points, starts, counts)\
+                    > self.min_contour_len
+            lap('cull')
+            if keep.any():
+                kept = points[np.repeat(keep, counts)].reshape(-1, 1, 2)
+                trans = cv2.perspectiveTransform(kept, work_env_homog)\
+                          .astype(np.int32)
+                trans_contours = np.split(trans, np.cumsum(counts[keep])[:-1])
+        lap('transform')
+        self.last_env_view = self.env_view.copy()
+        self.last_key = key
+        self.result = (trans_contours, work_env_contour)
+        return self.result
+
+    @property
+    def stats(self):
+        return {
+            'processed': self.frames_processed,
+            'skipped': self.frames_skipped,
+            'contours_reused': self.contours_reused,
+            'envelope_tracked': self.work_env_tracker.frames_tracked,
+            'envelope_searches': self.work_env_tracker.full_searches,
+            'timings': self.timings,
+        }
+
+class PreviewStream:
+    """
+    A live JPEG stream of camera frames shared by any number of subscribers.
+    While anyone is subscribed, an encoder thread encodes the newest frame
+    at most MAX_FPS times a second, once however many subscribers there are.
+    Subscribers that fall behind skip to the newest frame.
+    """
+    def __init__(self, camera, max_fps=15, quality=80):
+        self.camera = camera
+        self.max_fps = max_fps
+        self.quality = quality
+        self.condition = threading.Condition()
+        self.subscribers = 0
+        self.generation = 0
+        self.seq = 0
+        self.jpeg = None
+        self.thread = None
+        self.thread_generation = None
+        self.frames_encoded = 0
+        self.encode_time = 0.0
+
+    def _encode(self, frame):
+        start = time.perf_counter()
+        _, buf = cv2.imencode('.jpg', frame,\
+                              [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        with self.condition:
+            self.seq += 1
+            self.jpeg = buf.tobytes()
+            self.frames_encoded += 1
+            self.encode_time += time.perf_counter() - start
+            self.condition.notify_all()
+
+    def _run(self, generation):
+        if self.camera.dry_mode:
+            # The static image never changes, so encode it once.
+            self._encode(self.camera.capture_video_frame())
+        frame_seq = 0
+        next_due = time.time()
+        while True:
+            with self.condition:
+                if self.subscribers == 0 or self.generation != generation:
+                    if self.thread is threading.current_thread():
+                        self.thread = None
+                    return
+            if self.camera.dry_mode:
+                with self.condition:
+                    self.condition.wait(0.5)
+                continue
+            time.sleep(max(0, next_due - time.time()))
+            next_due = max(next_due + 1.0 / self.max_fps, time.time())
+            try:
+                frame_seq, frame = self.camera._read_video_image(frame_seq)
+            except RuntimeError:
+                continue  # No new frame yet; check for subscribers again
+            self._encode(frame)
+
+    def subscribe(self):
+        """
+        Yields JPEG-encoded frames as bytes, newest first, until stop() is
+        called or the generator is closed.
+        """
+        with self.condition:
+            self.subscribers += 1
+            generation = self.generation
+            if self.thread is None or self.thread_generation != generation:
+                self.thread = threading.Thread(target=self._run,\
+                                               args=(generation,))
+                self.thread.daemon = True
+                self.thread_generation = generation
+                self.thread.start()
+        last_seq = 0  # Start with the newest frame already encoded, if any
+        try:
+            while True:
+                with self.condition:
+                    while self.seq <= last_seq \
+                            and self.generation == generation:
+                        self.condition.wait()
+                    if self.generation != generation:
+                        return
+                    last_seq = self.seq
+                    jpeg = self.jpeg
+                yield jpeg
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                self.condition.notify_all()
+
+    def stop(self):
+        # Ends all current subscriptions.
+        with self.condition:
+            self.generation += 1
+            self.seq = 0
+            self.jpeg = None
+            self.condition.notify_all()
+
+    @property
+    def stats(self):
+        with self.condition:
+            return {
+                'subscribers': self.subscribers,
+                'encoded': self.frames_encoded,
+                'encode_time': self.encode_time,
+                'max_fps': self.max_fps,
+            }
 
 class Camera:
-    def __init__(self, dry=False):
+    def __init__(self, dry=False, fps=None, buffer_depth=4, rig='default'):
         self.dry_mode = dry
         self.PROJ_SCREEN_SIZE_HW = (900, 1440)
         self.CM_TO_PX = 37.7952755906
@@ -17,11 +531,26 @@ class Camera:
         self.contours = []
         self.work_env_contour = None
         self.preview_open = False
-        self.fiducial_homography = np.zeros((3, 3))
+        self.calibration = CalibrationStore(CALIBRATION_PATH)
+        self.rig = rig
+        self._fiducial_homography = None
+        self.camera_matrix = None
+        self.dist_coeffs = None
+        self.warp_cache = WarpCache()
+        self.contour_pipeline = ContourPipeline(self.MIN_CONTOUR_LEN)
         self.most_recent_img = np.zeros(0);
+        self.face_cascade = None
+        self.face_pool = None
+        # Width of the downscaled image searched first for face candidates,
+        # or None to search the full-resolution image directly.
+        self.face_prepass_width = 480
+        self.frame_grabber = None
         if not self.dry_mode:
             # self.video_capture = self.find_video_capture()
             self.video_capture = cv2.VideoCapture(1);
+            self.frame_grabber = FrameGrabber(self.video_capture, fps,\
+                                              buffer_depth)
+            self.frame_grabber.start()
 
     def find_video_capture(self):
         for i in range(3):
@@ -30,23 +559,43 @@ class Camera:
                 return maybe_capture
         print('Could not find working camera for video capture.')
 
-    def load_fiducial_homography_from_file(self):
+    def load_calibration(self):
+        # Sets the fiducial homography and lens intrinsics for this rig
         try:
-            f = open('./volatile/homography.pckl', 'rb')
-            homog_with_dims = pickle.load(f)
-            homog = homog_with_dims[0]
-        except (IOError, OSError) as e:
+            calibration = self.calibration.get(self.rig)
+        except (IOError, OSError, ValueError) as e:
             print('Error trying to initialize fiducial homography for camera');
             print(e)
-            f.close()
-            homog = np.zeros()
-        finally:
-            f.close()
-            return homog
+            calibration = None
+        if calibration is None:
+            self._fiducial_homography = np.zeros((3, 3))
+            return
+        self._fiducial_homography = np.array(calibration['homography'])
+        if calibration['camera_matrix'].any():
+            self.camera_matrix = np.array(calibration['camera_matrix'])
+            self.dist_coeffs = np.array(calibration['dist_coeffs'])
+
+    @property
+    def fiducial_homography(self):
+        # Read from the calibration store on first use, not at startup
+        if self._fiducial_homography is None:
+            self.load_calibration()
+        return self._fiducial_homography
 
     def set_homography(self, h):
-        # TODO
-        pass
+        # With intrinsics set, H maps undistorted frames to the projector.
+        self._fiducial_homography = np.array(h, dtype=np.float64)
+        self.calibration.save(self.rig, homography=self._fiducial_homography)
+
+    def set_intrinsics(self, camera_matrix, dist_coeffs):
+        self.fiducial_homography  # Load the rest of the calibration first
+        self.camera_matrix = np.array(camera_matrix, dtype=np.float64)
+        # The store keeps the five-coefficient (k1, k2, p1, p2, k3) model.
+        coeffs = np.ravel(dist_coeffs)[:5]
+        self.dist_coeffs = np.zeros(5)
+        self.dist_coeffs[:len(coeffs)] = coeffs
+        self.calibration.save(self.rig, camera_matrix=self.camera_matrix,\
+                              dist_coeffs=self.dist_coeffs)
 
     def _process_image(self, img):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -58,20 +607,40 @@ class Camera:
     def _load_file_image(self):
         return cv2.imread(self.static_image_path)
 
-    def _read_video_image(self):
-        ret, frame = self.video_capture.read()
+    def _read_video_image(self, newer_than=0):
+        # Returns (sequence number, frame); see FrameGrabber.latest()
+        seq, _, frame = self.frame_grabber.latest(newer_than)
         proj_h = self.PROJ_SCREEN_SIZE_HW[0]
         proj_w = self.PROJ_SCREEN_SIZE_HW[1]
         if self.fiducial_homography.any():
         # if False:
-            frame = cv2.warpPerspective(frame, self.fiducial_homography, \
-                    (proj_w, proj_h))
-        return frame
+            frame = self.warp_cache.warp(frame, self.fiducial_homography, \
+                    (proj_w, proj_h), self.camera_matrix, self.dist_coeffs)
+        elif self.camera_matrix is not None:
+            frame = self.warp_cache.warp(frame, np.eye(3), \
+                    (frame.shape[1], frame.shape[0]), self.camera_matrix, \
+                    self.dist_coeffs)
+        return seq, frame
 
     def capture_video_frame(self):
         if self.dry_mode:
             return self._load_file_image()
-        return self._read_video_image()
+        return self._read_video_image()[1]
+
+    def release(self):
+        if self.frame_grabber is not None:
+            self.frame_grabber.stop()
+            self.video_capture.release()
+            self.frame_grabber = None
+        if self.face_pool is not None:
+            self.face_pool.shutdown()
+            self.face_pool = None
+
+    @property
+    def capture_stats(self):
+        if self.frame_grabber is None:
+            return {}
+        return self.frame_grabber.stats
 
     def open_static_image_preview(self):
         self.preview_open = True
@@ -80,10 +649,10 @@ class Camera:
 
     def open_video_preview(self):
         self.preview_open = True
-        cv2.imshow('preview', self._read_video_image())
+        cv2.imshow('preview', self._read_video_image()[1])
 
     def update_video_preview(self):
-        img = self._read_video_image()
+        img = self._read_video_image()[1]
         img_edge = self._process_image(img)
         # contours = calc_contours(img_edge)
         # try:
@@ -98,23 +667,11 @@ class Camera:
         cv2.destroyWindow('preview')
 
     def calc_candidate_contours(self, envelope_hw):
-        # img = self._read_video_image()
-        img = self._load_file_image()
-        img = self._process_image(img)
-        contours = calc_contours(img)
-        work_env_contour = find_work_env_in_contours(contours)
+        img = self.capture_video_frame()
         envelope_hw_px = (round(envelope_hw[0] * self.CM_TO_PX),\
                           round(envelope_hw[1] * self.CM_TO_PX))
-        # TODO: this works with img_orig but we shouldn't be using it
-        work_env_homog = calc_work_env_homog(self.static_image, work_env_contour,\
-                                             envelope_hw_px)
-        decimated_contours = decimate_contours(contours)
-        # Not sure whether/how closed=T/F matters here
-        min_length_lambda = lambda c: cv2.arcLength(c, closed=True)\
-                            > self.MIN_CONTOUR_LEN
-        culled_contours = list(filter(min_length_lambda, decimated_contours))
-        trans_contours = list(map(lambda c: transform_contour_with_h(c,\
-                                work_env_homog), culled_contours))
+        trans_contours, work_env_contour = \
+                self.contour_pipeline.run(img, envelope_hw_px)
         self.contours = trans_contours
         self.work_env_contour = work_env_contour
 
@@ -125,16 +682,49 @@ class Camera:
     def detect_face_boxes(self, display_on_preview=False):
         """
         Returns bounding boxes as 4-tuples of the form (x, y, width, height).
+        Detection runs on the most recent photo, read back from disk only if
+        none has been taken in this session.
         """
-        face_cascade = cv2.CascadeClassifier('haarcascade_frontalface_default.xml')
+        if self.face_cascade is None:
+            self.face_cascade = load_face_cascade()
         # TODO: generalize choice of image
-        img = cv2.imread(self.camera_image_path)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+        if self.most_recent_img.any():
+            img = self.most_recent_img
+        else:
+            img = cv2.imread(self.camera_image_path)
+        faces = detect_faces(self.face_cascade, img, self.face_prepass_width)
         if display_on_preview:
             self.draw_face_boxes_on_preview(faces)
         return faces
 
+    def detect_face_boxes_batch(self, imgs, max_workers=None):
+        """
+        Runs detect_face_boxes over several images at once in a pool of
+        worker processes, which is kept for later batches. Returns a list
+        with the boxes for each image.
+        """
+        if self.face_pool is None:
+            self.face_pool = ProcessPoolExecutor(max_workers=max_workers,\
+                    initializer=_init_face_worker,\
+                    initargs=(FACE_CASCADE_PATH,))
+        results = [self.face_pool.submit(_detect_faces_in_worker, img,\
+                                         self.face_prepass_width)\
+                   for img in imgs]
+        return [r.result() for r in results]
+
+    def recent_frames(self):
+        """
+        Returns the frames currently held in the capture buffer, oldest
+        first, or the static image in dry mode.
+        """
+        if self.frame_grabber is None:
+            return [self._load_file_image()]
+        with self.frame_grabber.condition:
+            entries = list(self.frame_grabber.frames)
+            if entries:
+                self.frame_grabber.last_read_seq = entries[-1][0]
+        return [frame for (_, _, frame) in entries]
+
     def draw_face_boxes_on_preview(self, faces):
         if not self.preview_open:
             self.open_static_image_preview()
@@ -146,6 +736,8 @@ class Camera:
         cv2.waitKey()
 
 class Interpreter(cmd.Cmd):
+    PHOTO_DIR = 'volatile'
+
     def __init__(self, use_prompt=False):
         cmd.Cmd.__init__(self)
         self.PROJ_SCREEN_SIZE_HW = (720, 1280)
@@ -159,9 +751,18 @@ class Interpreter(cmd.Cmd):
             Interpreter.prompt = ""
 
         self.camera = Camera(dry=True)
+        self.preview_stream = PreviewStream(self.camera)
         self.machine = Machine(dry=True)
 
-    def do_image(self, arg):
+        # RPCs may run concurrently on worker threads, so calls that share
+        # a device take the matching lock.
+        self.camera_lock = threading.Lock()
+        self.machine_lock = threading.Lock()
+
+    # RPC handlers: each takes the payload string and returns the response
+    # payload. The do_* commands below wrap them for interactive use.
+
+    def rpc_image(self, arg):
         if self.camera.dry_mode:
             self.camera.open_static_image_preview()
         else:
@@ -175,18 +776,27 @@ class Interpreter(cmd.Cmd):
                 self.camera.close_video_preview()
                 cv2.waitKey(1)
                 break
+        return ''
 
-    def do_detect_face_boxes(self, arg):
+    def rpc_detect_face_boxes(self, arg):
         def marshal_boxes_into_one_line(boxes):
             string_arrays = [np.array2string(box, separator=', ') for box in boxes]
             return '[' + ', '.join(string_arrays) + ']'
 
         show_on_preview = arg == 'True'
-        boxes = self.camera.detect_face_boxes(show_on_preview)
-        marshaled_boxes = marshal_boxes_into_one_line(boxes)
-        print(marshaled_boxes)
+        with self.camera_lock:
+            boxes = self.camera.detect_face_boxes(show_on_preview)
+        return marshal_boxes_into_one_line(boxes)
 
-    def do_choose_point(self, arg):
+    def rpc_detect_face_boxes_batch(self, arg):
+        # One line of boxes for each frame in the capture buffer
+        with self.camera_lock:
+            frames = self.camera.recent_frames()
+            boxes_per_frame = self.camera.detect_face_boxes_batch(frames)
+        return '\n'.join(np.array2string(boxes, separator=', ')\
+                         for boxes in boxes_per_frame)
+
+    def rpc_choose_point(self, arg):
         # TODO: determine x and y scaling factors based on the ratio
         # of the work envelope to the projection window
         COORD_SCALE = 3.77952755906
@@ -208,94 +818,311 @@ class Interpreter(cmd.Cmd):
                 cv2.waitKey(1)
                 scaled_x = click_xy[0] / COORD_SCALE
                 scaled_y = click_xy[1] / COORD_SCALE
-                print(f'{scaled_x},{scaled_y}')
-                break
+                return f'{scaled_x},{scaled_y}'
 
-    def do_draw_envelope(self, arg):
+    def rpc_draw_envelope(self, arg):
         # TODO: un-hardcode
         CM_TO_PX = 37.795275591;
         pt = (3 / CM_TO_PX, 3 / CM_TO_PX)
         width = 28
         height = 18
-        instr = self.machine.plot_rect_hw(pt, height, width)
-        print(instr)
+        with self.machine_lock:
+            return self.machine.plot_rect_hw(pt, height, width)
 
-    def do_generate_preview(self, arg):
-        svg_filepath = './volatile/drawing.svg'
-        preview_filepath = './volatile/plot_preview.svg'
+    def rpc_generate_preview(self, arg):
         svg_string = arg
-        f_drawing = open(svg_filepath, 'w')
-        f_drawing.write(svg_string)
-        f_drawing.close()
-        preview_string = self.machine.generate_preview_svg(svg_filepath)
-        f_preview = open(preview_filepath, 'w')
-        f_preview.write(preview_string)
-        f_preview.close()
-        print(preview_string)
+        return self.machine.generate_preview_svg(svg_string)
 
-    def do_generate_instructions(self, arg):
-        svg_filepath = './volatile/drawing.svg'
-        instructions_filepath = './volatile/plot_instructions.txt'
+    def rpc_generate_instructions(self, arg):
         svg_string = arg
-        f_drawing = open(svg_filepath, 'w')
-        f_drawing.write(svg_string)
-        f_drawing.close()
-        instruction_list = self.machine.generate_axidraw_instructions(svg_filepath)
-        f_instructions = open(instructions_filepath, 'w')
-        for instruction in instruction_list:
-            f_instructions.write(instruction + '\n')
-        f_instructions.close()
-        print(instruction_list)
+        instruction_list = self.machine.generate_axidraw_instructions(svg_string)
+        return json.dumps(instruction_list)
 
-    def do_draw_toolpath(self, arg):
-        svg_filepath = './volatile/drawing.svg'
+    def rpc_estimate_plot(self, arg):
         svg_string = arg
-        f = open(svg_filepath, 'w')
-        f.write(svg_string)
-        f.close()
-        self.machine.plot_svg(svg_filepath)
+        return json.dumps(self.machine.estimate_plot(svg_string))
 
-    def do_take_photo(self, arg):
-        try:
+    def rpc_plan_cache_stats(self, arg):
+        return json.dumps(self.machine.plan_cache.stats)
+
+    def rpc_camera_stats(self, arg):
+        return json.dumps({
+            'capture': self.camera.capture_stats,
+            'contour_pipeline': self.camera.contour_pipeline.stats,
+            'preview_stream': self.preview_stream.stats,
+        })
+
+    # Streaming handlers: each takes the payload string and yields the
+    # payloads of the frames sent back while the stream lasts.
+
+    def stream_preview_stream(self, arg):
+        return self.preview_stream.subscribe()
+
+    def rpc_stop_preview_stream(self, arg):
+        self.preview_stream.stop()
+        return ''
+
+    def rpc_draw_toolpath(self, arg):
+        svg_string = arg
+        with self.machine_lock:
+            return self.machine.plot_svg(svg_string)
+
+    def rpc_set_homography(self, arg):
+        # Format: 'c0,c1,...,c8', row-major
+        h = np.fromstring(arg, dtype='float', sep=',')
+        if h.shape != (9,):
+            raise ValueError('Expected 9 homography coefficients.')
+        with self.camera_lock:
+            self.camera.set_homography(h.reshape((3, 3)))
+        return ''
+
+    def rpc_set_intrinsics(self, arg):
+        # Format: the 9 camera matrix coefficients, row-major, followed by
+        # up to 5 distortion coefficients (k1, k2, p1, p2, k3)
+        coeffs = np.fromstring(arg, dtype='float', sep=',')
+        if not 9 < len(coeffs) <= 14:
+            raise ValueError('Expected 9 camera matrix coefficients and'\
+                             ' 1 to 5 distortion coefficients.')
+        with self.camera_lock:
+            self.camera.set_intrinsics(coeffs[:9].reshape((3, 3)), coeffs[9:])
+        return ''
+
+    def rpc_take_photo(self, arg):
+        with self.camera_lock:
             img = self.camera.capture_video_frame()
             h_flat = np.fromstring(arg, dtype='float', sep=',')
             h_shrink = h_flat.reshape((3, 3))
             h_expand = np.linalg.inv(h_shrink)
             img_height, img_width = img.shape[0], img.shape[1]
-            img_adjusted = cv2.warpPerspective(img, h_expand, (img_width, img_height))
+            img_adjusted = self.camera.warp_cache.warp(img, h_expand,\
+                                                       (img_width, img_height))
             self.camera.most_recent_img = img_adjusted
-            cv2.imwrite('volatile/camera-photo.jpg', img_adjusted)
-            print('Image written.')
+        return self._write_photo(img_adjusted, 'camera-photo-')
+
+    def rpc_warp_last_photo(self, arg):
+        with self.camera_lock:
+            if not self.camera.most_recent_img.any():
+                raise ValueError('No photo has been taken yet.')
+            img = self.camera.most_recent_img
+            h_flat = np.fromstring(arg, dtype='float', sep=',')
+            h_shrink = h_flat.reshape((3, 3))
+            h_expand = np.linalg.inv(h_shrink)
+            img_height, img_width = img.shape[0], img.shape[1]
+            img_warped = self.camera.warp_cache.warp(img, h_expand,\
+                                                     (img_width, img_height))
+        return self._write_photo(img_warped, 'camera-photo-warped-')
+
+    def _write_photo(self, img, prefix):
+        # Each request gets its own file, so concurrent requests cannot
+        # overwrite each other's photo. Returns the file's path; the caller
+        # deletes it once it has been sent.
+        os.makedirs(Interpreter.PHOTO_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=prefix, suffix='.jpg',\
+                                    dir=Interpreter.PHOTO_DIR)
+        os.close(fd)
+        if not cv2.imwrite(path, img):
+            os.remove(path)
+            raise IOError(f'Could not write {path}.')
+        return os.path.abspath(path)
+
+    # Interactive commands
+
+    def do_image(self, arg):
+        self.rpc_image(arg)
+
+    def do_detect_face_boxes(self, arg):
+        print(self.rpc_detect_face_boxes(arg))
+
+    def do_detect_face_boxes_batch(self, arg):
+        print(self.rpc_detect_face_boxes_batch(arg))
+
+    def do_choose_point(self, arg):
+        print(self.rpc_choose_point(arg))
+
+    def do_draw_envelope(self, arg):
+        print(self.rpc_draw_envelope(arg))
+
+    def do_generate_preview(self, arg):
+        print(self.rpc_generate_preview(arg))
+
+    def do_generate_instructions(self, arg):
+        print(self.rpc_generate_instructions(arg))
+
+    def do_estimate_plot(self, arg):
+        print(self.rpc_estimate_plot(arg))
+
+    def do_plan_cache_stats(self, arg):
+        print(self.rpc_plan_cache_stats(arg))
+
+    def do_camera_stats(self, arg):
+        print(self.rpc_camera_stats(arg))
+
+    def do_draw_toolpath(self, arg):
+        self.rpc_draw_toolpath(arg)
+
+    def do_set_homography(self, arg):
+        self.rpc_set_homography(arg)
+
+    def do_set_intrinsics(self, arg):
+        self.rpc_set_intrinsics(arg)
+
+    def do_take_photo(self, arg):
+        try:
+            print(f'Image written to {self.rpc_take_photo(arg)}')
         except Exception as e:
             print('Could not warp photo')
             print(e)
 
     def do_warp_last_photo(self, arg):
-        if self.camera.most_recent_img.any():
-            try:
-                img = self.camera.most_recent_img
-                h_flat = np.fromstring(arg, dtype='float', sep=',')
-                h_shrink = h_flat.reshape((3, 3))
-                h_expand = np.linalg.inv(h_shrink)
-                img_height, img_width = img.shape[0], img.shape[1]
-                img_warped = cv2.warpPerspective(img, h_expand, (img_width, img_height))
-                cv2.imwrite('volatile/camera-photo-warped.jpg', img_warped)
-                print('Image written.')
-            except Exception as e:
-                print('Could not warp photo')
-                print(e)
+        try:
+            print(f'Image written to {self.rpc_warp_last_photo(arg)}')
+        except Exception as e:
+            print('Could not warp photo')
+            print(e)
 
     def do_bye(self, arg):
+        self.camera.release()
         print("Bye!")
         return True
 
     def do_EOF(self, arg):
         return True
 
+class FramedRpcServer:
+    """
+    Serves Interpreter RPCs over a framed protocol so that several requests
+    can be in flight at once and their responses matched back by ID.
+
+    Request frame:  b'<id> <command> <length>\\n' then <length> payload bytes.
+    Response frame: b'<id> <status> <length>\\n' then <length> payload bytes,
+    where status is 'ok' or 'error' (payload is then the error message).
+
+    Requests are read on a thread of their own and run on a worker pool,
+    except for commands that drive OpenCV windows. Those must stay on the
+    main thread, so they are queued for it and run one at a time in the
+    order received, while reading carries on. Streaming commands get a
+    thread of their own, and send any number of 'frame' responses under
+    their ID before the final 'ok' or 'error'.
+    """
+    MAIN_THREAD_COMMANDS = ('image', 'choose_point')
+    STREAM_COMMANDS = ('preview_stream',)
+
+    def __init__(self, interpreter, in_stream, out_stream, max_workers=4):
+        self.interpreter = interpreter
+        self.in_stream = in_stream
+        self.out_stream = out_stream
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.main_thread_requests = queue.Queue()
+        self.write_lock = threading.Lock()
+
+    def serve_forever(self):
+        """
+        Serves until the input closes or a 'bye' request arrives. Must be
+        called on the main thread, which runs MAIN_THREAD_COMMANDS.
+        """
+        reader = threading.Thread(target=self._read_requests)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                request = self.main_thread_requests.get()
+                if request is None:
+                    break
+                self._handle(*request)
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def _read_requests(self):
+        try:
+            while True:
+                header = self.in_stream.readline()
+                if not header:
+                    break
+                try:
+                    rpc_id, command, length = self._parse_header(header)
+                except ValueError:
+                    print(f'Dropping malformed frame header: {header!r}',
+                          file=sys.stderr)
+                    continue
+                payload = self._read_exactly(length)
+                if command == 'bye':
+                    self._respond(rpc_id, 'ok', 'Bye!')
+                    break
+                if command in FramedRpcServer.MAIN_THREAD_COMMANDS:
+                    self.main_thread_requests.put((rpc_id, command, payload))
+                elif command in FramedRpcServer.STREAM_COMMANDS:
+                    stream_thread = threading.Thread(target=self._stream,\
+                                        args=(rpc_id, command, payload))
+                    stream_thread.daemon = True
+                    stream_thread.start()
+                else:
+                    self.pool.submit(self._handle, rpc_id, command, payload)
+        finally:
+            # Lets the main thread finish what is queued and return
+            self.main_thread_requests.put(None)
+
+    def _parse_header(self, header):
+        fields = header.decode('utf-8').split()
+        if len(fields) != 3:
+            raise ValueError('Expected "<id> <command> <length>".')
+        rpc_id, command, length = fields
+        return rpc_id, command, int(length)
+
+    def _read_exactly(self, length):
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            chunk = self.in_stream.read(remaining)
+            if not chunk:
+                raise EOFError('Stream closed in the middle of a payload.')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def _handle(self, rpc_id, command, payload):
+        handler = getattr(self.interpreter, 'rpc_' + command, None)
+        if handler is None:
+            self._respond(rpc_id, 'error', f'Unknown command: {command}')
+            return
+        try:
+            result = handler(payload.decode('utf-8'))
+        except Exception as e:
+            self._respond(rpc_id, 'error', f'{type(e).__name__}: {e}')
+            return
+        self._respond(rpc_id, 'ok', result)
+
+    def _stream(self, rpc_id, command, payload):
+        handler = getattr(self.interpreter, 'stream_' + command)
+        try:
+            for frame in handler(payload.decode('utf-8')):
+                self._respond(rpc_id, 'frame', frame)
+        except Exception as e:
+            self._respond(rpc_id, 'error', f'{type(e).__name__}: {e}')
+            return
+        self._respond(rpc_id, 'ok', '')
+
+    def _respond(self, rpc_id, status, result):
+        if result is None:
+            result = b''
+        elif isinstance(result, str):
+            result = result.encode('utf-8')
+        header = f'{rpc_id} {status} {len(result)}\n'.encode('utf-8')
+        with self.write_lock:
+            self.out_stream.write(header + result)
+            self.out_stream.flush()
+
 def main():
-    Interpreter().cmdloop();
+    if '--framed' in sys.argv[1:]:
+        # Frames go to the real stdout; anything else printed along the way
+        # (e.g. driver logging) is diverted to stderr so it cannot corrupt
+        # the framing.
+        out_stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        server = FramedRpcServer(Interpreter(), sys.stdin.buffer, out_stream)
+        server.serve_forever()
+    else:
+        Interpreter().cmdloop();
 
 if __name__ == '__main__':
     main()
 
-
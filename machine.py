@@ -1,8 +1,98 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from lxml import etree
 from pyaxidraw import axidraw
 
+# Everything a preview run produces for one SVG document. Times are in
+# milliseconds, distances in meters. COMMANDS is the compiled list of EBB
+# commands that plot_svg streams to the machine.
+PlotPlan = namedtuple('PlotPlan', ['preview_svg', 'instructions',
+                                   'commands', 'time_estimate',
+                                   'distance_pendown', 'distance_total'])
+
+class PlanCache:
+    """
+    A thread-safe LRU cache of PlotPlans keyed by the content of the SVG
+    and the planner options that affect the result. Entries are evicted,
+    least recently used first, once their combined size passes MAX_BYTES.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.curr_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(svg_bytes, option_values):
+        digest = hashlib.sha256(svg_bytes)
+        digest.update(repr(option_values).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _plan_size(plan):
+        return len(plan.preview_svg) + sum(len(i) for i in plan.instructions) \
+                + sum(len(c) for c in plan.commands)
+
+    def get(self, key):
+        with self.lock:
+            plan = self.entries.get(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return plan
+
+    def put(self, key, plan):
+        size = PlanCache._plan_size(plan)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.curr_bytes -= PlanCache._plan_size(self.entries.pop(key))
+            self.entries[key] = plan
+            self.curr_bytes += size
+            while self.curr_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.curr_bytes -= PlanCache._plan_size(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.curr_bytes = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.curr_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
 class Machine:
+    # AxiDraw options that change a preview's output. Any of these may be
+    # overridden for planning through Machine.plan_options.
+    PLAN_OPTION_NAMES = ('speed_pendown', 'speed_penup', 'accel',
+                         'pen_pos_down', 'pen_pos_up', 'pen_rate_lower',
+                         'pen_rate_raise', 'pen_delay_down', 'pen_delay_up',
+                         'no_rotate', 'auto_rotate', 'const_speed', 'model',
+                         'resolution', 'reordering', 'rendering', 'units')
+
     def __init__(self, port='/dev/tty.usbmodem14101', dry=False):
         self.dry = dry
+        self.plan_options = {}
+        self.plan_cache = PlanCache()
+        self.default_plan_option_values = self._default_plan_option_values()
         self.ad = axidraw.AxiDraw()
         self.ad.interactive()
         MILLIMETER_FLAG = 2
@@ -55,30 +145,117 @@ class Machine:
             self.pen_up()
         return f'square at {start_pt} height {height} width {width}'
 
-    def generate_axidraw_instructions(self, filepath):
-        self.ad.plot_setup(filepath)
-        self.ad.options.preview = True
-        preview_svg, instructions = self.ad.plot_run(True)
-        return instructions
-
-    def generate_preview_svg(self, filepath):
-        self.ad.plot_setup(filepath)
-        self.ad.options.preview = True
-        self.ad.options.rendering = 3
-        self.ad.options.report_time = True
-        preview_svg, _ = self.ad.plot_run(True)
-        # TODO: use the time estimate values
-        # time_estimate = self.ad.time_estimate
-        # distance_total = self.ad.distance_total
-        # distance_pendown = self.ad.distance_pendown
-        return preview_svg
-
-    def plot_svg(self, filepath):
+    def _new_planner(self):
+        """
+        Returns a fresh AxiDraw for offline (preview) planning, so that
+        concurrent preview calls share no document state with each other
+        or with the connected plotter.
+        """
+        return axidraw.AxiDraw()
+
+    def _apply_plan_options(self, ad):
+        ad.options.preview = True
+        ad.options.rendering = 3
+        ad.options.report_time = True
+        for name, value in self.plan_options.items():
+            setattr(ad.options, name, value)
+
+    def _default_plan_option_values(self):
+        # Called once from __init__, before any plan_options are set
+        ad = self._new_planner()
+        ad.getoptions([])
+        self._apply_plan_options(ad)
+        return {name: getattr(ad.options, name, None)
+                for name in Machine.PLAN_OPTION_NAMES}
+
+    def _plan_option_values(self):
+        values = dict(self.default_plan_option_values)
+        for name, value in self.plan_options.items():
+            if name in values:
+                values[name] = value
+        return tuple(values[name] for name in Machine.PLAN_OPTION_NAMES)
+
+    @staticmethod
+    def _svg_input_as_bytes(svg_input):
+        if isinstance(svg_input, etree._ElementTree) or etree.iselement(svg_input):
+            return etree.tostring(svg_input)
+        if isinstance(svg_input, (bytes, bytearray)):
+            return bytes(svg_input)
+        if isinstance(svg_input, os.PathLike):
+            svg_input = os.fspath(svg_input)
+        if isinstance(svg_input, str) and svg_input.lstrip().startswith('<'):
+            return svg_input.encode('utf-8')
+        with open(svg_input, 'rb') as f:
+            return f.read()
+
+    def plan(self, svg_input):
+        """
+        Runs the preview pipeline on SVG_INPUT (a file path, a string of SVG
+        markup, or a parsed lxml tree) and returns a PlotPlan. Results are
+        cached on the SVG content and planner options, so repeat requests
+        for the same drawing return immediately.
+        """
+        svg_bytes = Machine._svg_input_as_bytes(svg_input)
+        key = PlanCache.make_key(svg_bytes, self._plan_option_values())
+        plan = self.plan_cache.get(key)
+        if plan is not None:
+            return plan
+        ad = self._new_planner()
+        ad.plot_setup(svg_input)
+        self._apply_plan_options(ad)
+        preview_svg, instructions, commands = ad.plot_compile(True)
+        ad.discard_overlay()
+        distance_pendown = 0.0254 * ad.pen_down_travel_inches
+        distance_penup = 0.0254 * ad.pen_up_travel_inches
+        plan = PlotPlan(preview_svg, tuple(instructions), tuple(commands),
+                        ad.pt_estimate, distance_pendown,
+                        distance_pendown + distance_penup)
+        self.plan_cache.put(key, plan)
+        return plan
+
+    def generate_axidraw_instructions(self, svg_input):
+        """
+        SVG_INPUT may be a file path, a string of SVG markup, or a parsed
+        lxml tree.
+        """
+        return list(self.plan(svg_input).instructions)
+
+    def generate_preview_svg(self, svg_input):
+        """
+        SVG_INPUT may be a file path, a string of SVG markup, or a parsed
+        lxml tree. Returns the preview document as a string.
+        """
+        return self.plan(svg_input).preview_svg
+
+    def estimate_plot(self, svg_input):
+        """
+        Returns the estimated plot time (ms) and pen-down and total travel
+        distances (m) for SVG_INPUT.
+        """
+        plan = self.plan(svg_input)
+        return {
+            'time_estimate': plan.time_estimate,
+            'distance_pendown': plan.distance_pendown,
+            'distance_total': plan.distance_total
+        }
+
+    def plot_svg(self, svg_input):
+        """
+        Plots SVG_INPUT by streaming its compiled plan to the connected
+        AxiDraw. Planning happens up front (or comes from the plan cache),
+        so the machine never waits on computation mid-plot.
+        """
         if not self.dry:
-            try:
-                self.ad.plot_setup(filepath)
-                self.ad.plot_run()
-            except Exception as e:
-                print(e)
-        return f'plotted {filepath}'
+            commands = self.plan(svg_input).commands
+            sent = self.ad.plot_run_compiled(commands)
+            if self.ad.b_stopped:
+                errors = '; '.join(f'{command}: {response}' for command, response
+                                   in self.ad.ebb_errors)
+                raise RuntimeError(f'Plot halted after {sent} of {len(commands)} '
+                                   f'commands. {errors}'.strip())
+        if isinstance(svg_input, os.PathLike):
+            return f'plotted {os.fspath(svg_input)}'
+        if isinstance(svg_input, str) and not svg_input.lstrip().startswith('<'):
+            return f'plotted {svg_input}'
+        return 'plotted SVG document'
 
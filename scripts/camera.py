@@ -27,8 +27,10 @@ def draw_hough_lines(edge_img, out_img):
         cv2.line(out_img,(x1, y1),(x2, y2), (0, 255, 0), 2)
 
 def calc_contours(edge_img):
-    _, contours, hierarchy = cv2.findContours(edge_img, cv2.RETR_TREE,\
-                                           cv2.CHAIN_APPROX_SIMPLE)
+    # OpenCV 3 returns (image, contours, hierarchy), later versions
+    # (contours, hierarchy).
+    contours, hierarchy = cv2.findContours(edge_img, cv2.RETR_TREE,\
+                                           cv2.CHAIN_APPROX_SIMPLE)[-2:]
     return contours
 
 def decimate_contours(contours):
@@ -36,9 +38,14 @@ def decimate_contours(contours):
     return list(map(lambda c: cv2.approxPolyDP(c,\
                     MAX_DIST, True), contours))
 
-def find_work_env_in_contours(contours):
+def find_work_env_in_contours(contours, decimated=False):
+    """
+    Returns the largest four-point contour after decimation. Pass
+    DECIMATED=True if CONTOURS have already been through decimate_contours.
+    """
     def select_contour(contours):
-        decimated_contours = decimate_contours(contours)
+        decimated_contours = contours if decimated \
+                             else decimate_contours(contours)
         four_pt_contours = list(filter(lambda c: len(c) == 4, decimated_contours))
         max_area = 0
         candidate = None
@@ -61,6 +68,81 @@ def find_work_env_in_contours(contours):
         raise ValueError('Cannot find a contour with four points.')
     return rect_contour
 
+class WorkEnvTracker:
+    """
+    Follows the work envelope quadrilateral from frame to frame. After a
+    full search with find_work_env_in_contours, each corner is looked for
+    only within ROI_RADIUS pixels of where it was and refined to sub-pixel
+    accuracy. The full search runs again only when a corner is lost, or the
+    quadrilateral stops being convex or changes area by more than
+    MAX_AREA_CHANGE.
+
+    Corners are returned as a 4 x 2 float32 array, in the order of the
+    contour first found.
+    """
+    def __init__(self, roi_radius=24, max_area_change=0.1):
+        self.roi_radius = roi_radius
+        self.max_area_change = max_area_change
+        self.corners = None
+        self.frames_tracked = 0
+        self.full_searches = 0
+        self.losses = 0
+
+    def reset(self):
+        self.corners = None
+
+    def _refine(self, gray, corners):
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.03)
+        win = max(self.roi_radius // 4, 2)
+        corners = corners.reshape((-1, 1, 2)).astype(np.float32)
+        cv2.cornerSubPix(gray, corners, (win, win), (-1, -1), criteria)
+        return corners.reshape((4, 2))
+
+    def _track(self, gray):
+        img_h, img_w = gray.shape
+        r = self.roi_radius
+        found = []
+        for (x, y) in self.corners:
+            x0, y0 = max(int(x) - r, 0), max(int(y) - r, 0)
+            x1, y1 = min(int(x) + r + 1, img_w), min(int(y) + r + 1, img_h)
+            if x1 - x0 < 3 or y1 - y0 < 3:
+                return None
+            pts = cv2.goodFeaturesToTrack(gray[y0:y1, x0:x1], 4, 0.05, 3)
+            if pts is None:
+                return None
+            # Other features may fall within the window too, so take the
+            # one nearest the corner's last position.
+            pts = pts.reshape((-1, 2)) + (x0, y0)
+            found.append(pts[np.argmin(np.hypot(*(pts - (x, y)).T))])
+        corners = self._refine(gray, np.array(found))
+        area = cv2.contourArea(corners)
+        prev_area = cv2.contourArea(self.corners)
+        if not cv2.isContourConvex(corners) \
+                or abs(area - prev_area) > self.max_area_change * prev_area:
+            return None
+        return corners
+
+    def update(self, gray, find_contours):
+        """
+        Returns the work envelope corners in the grayscale frame GRAY.
+        FIND_CONTOURS is called with no arguments to get the frame's
+        contours, already through decimate_contours, only if a full search
+        is needed. Raises ValueError if the envelope cannot be found.
+        """
+        if self.corners is not None:
+            corners = self._track(gray)
+            if corners is not None:
+                self.corners = corners
+                self.frames_tracked += 1
+                return corners
+            self.losses += 1
+            self.corners = None
+        self.full_searches += 1
+        rect_contour = find_work_env_in_contours(find_contours(),\
+                                                 decimated=True)
+        self.corners = self._refine(gray, rect_contour)
+        return self.corners
+
 def calc_work_env_homog(raw_img, env_corner_points, out_shape):
     def order_contour_points(contour_pts, img_contour):
         """
@@ -103,6 +185,22 @@ def calc_work_env_homog(raw_img, env_corner_points, out_shape):
                                    np.array(out_img_corners, np.float32))
     return h
 
+def calc_undistort_maps(camera_matrix, dist_coeffs, out_size, h=None):
+    """
+    Returns fixed-point cv2.remap maps that correct lens distortion and then,
+    if H is given, apply the homography H, both in a single pass. OUT_SIZE
+    is (width, height).
+    """
+    if h is None:
+        h = np.eye(3)
+    # initUndistortRectifyMap takes each output pixel p back through
+    # inv(newCameraMatrix * R). With R = camera_matrix and newCameraMatrix =
+    # h, that is inv(camera_matrix) * inv(h) * p: the undistorted pixel that
+    # h maps to p, in normalized camera coordinates, ready to be distorted.
+    return cv2.initUndistortRectifyMap(camera_matrix, dist_coeffs,\
+                                       camera_matrix, h, out_size,\
+                                       cv2.CV_16SC2)
+
 def transform_contour_with_h(contour, h):
     contour_float = np.array(contour).astype(np.float32)
     trans = cv2.perspectiveTransform(contour_float, h)
@@ -164,6 +262,11 @@ class Camera:
         self.work_env_contour = None
         self.video_capture = cv2.VideoCapture(0)
         self.video_preview_open = False
+        self.work_env_tracker = WorkEnvTracker()
+        self.camera_matrix = None
+        self.dist_coeffs = None
+        self.undistort_maps = None
+        self.undistort_size = None
 
     def _process_image(self, img):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -175,8 +278,23 @@ class Camera:
     def _load_file_image(self):
         return cv2.imread(self.path)
 
+    def set_intrinsics(self, camera_matrix, dist_coeffs):
+        self.camera_matrix = camera_matrix
+        self.dist_coeffs = dist_coeffs
+        self.undistort_maps = None
+
+    def _undistort(self, frame):
+        size = (frame.shape[1], frame.shape[0])
+        if self.undistort_maps is None or self.undistort_size != size:
+            self.undistort_maps = calc_undistort_maps(self.camera_matrix,\
+                                                      self.dist_coeffs, size)
+            self.undistort_size = size
+        return cv2.remap(frame, *self.undistort_maps, cv2.INTER_LINEAR)
+
     def _read_video_image(self):
         ret, frame = self.video_capture.read()
+        if self.camera_matrix is not None:
+            frame = self._undistort(frame)
         return frame
 
     def open_video_preview(self):
@@ -185,11 +303,13 @@ class Camera:
 
     def update_video_preview(self):
         img = self._read_video_image()
-        img_edge = self._process_image(img)
-        contours = calc_contours(img_edge)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        find_contours = lambda: decimate_contours(calc_contours(\
+                                    self._process_image(img)))
         try:
-            work_env_contour = find_work_env_in_contours(contours)
-            cv2.drawContours(img, [work_env_contour], -1, (0, 255, 0), 3)
+            work_env_contour = self.work_env_tracker.update(gray, find_contours)
+            cv2.drawContours(img, [work_env_contour.round().astype(np.int32)],\
+                             -1, (0, 255, 0), 3)
         except ValueError:
             pass
         cv2.imshow('preview', img)
@@ -2,17 +2,140 @@ import numpy as np
 import svgpathtools as pt
 import math
 import cv2
-from functools import reduce
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+class PackedContours:
+    """
+    A list of contours stored as one (N, 2) int32 array of points and an
+    array of M + 1 offsets, where contour i is points[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, points, offsets):
+        self.points = points
+        self.offsets = offsets
+
+    @staticmethod
+    def from_contours(contours):
+        counts = [len(c) for c in contours]
+        offsets = np.zeros(len(counts) + 1, np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if len(contours) == 0:
+            return PackedContours(np.zeros((0, 2), np.int32), offsets)
+        points = np.concatenate([np.asarray(c).reshape((-1, 2))\
+                                 for c in contours]).astype(np.int32)
+        return PackedContours(points, offsets)
+
+    def to_contours(self):
+        """
+        Returns the contours as a list of (k, 1, 2) views of the points, the
+        layout OpenCV uses.
+        """
+        points = self.points.reshape((-1, 1, 2))
+        return [points[start:end] for start, end\
+                in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def combined(self):
+        """
+        Returns every point of every contour as one (N, 1, 2) contour. This
+        is a view, not a copy.
+        """
+        return self.points.reshape((-1, 1, 2))
+
+    def transformed(self, mat):
+        """
+        Returns a new PackedContours with the 2x3 affine MAT applied to
+        every point in a single pass. The offsets are shared.
+        """
+        points = cv2.transform(self.combined(), mat).reshape((-1, 2))
+        return PackedContours(points.astype(np.int32, copy=False),\
+                              self.offsets)
+
+    def bounding_rect(self):
+        return cv2.boundingRect(self.combined())
+
+    def save(self, filepath):
+        # Written to a temporary file first, so an interrupted save never
+        # leaves a partial file at FILEPATH.
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp',\
+                                        dir=os.path.dirname(filepath) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, points=self.points, offsets=self.offsets)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def load(filepath):
+        # Opened here so that the file is closed even when np.load fails
+        with open(filepath, 'rb') as f, np.load(f) as data:
+            packed = PackedContours(data['points'], data['offsets'])
+        if packed.points.ndim != 2 or packed.points.shape[1] != 2\
+                or len(packed.offsets) == 0\
+                or packed.offsets[-1] != len(packed.points):
+            raise ValueError(f'Malformed contours in {filepath}')
+        return packed
+
+def _extract_packed_contours(img_filepath, threshold):
+    # Runs in a worker process for Loader.extract_contours_from_img_files
+    contours = Loader.extract_contours_from_img_file(img_filepath, threshold)
+    return PackedContours.from_contours(contours)
 
 class Loader:
+    # Converted files are cached here, keyed on file content and parameters
+    CACHE_DIR = '.loader_cache'
+    CACHE_VERSION = 1
+
     def __init__(self):
         pass
 
     @staticmethod
-    def load_svg(filepath):
+    def _cache_path(filepath, kind, params):
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(repr((Loader.CACHE_VERSION, kind, params)).encode('utf-8'))
+        return os.path.join(Loader.CACHE_DIR, f'{kind}-{digest.hexdigest()}.npz')
+
+    @staticmethod
+    def _load_cached(cache_path):
+        """
+        Returns the PackedContours cached at CACHE_PATH, or None. A cache
+        file that cannot be read for any reason, e.g. one left truncated or
+        empty by an interrupted write, counts as a miss.
+        """
+        try:
+            return PackedContours.load(cache_path)
+        except Exception:
+            return None
+
+    @staticmethod
+    def load_svg(filepath, t_samp=10):
+        """
+        Returns one contour for each path in the SVG file, with curves and
+        arcs sampled at T_SAMP + 1 points. Results are cached on disk by file
+        content and T_SAMP.
+        """
+        cache_path = Loader._cache_path(filepath, 'svg', (t_samp,))
+        packed = Loader._load_cached(cache_path)
+        if packed is not None:
+            return packed.to_contours()
+        packed = Loader._sample_svg(filepath, t_samp)
+        os.makedirs(Loader.CACHE_DIR, exist_ok=True)
+        packed.save(cache_path)
+        return packed.to_contours()
+
+    @staticmethod
+    def _sample_svg(filepath, T_SAMP):
         paths, attrs = pt.svg2paths(filepath)
         contours = []
-        T_SAMP = 10
         for idx, path in enumerate(paths):
             subpath_matrices = []
             try:
@@ -41,15 +164,17 @@ class Loader:
 
                 subpath_matrices.append(sp_mtx)
             contours.append(Loader._combine_subpath_matrices(subpath_matrices))
-        return contours
+        return PackedContours.from_contours(contours)
 
     @staticmethod
-    def extract_contours_from_img_file(img_filepath):
+    def extract_contours_from_img_file(img_filepath, threshold=100):
         img = cv2.imread(img_filepath)
-        _, edge_img = cv2.threshold(img, 100, 255, cv2.THRESH_BINARY)
+        _, edge_img = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
         edge_img = cv2.cvtColor(edge_img, cv2.COLOR_BGR2GRAY)
-        _, contours, hierarchy = cv2.findContours(edge_img, cv2.RETR_TREE,\
-                                               cv2.CHAIN_APPROX_SIMPLE)
+        # OpenCV 3 returns (image, contours, hierarchy), later versions
+        # (contours, hierarchy).
+        contours, hierarchy = cv2.findContours(edge_img, cv2.RETR_TREE,\
+                                               cv2.CHAIN_APPROX_SIMPLE)[-2:]
         return contours
         # img = cv2.imread(img_filepath)
         # _ = np.zeros(img.shape)
@@ -58,6 +183,59 @@ class Loader:
         # edge_img = cv2.Canny(img, thresh_low, thresh_high)
         # return [edge_img]
 
+    @staticmethod
+    def extract_contours_from_img_files(img_filepaths, threshold=100,\
+                                        max_workers=None):
+        """
+        Converts several raster images to contours as
+        extract_contours_from_img_file does, and returns a dict from each
+        path to its PackedContours. Results are cached on disk by file
+        content and threshold; images not yet in the cache are converted in
+        a pool of worker processes.
+        """
+        results = {}
+        misses = {}
+        for filepath in img_filepaths:
+            cache_path = Loader._cache_path(filepath, 'img', (threshold,))
+            packed = Loader._load_cached(cache_path)
+            if packed is None:
+                misses[filepath] = cache_path
+            else:
+                results[filepath] = packed
+        if len(misses) == 1:
+            # Not worth starting worker processes for
+            filepath = next(iter(misses))
+            converted = {filepath: _extract_packed_contours(filepath, threshold)}
+        elif misses:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = {filepath: pool.submit(_extract_packed_contours,\
+                                                 filepath, threshold)\
+                           for filepath in misses}
+                converted = {filepath: future.result()\
+                             for filepath, future in futures.items()}
+        else:
+            converted = {}
+        if converted:
+            os.makedirs(Loader.CACHE_DIR, exist_ok=True)
+        for filepath, packed in converted.items():
+            packed.save(misses[filepath])
+            results[filepath] = packed
+        return results
+
+    @staticmethod
+    def extract_contours_from_img_dir(directory, threshold=100,\
+                                      max_workers=None):
+        """
+        Runs extract_contours_from_img_files on every PNG and JPG file in
+        DIRECTORY.
+        """
+        filepaths = [os.path.join(directory, filename)\
+                     for filename in sorted(os.listdir(directory))\
+                     if filename.lower().endswith(('.png', '.jpg'))\
+                     and filename[0] != '.']
+        return Loader.extract_contours_from_img_files(filepaths, threshold,\
+                                                      max_workers)
+
     @staticmethod
     def export_contours_as_svg(contours, title):
         culled_contours = Loader._cull_small_contours(contours)
@@ -87,9 +265,7 @@ class Loader:
 
     @staticmethod
     def _combine_subpath_matrices(matrices):
-        def combine(c0, c1):
-            return np.append(c0, c1, axis=0)
-        return reduce(combine, matrices).astype(np.int32)
+        return np.concatenate(matrices).astype(np.int32)
 
     @staticmethod
     def _cull_small_contours(contours):
@@ -3,15 +3,266 @@ import math
 import cv2
 import numpy as np
 from machine import Machine
+from calibration import CalibrationStore, CALIBRATION_PATH
 # from camera import Camera
-from loader import Loader
+from loader import Loader, PackedContours
 from toolpath_collection import Toolpath, ToolpathCollection
 import projection
-import pickle
-import os
+
+TOOLPATH_COLORS = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+    'red': (0, 0, 255),
+    'green': (0, 255, 0),
+}
+
+class SceneRenderer:
+    """
+    Retained-mode renderer for an Interaction's projection image.
+
+    Each toolpath is drawn into its own sprite, which is redrawn only when
+    the toolpath's rotation, scale, color or selection changes; moving a
+    toolpath just moves its sprite. The GUI and the toolpath thumbnails form
+    a background layer that is redrawn only when the GUI state changes.
+    A render then recomposites only the rectangles where toolpaths were and
+    now are, so dragging one toolpath costs the same however many others
+    are loaded.
+    """
+    # Room around a toolpath's bounding box for its line width
+    SPRITE_PAD = 2
+
+    def __init__(self, img_shape):
+        self.img_shape = img_shape
+        self.frame = np.zeros(img_shape, np.float32)
+        self.sprites = {}
+        self.placed = []
+        self.gui_key = None
+        self.gui_img = None
+        self.gui_mask = None
+        self.thumbnails = None
+        self.thumbnail_bitmap = None
+        self.full_redraw = True
+        self.regions_composited = 0
+
+    def _gui_state(self, ixn):
+        return (ixn.listening_translate, ixn.listening_rotate,\
+                ixn.listening_scale, ixn.mode_flag, ixn.gui.envelope_hw)
+
+    def _render_background(self, ixn):
+        self.gui_img = np.zeros(self.img_shape, np.float32)
+        ixn.gui.render_gui_layer(ixn, self.gui_img)
+        # Drawn again in one solid color, so that black GUI pixels such as
+        # button labels still cover the toolpaths under them
+        coverage = np.zeros(self.img_shape[:2], np.uint8)
+        ixn.gui.render_gui_layer(ixn, coverage, 'white')
+        self.gui_mask = coverage.astype(bool)
+        self.thumbnail_bitmap = ixn.toolpath_collection.bitmap
+        self.thumbnails = ixn.toolpath_collection.add_bitmap_to_projection(\
+                            np.zeros(self.img_shape, np.float32))
+
+    def _sprite_for(self, ixn, tp):
+        key = (tp.theta, tp.scale, tp.color, tp.name == ixn.selected_tp_name,\
+               id(tp.packed))
+        cached = self.sprites.get(tp.name)
+        if cached is None or cached[0] != key:
+            sprite, mask = ixn.rasterize_toolpath(tp.name,\
+                                                  SceneRenderer.SPRITE_PAD)
+            cached = (key, sprite, mask)
+            self.sprites[tp.name] = cached
+        return cached[1], cached[2]
+
+    def _layers(self, ixn):
+        # (name, screen rect (x0, y0, x1, y1), sprite, mask) in z-order
+        layers = []
+        pad = SceneRenderer.SPRITE_PAD
+        for tp in ixn.toolpaths:
+            sprite, mask = self._sprite_for(ixn, tp)
+            x0 = int(tp.translate_x) - pad
+            y0 = int(tp.translate_y) - pad
+            rect = (x0, y0, x0 + sprite.shape[1], y0 + sprite.shape[0])
+            layers.append((tp.name, rect, sprite, mask))
+        if len(self.sprites) > len(layers):
+            active = {name for (name, _, _, _) in layers}
+            self.sprites = {name: cached for name, cached\
+                            in self.sprites.items() if name in active}
+        return layers
+
+    def _composite(self, rect, layers):
+        img_h, img_w = self.img_shape[:2]
+        x0, y0 = max(rect[0], 0), max(rect[1], 0)
+        x1, y1 = min(rect[2], img_w), min(rect[3], img_h)
+        if x0 >= x1 or y0 >= y1:
+            return
+        region = self.frame[y0:y1, x0:x1]
+        region[:] = 0
+        for (_, (lx0, ly0, lx1, ly1), sprite, mask) in layers:
+            ox0, oy0 = max(x0, lx0), max(y0, ly0)
+            ox1, oy1 = min(x1, lx1), min(y1, ly1)
+            if ox0 >= ox1 or oy0 >= oy1:
+                continue
+            np.copyto(region[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0],\
+                      sprite[oy0 - ly0:oy1 - ly0, ox0 - lx0:ox1 - lx0],\
+                      where=mask[oy0 - ly0:oy1 - ly0, ox0 - lx0:ox1 - lx0,\
+                                 np.newaxis])
+        np.copyto(region, self.gui_img[y0:y1, x0:x1],\
+                  where=self.gui_mask[y0:y1, x0:x1, np.newaxis])
+        region += self.thumbnails[y0:y1, x0:x1]
+        self.regions_composited += 1
+
+    def invalidate(self):
+        self.full_redraw = True
+
+    def render(self, ixn):
+        """
+        Brings the frame up to date with IXN and returns it.
+        """
+        gui_key = self._gui_state(ixn)
+        if gui_key != self.gui_key \
+                or ixn.toolpath_collection.bitmap is not self.thumbnail_bitmap:
+            self._render_background(ixn)
+            self.gui_key = gui_key
+            self.full_redraw = True
+        layers = self._layers(ixn)
+        placed = [(name, rect, id(sprite)) for (name, rect, sprite, _)\
+                  in layers]
+        if self.full_redraw:
+            img_h, img_w = self.img_shape[:2]
+            dirty = [(0, 0, img_w, img_h)]
+        elif [name for (name, _, _) in placed] \
+                != [name for (name, _, _) in self.placed]:
+            # The stacking order changed, so redraw everywhere a toolpath
+            # was or is.
+            dirty = [rect for (_, rect, _) in self.placed + placed]
+        else:
+            dirty = []
+            for old, new in zip(self.placed, placed):
+                if old != new:
+                    dirty.extend((old[1], new[1]))
+        for rect in dirty:
+            self._composite(rect, layers)
+        self.placed = placed
+        self.full_redraw = False
+        return self.frame
+
+class ContourIndex:
+    """
+    Uniform grid over the bounding boxes of a list of contours, with their
+    arc lengths computed up front, so finding the contours near a point
+    only tests the few whose boxes are close to it.
+    """
+    CELL_PX = 64
+
+    def __init__(self, contours):
+        self.contours = contours
+        self.arc_lengths = np.array([cv2.arcLength(c, closed=True)\
+                                     for c in contours])
+        # (x_min, y_min, x_max, y_max) per contour, with the same corners
+        # as Interaction.calc_straight_bbox_for_contour
+        self.bboxes = np.zeros((len(contours), 4), np.int64)
+        self.cells = {}
+        for idx, contour in enumerate(contours):
+            x, y, w, h = cv2.boundingRect(contour)
+            self.bboxes[idx] = (x, y, x + w, y + h)
+            for cell in self._cells_overlapping(x, y, x + w, y + h):
+                self.cells.setdefault(cell, []).append(idx)
+
+    def _cells_overlapping(self, x0, y0, x1, y1):
+        cell_px = ContourIndex.CELL_PX
+        for cy in range(int(y0) // cell_px, int(y1) // cell_px + 1):
+            for cx in range(int(x0) // cell_px, int(x1) // cell_px + 1):
+                yield (cx, cy)
+
+    def near(self, pt, eps_px):
+        """
+        Returns the indices, in ascending order, of the contours whose
+        outline passes within EPS_PX of PT.
+        """
+        x, y = pt
+        candidates = set()
+        for cell in self._cells_overlapping(x - eps_px, y - eps_px,\
+                                            x + eps_px, y + eps_px):
+            candidates.update(self.cells.get(cell, ()))
+        if not candidates:
+            return []
+        candidates = np.array(sorted(candidates))
+        bboxes = self.bboxes[candidates]
+        in_reach = (bboxes[:, 0] - eps_px <= x) & (x <= bboxes[:, 2] + eps_px)\
+                   & (bboxes[:, 1] - eps_px <= y) & (y <= bboxes[:, 3] + eps_px)
+        return [idx for idx in candidates[in_reach]\
+                if abs(cv2.pointPolygonTest(self.contours[idx], pt,\
+                                            measureDist=True)) <= eps_px]
+
+class SnapEngine:
+    """
+    Sorted vertical and horizontal edges of a set of bounding boxes, for
+    snapping a dragged box to the nearest edge with binary searches. An
+    edge only counts if its box comes within the snap distance of the
+    dragged box on the other axis, so boxes elsewhere on the screen do not
+    pull the dragged box into line with them.
+    """
+    def __init__(self, extents, snap_dist):
+        # EXTENTS are (x_min, y_min, x_max, y_max) rows
+        extents = np.asarray(extents, np.int64).reshape((-1, 4))
+        self.x_edges, self.x_spans = \
+                SnapEngine._sorted_edges(extents[:, [0, 2]], extents[:, [1, 3]])
+        self.y_edges, self.y_spans = \
+                SnapEngine._sorted_edges(extents[:, [1, 3]], extents[:, [0, 2]])
+        self.snap_dist = snap_dist
+
+    @staticmethod
+    def _sorted_edges(sides, spans):
+        # Both sides of each box, sorted, each with the box's (min, max)
+        # on the other axis
+        edges = sides.ravel()
+        spans = np.repeat(spans, 2, axis=0)
+        order = np.argsort(edges, kind='stable')
+        return edges[order], spans[order]
+
+    def _nearby(self, spans, start, stop, other_low, other_high):
+        # Indices in [START, STOP) of edges whose box overlaps the dragged
+        # box on the other axis, or is within the snap distance of it
+        window = spans[start:stop]
+        near = (window[:, 0] <= other_high + self.snap_dist)\
+               & (window[:, 1] >= other_low - self.snap_dist)
+        return start + np.flatnonzero(near)
+
+    def _snap_axis(self, edges, spans, low, size, other_low, other_size):
+        # Snap the box's far side onto an edge at or just beyond it, or its
+        # near side onto an edge just behind it, whichever is closer.
+        high = low + size
+        other_high = other_low + other_size
+        snap = None
+        snap_dist = None
+        beyond = self._nearby(spans, np.searchsorted(edges, high, 'left'),\
+                              np.searchsorted(edges, high + self.snap_dist,\
+                                              'right'),\
+                              other_low, other_high)
+        if len(beyond):
+            snap = int(edges[beyond[0]]) - size
+            snap_dist = edges[beyond[0]] - high
+        behind = self._nearby(spans,\
+                              np.searchsorted(edges, low - self.snap_dist,\
+                                              'left'),\
+                              np.searchsorted(edges, low, 'left'),\
+                              other_low, other_high)
+        if len(behind):
+            if snap is None or low - edges[behind[-1]] < snap_dist:
+                snap = int(edges[behind[-1]])
+        return snap
+
+    def snap(self, x, y, width, height):
+        """
+        Returns [x, y] for the top left of a WIDTH by HEIGHT box at (X, Y)
+        snapped to the nearby edges, with None for an axis that does not
+        snap.
+        """
+        return [self._snap_axis(self.x_edges, self.x_spans, x, width,\
+                                y, height),\
+                self._snap_axis(self.y_edges, self.y_spans, y, height,\
+                                x, width)]
 
 class Interaction:
-    es_filename = './envelope_settings.pckl'
+    calibration_filename = CALIBRATION_PATH
 
     def __init__(self, img, screen_size):
         self.proj_screen_hw = (720, 1280)
@@ -24,28 +275,30 @@ class Interaction:
         self.set_listening_rotate(False)
         self.set_listening_scale(False)
         self.mode_flag = None
-        self.candidate_contours = []
         self.chosen_contour = None
         self.chosen_contour_bbox = []
+        self.set_candidate_contours([])
         self.curr_sel_contour = None
         self.curr_mouse_pos = (0, 0)
         self.curr_mouse_down = False
 
         # Init envelope
-        # if os.path.exists(Interaction.es_filename):
-        if False:
-            f = open(Interaction.es_filename, 'rb')
-            self.envelope_h = pickle.load(f)
-            f.close()
+        self.calibration = CalibrationStore(Interaction.calibration_filename)
+        calibration = self.calibration.get()
+        if calibration is not None and calibration['homography'].any():
+            self.envelope_h = np.array(calibration['homography'])
         else:
             self.envelope_h = None
-        # TODO: set these from envelope settings
-        self.envelope_hw = (18, 28) # slightly smaller than axidraw envelope
+        if calibration is not None and calibration['envelope_hw'].any():
+            self.envelope_hw = tuple(calibration['envelope_hw'])
+        else:
+            self.envelope_hw = (18, 28) # slightly smaller than axidraw envelope
         self.envelope_tp = Toolpath('ENVELOPE', None)
 
         # Init GUI
         self.gui = GuiControl(self.proj_screen_hw, img.shape)
-        self.gui.render_gui(self)
+        self.gui.envelope_hw = self.envelope_hw
+        self.scene = SceneRenderer(img.shape)
         self.mdown_offset_x = 0
         self.mdown_offset_y = 0
         self.selected_tp_name = None
@@ -56,6 +309,15 @@ class Interaction:
     def toolpaths(self):
         return self.toolpath_collection
 
+    def set_envelope_hw(self, envelope_hw):
+        """
+        Sets the work envelope size in cm as (height, width) and saves it
+        to the calibration store.
+        """
+        self.envelope_hw = tuple(envelope_hw)
+        self.gui.envelope_hw = self.envelope_hw
+        self.calibration.save(envelope_hw=self.envelope_hw)
+
     def move_toolpath_with_mdown_offset(self, tp_name, x, y):
         tp = self.toolpaths[tp_name]
         tp.translate_x = x - self.mdown_offset_x
@@ -68,42 +330,18 @@ class Interaction:
         self.render()
 
     def check_snap_for_toolpath(self, tp_name, x_val, y_val):
-        snaps = [None, None]
+        height, width = self.toolpaths[tp_name].transformed_size_hw()
+        return self.snap_engine.snap(x_val, y_val, width, height)
+
+    def _update_snap_engine(self):
+        # Snap to the chosen contour and to the candidate contours near
+        # the dragged toolpath
+        extents = self.candidate_index.bboxes
         if len(self.chosen_contour_bbox) > 0:
-            contour_bbox = self.chosen_contour_bbox.reshape((4, 1, 2))
-            x_vals = contour_bbox[:, 0, 0]
-            y_vals = contour_bbox[:, 0, 1]
-            x_min = x_vals[np.argmin(x_vals)]
-            x_max = x_vals[np.argmax(x_vals)]
-            y_min = y_vals[np.argmin(y_vals)]
-            y_max = y_vals[np.argmax(y_vals)]
-            trans_toolpath_bbox = self.calc_bbox_for_trans_toolpath(tp_name)
-            _, _, width, height = cv2.boundingRect(trans_toolpath_bbox)
-            x_min_border_left = x_val + width - x_min
-            x_min_border_right = x_val - x_min
-            x_max_border_left = x_val + width - x_max
-            x_max_border_right = x_val - x_max
-            y_min_border_bottom = y_val + height - y_min
-            y_min_border_top = y_val - y_min
-            y_max_border_bottom = y_val + height - y_max
-            y_max_border_top = y_val - y_max
-            if x_min_border_left >= -self.GRID_SNAP_DIST and x_min_border_left <= 0:
-                snaps[0] = x_min - width
-            if x_min_border_right <= self.GRID_SNAP_DIST and x_min_border_right > 0:
-                snaps[0] = x_min
-            if x_max_border_left >= -self.GRID_SNAP_DIST and x_max_border_left <= 0:
-                snaps[0] = x_max - width
-            if x_max_border_right <= self.GRID_SNAP_DIST and x_max_border_right > 0:
-                snaps[0] = x_max
-            if y_min_border_bottom >= -self.GRID_SNAP_DIST and y_min_border_bottom <= 0:
-                snaps[1] = y_min - height
-            if y_min_border_top <= self.GRID_SNAP_DIST and y_min_border_top > 0:
-                snaps[1] = y_min
-            if y_max_border_bottom >= -self.GRID_SNAP_DIST and y_max_border_bottom <= 0:
-                snaps[1] = y_max - height
-            if y_max_border_top <= self.GRID_SNAP_DIST and y_max_border_top > 0:
-                snaps[1] = y_max
-        return snaps
+            bbox = self.chosen_contour_bbox
+            extents = np.vstack((extents, (bbox[0, 0], bbox[0, 1],\
+                                           bbox[2, 0], bbox[2, 1])))
+        self.snap_engine = SnapEngine(extents, self.GRID_SNAP_DIST)
 
     def snap_translate(self):
         # TODO: offset doesn't work when rotation angle past pi radians
@@ -170,9 +408,11 @@ class Interaction:
 
     def set_candidate_contours(self, contours):
         self.candidate_contours = contours
+        self.candidate_index = ContourIndex(contours)
+        self._update_snap_engine()
 
     def clear_candidate_contours(self):
-        self.candidate_contours = []
+        self.set_candidate_contours([])
 
     def set_curr_sel_contour(self, contours):
         self.curr_sel_contour = contours
@@ -183,23 +423,26 @@ class Interaction:
     def set_chosen_contour(self, contour):
         self.chosen_contour = contour
         self.chosen_contour_bbox = self.calc_straight_bbox_for_contour(contour)
+        self._update_snap_engine()
 
     def clear_chosen_contour(self):
         self.chosen_contour = None
         self.chosen_contour_bbox = []
+        self._update_snap_engine()
 
     def select_contour_at_point(self, pt):
-        selected_contours = []
+        """
+        Returns the longest candidate contour whose outline passes near PT,
+        or None.
+        """
         eps_px = 10
-        for contour in self.candidate_contours:
-            signed_dist = cv2.pointPolygonTest(contour, pt, measureDist=True)
-            if abs(signed_dist) <= eps_px:
-                selected_contours.append(contour)
         max_len = 0
         optimal_contour = None
-        for c in selected_contours:
-            if cv2.arcLength(c, closed=True) >= max_len:
-                optimal_contour = c
+        for idx in self.candidate_index.near(pt, eps_px):
+            arc_length = self.candidate_index.arc_lengths[idx]
+            if arc_length >= max_len:
+                max_len = arc_length
+                optimal_contour = self.candidate_contours[idx]
         return optimal_contour
 
     def calc_bbox_center(self, contour):
@@ -215,14 +458,8 @@ class Interaction:
 
     def check_pt_inside_toolpath_bbox(self, pt):
         for tp in self.toolpaths:
-            trans_bbox = self.calc_bbox_for_trans_toolpath(tp.name)\
-                             .reshape((4, 1, 2))
-            x_vals = trans_bbox[:, 0, 0]
-            y_vals = trans_bbox[:, 0, 1]
-            x_min = x_vals[np.argmin(x_vals)]
-            x_max = x_vals[np.argmax(x_vals)]
-            y_min = y_vals[np.argmin(y_vals)]
-            y_max = y_vals[np.argmax(y_vals)]
+            # The bbox is cached on the toolpath until it is transformed
+            (x_min, y_min), _, (x_max, y_max), _ = tp.transformed_bbox()
             x_pt = pt[0]
             y_pt = pt[1]
             in_bbox = x_pt >= x_min and x_pt <= x_max\
@@ -293,9 +530,15 @@ class Interaction:
         return (box[0], box[3])
 
     def combine_contours(self, contours):
-        def combine(c0, c1):
-            return np.append(c0, c1, axis=0)
-        return reduce(combine, contours).astype(np.int32)
+        """
+        Returns the points of CONTOURS, which may be a list of contours, a
+        PackedContours or a Toolpath, as a single contour.
+        """
+        if isinstance(contours, Toolpath):
+            return contours.as_combined_subpaths()
+        if not isinstance(contours, PackedContours):
+            contours = PackedContours.from_contours(contours)
+        return contours.combined()
 
     def calc_min_bbox_for_contour(self, contour):
         rectangle = cv2.minAreaRect(contour)
@@ -317,16 +560,7 @@ class Interaction:
         return ((x[0], y[0]), (vx[0], vy[0]))
 
     def calc_bbox_for_trans_toolpath(self, tp_name):
-        toolpath = self.toolpaths[tp_name]
-        combined_contour = self.combine_contours(toolpath.path)
-        trans_toolpath = np.copy(combined_contour)
-        trans_toolpath = cv2.transform(trans_toolpath, toolpath.mat)
-        off_x, off_y, _, _ = cv2.boundingRect(trans_toolpath)
-        trans_toolpath[:,0,0] = trans_toolpath[:,0,0] \
-                                + toolpath.translate_x - off_x
-        trans_toolpath[:,0,1] = trans_toolpath[:,0,1] \
-                                + toolpath.translate_y - off_y
-        return self.calc_straight_bbox_for_contour(trans_toolpath)
+        return self.toolpaths[tp_name].transformed_bbox()
 
     def _render_candidate_contours(self):
         cv2.drawContours(self.img, self.candidate_contours, -1, (255, 0, 0), 1)
@@ -366,56 +600,45 @@ class Interaction:
                 projection.guide_through_pts(edge[0], edge[1],\
                         self.proj_screen_hw, self.img)
 
-    def _render_toolpath(self, tp_name):
-        color_name = self.toolpaths[tp_name].color
-        if color_name == 'white':
-            color = (255, 255, 255)
-        elif color_name == 'black':
-            color = (0, 0, 0)
-        elif color_name == 'red':
-            color = (0, 0, 255)
-        elif color_name == 'green':
-            color = (0, 255, 0)
-        else:
-            color = (255, 255, 255)
-
-        def make_translate_matrix(x, y):
-            def fn(contour):
-                c = np.copy(contour)
-                c[:,0,0] = c[:,0,0] + x
-                c[:,0,1] = c[:,0,1] + y
-                return c
-            return fn
+    def rasterize_toolpath(self, tp_name, pad):
+        """
+        Draws the rotated and scaled toolpath, with its bounding box if it
+        is selected, into a sprite whose top left is PAD pixels up and left
+        of the toolpath's bounding box. Returns the sprite and a boolean
+        mask of the pixels drawn.
+        """
         tp = self.toolpaths[tp_name]
-        tp.mat = cv2.getRotationMatrix2D((0, 0), \
-                            tp.theta, tp.scale)
-        sr_contours = list(map(lambda c: cv2.transform(c, tp.mat),\
-                                  tp.path))
-        combined_contour = self.combine_contours(sr_contours)
-        sr_off_x, sr_off_y, _, _ = cv2.boundingRect(combined_contour)
-        translate_sr_off = make_translate_matrix(-sr_off_x, -sr_off_y)
-        translate_full = make_translate_matrix(tp.translate_x, tp.translate_y)
-        sr_off_contours = list(map(translate_sr_off, sr_contours))
-        srt_off_contours = list(map(translate_full, sr_off_contours))
-        cv2.polylines(self.img, srt_off_contours, False, color, 2)
+        color = TOOLPATH_COLORS.get(tp.color, (255, 255, 255))
+        sr_h, sr_w = tp.transformed_size_hw()
+        local_contours = [c + pad for c in tp.rotated_scaled_subpaths()]
+        sprite_hw = (sr_h + 2 * pad + 1, sr_w + 2 * pad + 1)
+        sprite = np.zeros(sprite_hw + (3,), np.float32)
+        mask = np.zeros(sprite_hw, np.uint8)
+        cv2.polylines(sprite, local_contours, False, color, 2)
+        cv2.polylines(mask, local_contours, False, 255, 2)
         if tp_name == self.selected_tp_name:
-            self._render_bbox_for_toolpath(tp_name)
+            bbox = np.array([[0, 0], [sr_w, 0], [sr_w, sr_h], [0, sr_h]])\
+                   + pad
+            cv2.drawContours(sprite, [bbox], 0, (255, 255, 0), 1)
+            cv2.drawContours(mask, [bbox], 0, 255, 1)
+        return sprite, mask.astype(bool)
 
     def render(self, extras_fn=None):
         """
-        Note: this function draws each render subroutine over the last call
-        to the effect of being an informal z-buffer.
+        Updates the projection through the retained scene, which redraws
+        only what changed since the last call. Toolpaths are drawn first,
+        under the GUI, with the toolpath thumbnails added on top.
         """
-        self.img = np.zeros(self.img.shape, np.float32)
         # self._render_candidate_contours()
         # self._render_chosen_contour()
         # self._render_guides()
         # self._render_sel_contour()
-        for tp in self.toolpaths:
-            self._render_toolpath(tp.name)
-        self.gui.render_gui(self)
+        self.img = self.scene.render(self)
         if extras_fn:
+            # Extras draw straight onto the frame, so the scene has to
+            # start over next time.
             extras_fn()
+            self.scene.invalidate()
         cv2.imshow('Projection', self.img)
 
 class GuiControl:
@@ -431,7 +654,7 @@ class GuiControl:
             'gutter' : 100\
         }
 
-    def add_bottom_button(self, text, color_name, img):
+    def add_bottom_button(self, text, color_name, img, text_color='black'):
         text_size = projection.find_text_size(text)
         x_offset = len(self.bottom_buttons) *\
                    (text_size[0] + self.button_params['gutter'])
@@ -439,7 +662,7 @@ class GuiControl:
               self.button_params['start_pt'][1])
         rect_obj = projection.rectangle_at(pt, text_size[0], text_size[1], \
                     img, color_name, True)
-        text_obj = projection.text_at(text, pt, 'black', 1.5, img)
+        text_obj = projection.text_at(text, pt, text_color, 1.5, img)
         self.bottom_buttons.append((rect_obj, text_obj))
 
     def calibration_square(self, start_pt, length, img):
@@ -452,7 +675,7 @@ class GuiControl:
         projection.line_from_to(pt2, pt3, 'white', img)
         projection.line_from_to(pt3, start_pt, 'white', img)
 
-    def calibration_envelope(self, envelope_hw, img):
+    def calibration_envelope(self, envelope_hw, img, color_name='red'):
         height_px = envelope_hw[0] * self.CM_TO_PX
         width_px = envelope_hw[1] * self.CM_TO_PX
         thickness = 3
@@ -460,12 +683,12 @@ class GuiControl:
         pt1 = (width_px - thickness, thickness)
         pt2 = (width_px - thickness, height_px - thickness)
         pt3 = (thickness, height_px - thickness)
-        projection.line_from_to(pt0, pt1, 'red', img)
-        projection.line_from_to(pt1, pt2, 'red', img)
-        projection.line_from_to(pt2, pt3, 'red', img)
-        projection.line_from_to(pt3, pt0, 'red', img)
+        projection.line_from_to(pt0, pt1, color_name, img)
+        projection.line_from_to(pt1, pt2, color_name, img)
+        projection.line_from_to(pt2, pt3, color_name, img)
+        projection.line_from_to(pt3, pt0, color_name, img)
 
-    def render_envelope_handles(self, img):
+    def render_envelope_handles(self, img, color_name='cyan'):
         self.mode_flag = 'resize_envelope'
         CM_TO_PX = 37.7952755906
         h, w = self.envelope_hw
@@ -476,26 +699,31 @@ class GuiControl:
         for handle in corner_handles:
             rect_dim = 10
             projection.rectangle_centered_at(handle, rect_dim, rect_dim,
-                                        img, 'cyan', True)
+                                        img, color_name, True)
 
     def render_envelope_for_toolpath(self, toolpath, img):
         pass
 
-    def render_gui(self, ixn):
+    def render_gui_layer(self, ixn, img, solid_color=None):
         """
-        Renders the gui to IXN's bitmap.
+        Renders the buttons and envelope guides, but not the toolpath
+        thumbnails, to IMG. If SOLID_COLOR is given, everything, labels
+        included, is drawn in that color, which gives a coverage raster.
         """
         self.bottom_buttons = []
         t_color = 'green' if ixn.listening_translate else 'red'
         r_color = 'green' if ixn.listening_rotate else 'red'
         s_color = 'green' if ixn.listening_scale else 'red'
-        self.add_bottom_button('translate', t_color, ixn.img)
-        self.add_bottom_button('rotate', r_color, ixn.img)
-        self.add_bottom_button('scale', s_color, ixn.img)
-        self.calibration_envelope(self.envelope_hw, ixn.img)
+        text_color = solid_color or 'black'
+        self.add_bottom_button('translate', solid_color or t_color, img,\
+                               text_color)
+        self.add_bottom_button('rotate', solid_color or r_color, img,\
+                               text_color)
+        self.add_bottom_button('scale', solid_color or s_color, img,\
+                               text_color)
+        self.calibration_envelope(self.envelope_hw, img, solid_color or 'red')
         if ixn.mode_flag == 'resize_envelope':
-            self.render_envelope_handles(ixn.img)
-        ixn.img = ixn.toolpath_collection.add_bitmap_to_projection(ixn.img)
+            self.render_envelope_handles(img, solid_color or 'cyan')
 
 def make_machine_ixn_click_handler(machine, ixn):
     def handle_click(event, x, y, flags, param):
@@ -695,6 +923,8 @@ def run_canvas_loop():
                 instr = machine.plot_rect_hw(pt, ixn.envelope_hw[0],\
                                              ixn.envelope_hw[1])
                 print(instr)
+                # Keep the envelope just drawn for the next session
+                ixn.set_envelope_hw(ixn.envelope_hw)
                 ixn.mode_flag = 'resize_envelope'
 
             if pressed_key == ord('0') or pressed_key == ord('1')\
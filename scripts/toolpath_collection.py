@@ -1,13 +1,18 @@
 import numpy as np
 import cv2, os
-from functools import reduce
-from loader import Loader
+from loader import Loader, PackedContours
 import projection
 
 class Toolpath:
-    def __init__(self, name, filename, color='red'):
+    """
+    A named drawing and its placement on the canvas. The subpaths are kept
+    packed in one array (see PackedContours), and the rotated, scaled and
+    translated points and bounding box are computed once per transform
+    rather than on every frame, hit test and snap.
+    """
+    def __init__(self, name, filename, color='red', contours=None):
         self.name = name
-        self.path = np.array([])
+        self.path = []
         self.color = color
         self.theta = 0
         self.scale = 1.0
@@ -17,6 +22,8 @@ class Toolpath:
         self.mat = np.array([[1, 0, 0], [0, 1, 0]])
         if name == 'ENVELOPE':
             self._set_envelope_path()
+        elif contours is not None:
+            self.path = contours
         else:
             self._load_path_from_file(filename)
 
@@ -28,8 +35,75 @@ class Toolpath:
     def __iter__(self):
         return iter(self.path)
 
+    @property
+    def path(self):
+        """
+        The subpaths as a list of (k, 1, 2) views into the packed points.
+        May be set to a list of contours or to a PackedContours.
+        """
+        return self._path
+
+    @path.setter
+    def path(self, contours):
+        if not isinstance(contours, PackedContours):
+            contours = PackedContours.from_contours(contours)
+        self.packed = contours
+        self._path = contours.to_contours()
+        self._sr_key = None
+        self._trans_key = None
+
+    def _update_rotate_scale(self):
+        # Rotated and scaled points, shifted so their bounding box starts
+        # at the origin.
+        key = (self.theta, self.scale)
+        if key == self._sr_key:
+            return
+        self.mat = cv2.getRotationMatrix2D((0, 0), self.theta, self.scale)
+        sr_packed = self.packed.transformed(self.mat)
+        off_x, off_y, w, h = sr_packed.bounding_rect()
+        sr_packed.points -= np.array([off_x, off_y], np.int32)
+        self._sr_points = sr_packed.combined()
+        self._sr_subpaths = sr_packed.to_contours()
+        self._sr_hw = (h, w)
+        self._sr_key = key
+
+    def rotated_scaled_subpaths(self):
+        """
+        Returns the subpaths rotated by theta and scaled, with their
+        bounding box moved to the origin, as views into one cached array.
+        Also sets mat.
+        """
+        self._update_rotate_scale()
+        return self._sr_subpaths
+
+    def transformed_size_hw(self):
+        self._update_rotate_scale()
+        return self._sr_hw
+
+    def transformed_points(self):
+        """
+        Returns every point of the toolpath as it is placed on the canvas,
+        as one (N, 1, 2) int32 array.
+        """
+        self._update_rotate_scale()
+        key = (self._sr_key, self.translate_x, self.translate_y)
+        if key != self._trans_key:
+            self._trans_points = self._sr_points\
+                + np.array([self.translate_x, self.translate_y]).astype(np.int32)
+            self._trans_key = key
+        return self._trans_points
+
+    def transformed_bbox(self):
+        """
+        Returns the corners of the placed toolpath's upright bounding box,
+        clockwise from the top left, as a (4, 2) array.
+        """
+        h, w = self.transformed_size_hw()
+        x, y = int(self.translate_x), int(self.translate_y)
+        return np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]])
+
     def _load_path_from_file(self, filepath):
-        codec = filepath.split('.')[1]
+        codec = os.path.splitext(filepath)[1][1:].lower()
         if codec == 'svg':
             self.path = Loader.load_svg(filepath)
         else:
@@ -39,9 +113,7 @@ class Toolpath:
         pass
 
     def as_combined_subpaths(self):
-        def combine(c0, c1):
-            return np.append(c0, c1, axis=0)
-        return reduce(combine, self.path.copy()).astype(np.int32)
+        return self.packed.combined()
 
 class ToolpathCollection:
     def __init__(self, main_canvas_hw_px):
@@ -111,10 +183,18 @@ class ToolpathCollection:
             return filename[0] != '.' and filename.find('.') != -1
         filenames = os.listdir(self.directory_vectors)
         filenames = list(filter(fn_not_hidden_or_idr, filenames))
+        # Convert all the rasters at once, in parallel
+        raster_paths = [self.directory_vectors + filename\
+                        for filename in filenames\
+                        if os.path.splitext(filename.lower())[1]\
+                            in ('.png', '.jpg')]
+        raster_contours = Loader.extract_contours_from_img_files(raster_paths)
         for idx, filename in enumerate(filenames):
-            short_name, codec = filename.lower().split('.')
-            if codec == 'svg' or codec == 'png' or codec == 'jpg':
-                new_tp = Toolpath(short_name, self.directory_vectors + filename)
+            short_name, ext = os.path.splitext(filename.lower())
+            if ext in ('.svg', '.png', '.jpg'):
+                filepath = self.directory_vectors + filename
+                new_tp = Toolpath(short_name, filepath,\
+                                  contours=raster_contours.get(filepath))
                 new_tp.box_idx = idx
                 self.toolpaths.append(new_tp)
 
@@ -128,15 +208,13 @@ class ToolpathCollection:
                     self.box_width, self.box_height, self.bitmap, 'red')
             projection.text_at(tp.name, (x_offset, y_offset + self.box_height),
                     'red', 0.5, overlay)
-            _, _, path_bbox_w, path_bbox_h = cv2.boundingRect(tp \
-                                                .as_combined_subpaths())
+            _, _, path_bbox_w, path_bbox_h = tp.packed.bounding_rect()
             downscale_x = self.box_width / path_bbox_w
             downscale_y = self.box_height / path_bbox_h
             ds_min = min(downscale_x, downscale_y)
             trans_mat = np.array([[ds_min, 0, x_offset], \
                                   [0, ds_min, y_offset]])
-            trans_paths = [cv2.transform(subpath, trans_mat)\
-                    for subpath in tp.path]
+            trans_paths = tp.packed.transformed(trans_mat).to_contours()
             cv2.polylines(overlay, trans_paths, False, (0, 0, 255), 1)
         self.bitmap = self.bitmap + overlay
 
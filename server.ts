@@ -25,7 +25,10 @@ const DEVICE_PORT_MOCKS: SerialPortMock[] = [];
 const DEVICE_PORT_PARSERS: ReadlineParser[] = [];
 app.use(bodyParser.json({ limit: '10mb' })); // for parsing application/json
 app.use(express.static(__dirname + '/client')); // set the static files location /public/img will be /img for users
-const shell = new ps.PythonShell('./cp_interpreter.py', {});
+const shell = new ps.PythonShell('./cp_interpreter.py', {
+    mode: 'binary',
+    args: ['--framed']
+});
 
 // database ===========================================
 const db = new bsDatabase('verso.db', {});
@@ -56,76 +59,133 @@ if (workflowTableIsEmpty(db)) {
 }
 
 
-/* Keep references to the name and Express response object for the current
- * RPC and set the shell.on handler once only, using a lookup table that
- * checks the name of the RPC and handles it appropriately. This is because
- * we cannot unbind shell.on handlers and so cannot set them in routes. */
-shell.currRpcResponse = undefined;
-shell.currRpcName = '';
-shell.on('message', (message: string) => {
-    if (shell.currRpcName === 'choosePoint') {
-        let xyPair = message;
-        let parsedPair = xyPair.split(',').map(s => parseInt(s));
-        shell.currRpcResponse.status(200).json({
-            results: {
-                x: parsedPair[0],
-                y: parsedPair[1]
-            }
+/* RPCs to the interpreter use a framed protocol so that several calls can
+ * be in flight at once (e.g. a slow preview and a photo) and each response
+ * is matched back to its caller by request ID.
+ *
+ * Request:  '<id> <command> <length>\n' followed by <length> payload bytes.
+ * Response: '<id> <status> <length>\n' followed by <length> payload bytes,
+ *           where status is 'ok' or 'error'. Streaming calls first get any
+ *           number of responses with status 'frame' under the same ID. */
+interface PendingRpc {
+    resolve: (payload: Buffer) => void;
+    reject: (error: Error) => void;
+    onFrame?: (payload: Buffer) => void;
+}
+const pendingRpcs = new Map<number, PendingRpc>();
+let nextRpcId = 0;
+let rpcReadBuffer = Buffer.alloc(0);
+
+let callRpc = (command: string, payload: string = '',
+               onFrame?: (payload: Buffer) => void): Promise<Buffer> => {
+    let rpcId = nextRpcId++;
+    let payloadBuffer = Buffer.from(payload, 'utf-8');
+    let header = Buffer.from(`${rpcId} ${command} ${payloadBuffer.length}\n`, 'utf-8');
+    return new Promise((resolve, reject) => {
+        pendingRpcs.set(rpcId, {
+            resolve: resolve,
+            reject: reject,
+            onFrame: onFrame
         });
-        shell.currRpcResponse = undefined;
-        shell.currRpcName = '';
-    }
-    else if (shell.currRpcName === 'detectFaceBoxes') {
-        try {
-            let arrayOfArrays = JSON.parse(message);
-            let boxes = arrayOfArrays.map((box: number[]) => {
-                return {
-                    topLeftX: box[0],
-                    topLeftY: box[1],
-                    width: box[2],
-                    height: box[3]
-                }
-            });
-            shell.currRpcResponse.status(200).json({
-                results: boxes
-            });
-            shell.currRpcResponse = undefined;
-            shell.currRpcName = '';
+        shell.stdin.write(Buffer.concat([header, payloadBuffer]));
+    });
+};
+
+let consumeRpcFrames = () => {
+    while (true) {
+        let headerEnd = rpcReadBuffer.indexOf('\n');
+        if (headerEnd === -1) {
+            return;
         }
-        catch (e) {
-            console.log(`PC --> Could not parse faces.`);
+        let [idString, status, lengthString] = rpcReadBuffer.slice(0, headerEnd)
+                                                .toString('utf-8').split(' ');
+        let payloadStart = headerEnd + 1;
+        let payloadEnd = payloadStart + parseInt(lengthString);
+        if (rpcReadBuffer.length < payloadEnd) {
+            return;
+        }
+        let payload = rpcReadBuffer.slice(payloadStart, payloadEnd);
+        rpcReadBuffer = rpcReadBuffer.slice(payloadEnd);
+        let rpcId = parseInt(idString);
+        let pending = pendingRpcs.get(rpcId);
+        if (!pending) {
+            console.log(`PC --> Response for unknown RPC ${idString}.`);
+            continue;
+        }
+        if (status === 'frame') {
+            if (pending.onFrame) {
+                pending.onFrame(payload);
+            }
+            continue;
+        }
+        pendingRpcs.delete(rpcId);
+        if (status === 'ok') {
+            pending.resolve(payload);
+        }
+        else {
+            pending.reject(new Error(payload.toString('utf-8')));
         }
     }
-    else if (shell.currRpcName === 'generatePreview') {
-        console.log(`PC (preview) --> ${message}`);
-        shell.currRpcResponse.sendFile(__dirname + '/volatile/plot_preview.svg');
-        shell.currRpcResponse = undefined;
-        shell.currRpcName = '';
-    }
-    else if (shell.currRpcName === 'generateInstructions') {
-        let instText = fs.readFileSync(__dirname + '/volatile/plot_instructions.txt')
-                         .toString();
-        let instructions = instText.split('\n').filter((inst: string) => !!inst);
-        shell.currRpcResponse.status(200).json({
-            instructions: instructions
-        });
-        shell.currRpcResponse = undefined;
-        shell.currRpcName = '';
-    }
-    else if (shell.currRpcName === 'takePhoto') {
-        shell.currRpcResponse.sendFile(__dirname + '/volatile/camera-photo.jpg');
-        shell.currRpcResponse = undefined;
-        shell.currRpcName = '';
-    }
-    else if (shell.currRpcName === 'warpLastPhoto') {
-        shell.currRpcResponse.sendFile(__dirname + '/volatile/camera-photo-warped.jpg');
-        shell.currRpcResponse = undefined;
-        shell.currRpcName = '';
-    }
-    else {
-        console.log(`PC --> ${message}`);
-    }
+};
+
+shell.stdout.on('data', (data: Buffer) => {
+    rpcReadBuffer = Buffer.concat([rpcReadBuffer, data]);
+    consumeRpcFrames();
 });
+shell.stderr.on('data', (data: Buffer) => {
+    console.log(`PC --> ${data.toString('utf-8').trimEnd()}`);
+});
+
+let respondWithRpcError = (res: Response, error: Error) => {
+    console.log(`PC --> ${error.message}`);
+    res.status(500).json({ message: error.message });
+};
+
+/* Photo RPCs write each photo to a file of its own and reply with its
+ * path, so concurrent requests never share a file. */
+let sendPhotoAndDelete = (res: Response, photoPath: string) => {
+    res.sendFile(photoPath, () => {
+        fs.unlink(photoPath, (err: Error | null) => {
+            if (err) {
+                console.log(`PC --> Could not delete ${photoPath}: ${err.message}`);
+            }
+        });
+    });
+};
+
+/* Live camera preview. All viewers share one preview_stream call to the
+ * interpreter, which sends each JPEG frame once; every frame is written to
+ * each open MJPEG response. The stream is stopped when the last viewer
+ * leaves. */
+const MJPEG_BOUNDARY = 'versoframe';
+const previewSubscribers = new Set<Response>();
+let previewStreamActive = false;
+
+let broadcastPreviewFrame = (jpeg: Buffer) => {
+    let partHeader = Buffer.from(`--${MJPEG_BOUNDARY}\r\n`
+        + 'Content-Type: image/jpeg\r\n'
+        + `Content-Length: ${jpeg.length}\r\n\r\n`, 'utf-8');
+    let frame = Buffer.concat([partHeader, jpeg, Buffer.from('\r\n')]);
+    previewSubscribers.forEach((res) => res.write(frame));
+};
+
+let startPreviewStream = () => {
+    previewStreamActive = true;
+    callRpc('preview_stream', '', broadcastPreviewFrame)
+    .then(() => {
+        previewStreamActive = false;
+        // Someone may have connected while the stream was stopping.
+        if (previewSubscribers.size > 0) {
+            startPreviewStream();
+        }
+    })
+    .catch((e: Error) => {
+        console.log(`PC --> ${e.message}`);
+        previewStreamActive = false;
+        previewSubscribers.forEach((res) => res.end());
+        previewSubscribers.clear();
+    });
+};
 
 // routes and start ========================================
 
@@ -226,51 +286,115 @@ let attachRoutesAndStart = () => {
     });
 
     app.put('/machine/drawEnvelope', (req: Request, res: Response) => {
-        shell.send('draw_envelope');
+        callRpc('draw_envelope').catch((e: Error) => console.log(`PC --> ${e.message}`));
         res.status(200).send();
     });
 
     app.put('/machine/drawToolpath', (req: Request, res: Response) => {
         let svgString = req.body.svgString;
-        shell.send('draw_toolpath '+ svgString);
+        callRpc('draw_toolpath', svgString)
+            .catch((e: Error) => console.log(`PC --> ${e.message}`));
         res.status(200).send();
     });
 
     app.put('/machine/generatePreview', (req: Request, res: Response) => {
         let svgString = req.body.svgString;
-        shell.currRpcResponse = res;
-        shell.currRpcName = 'generatePreview';
-        shell.send('generate_preview '+ svgString);
+        callRpc('generate_preview', svgString).then((preview) => {
+            res.status(200).type('image/svg+xml').send(preview);
+        })
+        .catch((e: Error) => respondWithRpcError(res, e));
     });
 
     app.put('/machine/generateInstructions', (req: Request, res: Response) => {
         let svgString = req.body.svgString;
-        shell.currRpcResponse = res;
-        shell.currRpcName = 'generateInstructions';
-        shell.send('generate_instructions '+ svgString);
+        callRpc('generate_instructions', svgString).then((payload) => {
+            res.status(200).json({
+                instructions: JSON.parse(payload.toString('utf-8'))
+            });
+        })
+        .catch((e: Error) => respondWithRpcError(res, e));
     });
 
     app.get('/camera/takePhoto', (req: Request, res: Response) => {
         /* Format: 'c0,c1,...,c8' */
         let coeffs = req.query['coeffs'] || IDENTITY_COEFFS;
-        shell.currRpcResponse = res;
-        shell.currRpcName = 'takePhoto';
-        shell.send(`take_photo ${coeffs}`);
+        callRpc('take_photo', coeffs.toString()).then((payload) => {
+            sendPhotoAndDelete(res, payload.toString('utf-8'));
+        })
+        .catch((e: Error) => respondWithRpcError(res, e));
+    });
+
+    app.get('/camera/stream', (req: Request, res: Response) => {
+        res.writeHead(200, {
+            'Content-Type': `multipart/x-mixed-replace; boundary=${MJPEG_BOUNDARY}`,
+            'Cache-Control': 'no-cache',
+            'Connection': 'close'
+        });
+        previewSubscribers.add(res);
+        if (!previewStreamActive) {
+            startPreviewStream();
+        }
+        req.on('close', () => {
+            previewSubscribers.delete(res);
+            if (previewSubscribers.size === 0 && previewStreamActive) {
+                callRpc('stop_preview_stream')
+                .catch((e: Error) => console.log(`PC --> ${e.message}`));
+            }
+        });
     });
 
     app.get('/camera/warpLastPhoto', (req: Request, res: Response) => {
         /* Format: 'c0,c1,...,c8' */
         let coeffs = req.query['coeffs']
-        shell.currRpcResponse = res;
-        shell.currRpcName = 'warpLastPhoto';
-        shell.send(`warp_last_photo ${coeffs}`);
+        callRpc('warp_last_photo', (coeffs || '').toString()).then((payload) => {
+            sendPhotoAndDelete(res, payload.toString('utf-8'));
+        })
+        .catch((e: Error) => respondWithRpcError(res, e));
+    });
+
+    app.put('/camera/homography', (req: Request, res: Response) => {
+        /* Format: 'c0,c1,...,c8' */
+        let coeffs = req.body.coeffs;
+        if (!coeffs) {
+            res.status(400).send();
+            return;
+        }
+        callRpc('set_homography', coeffs.toString()).then(() => {
+            res.status(200).send();
+        })
+        .catch((e: Error) => respondWithRpcError(res, e));
+    });
+
+    app.put('/camera/intrinsics', (req: Request, res: Response) => {
+        /* Format: 'm0,m1,...,m8,k1,k2,p1,p2,k3' */
+        let coeffs = req.body.coeffs;
+        if (!coeffs) {
+            res.status(400).send();
+            return;
+        }
+        callRpc('set_intrinsics', coeffs.toString()).then(() => {
+            res.status(200).send();
+        })
+        .catch((e: Error) => respondWithRpcError(res, e));
     });
 
     // TODO: pass in photo as parameter
     app.get('/image/detectFaceBoxes', (req: Request, res: Response) => {
-        shell.currRpcResponse = res;
-        shell.currRpcName = 'detectFaceBoxes';
-        shell.send('detect_face_boxes');
+        callRpc('detect_face_boxes').then((payload) => {
+            let arrayOfArrays = JSON.parse(payload.toString('utf-8'));
+            let boxes = arrayOfArrays.map((box: number[]) => {
+                return {
+                    topLeftX: box[0],
+                    topLeftY: box[1],
+                    width: box[2],
+                    height: box[3]
+                }
+            });
+            res.status(200).json({
+                results: boxes
+            });
+        })
+        .catch((e: Error) => respondWithRpcError(res, e));
     });
 
     app.get('/geometries', (req: Request, res: Response) => {
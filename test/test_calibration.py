@@ -0,0 +1,103 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from calibration import CalibrationStore
+
+# python -m unittest discover -s test in top-level dir, with axidraw/ on
+# PYTHONPATH
+
+class CalibrationStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'volatile', 'calibration.npy')
+        self.homography_path = os.path.join(self.dir, 'homography.pckl')
+        self.envelope_settings_path = os.path.join(self.dir,\
+                                                   'envelope_settings.pckl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def store(self):
+        return CalibrationStore(self.path, self.homography_path,\
+                                self.envelope_settings_path)
+
+    def test_round_trip(self):
+        h = np.arange(9, dtype=np.float64).reshape((3, 3))
+        self.store().save('rig', homography=h, envelope_hw=(18, 28))
+        self.store().save('rig', dist_coeffs=(0.1, 0.2, 0, 0, 0.3))
+        self.store().save('other', camera_hw=(720, 1280))
+
+        store = self.store()
+        self.assertEqual(store.rig_names, ['rig', 'other'])
+        record = store.get('rig')
+        np.testing.assert_array_equal(record['homography'], h)
+        np.testing.assert_array_equal(record['envelope_hw'], (18, 28))
+        np.testing.assert_array_equal(record['dist_coeffs'],\
+                                      (0.1, 0.2, 0, 0, 0.3))
+        self.assertFalse(record['camera_matrix'].any())
+        self.assertEqual(record['revision'], 2)
+        self.assertIsNone(store.get('missing'))
+
+    def test_version_mismatch_is_rejected(self):
+        self.store().save(homography=np.eye(3))
+        records = np.load(self.path)
+        records[0]['revision'] = CalibrationStore.FORMAT_VERSION + 1
+        np.save(self.path, records)
+        with self.assertRaises(ValueError):
+            self.store().get()
+
+        np.save(self.path, np.zeros(3))
+        with self.assertRaises(ValueError):
+            self.store().get()
+
+    def test_failed_save_keeps_previous_file(self):
+        store = self.store()
+        store.save(homography=np.eye(3))
+        with open(self.path, 'rb') as f:
+            before = f.read()
+        def partial_save(f, arr):
+            f.write(b'\x93NUMPY')
+            raise OSError('disk full')
+        with mock.patch('calibration.np.save', partial_save):
+            with self.assertRaises(OSError):
+                store.save(homography=np.zeros((3, 3)))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),\
+                         ['calibration.npy'])
+        np.testing.assert_array_equal(self.store().get()['homography'],\
+                                      np.eye(3))
+
+    def test_legacy_homography_is_imported_once(self):
+        h = np.arange(9, dtype=np.float64).reshape((3, 3))
+        with open(self.homography_path, 'wb') as f:
+            pickle.dump((h, (720, 1280)), f)
+        np.testing.assert_array_equal(self.store().get()['homography'], h)
+        self.assertTrue(os.path.exists(self.path))
+
+        # Once the store exists the pickles are no longer read
+        with open(self.homography_path, 'wb') as f:
+            pickle.dump((np.eye(3), (720, 1280)), f)
+        np.testing.assert_array_equal(self.store().get()['homography'], h)
+
+    def test_legacy_envelope_settings_are_imported(self):
+        h = np.diag([2.0, 3.0, 1.0])
+        with open(self.envelope_settings_path, 'wb') as f:
+            pickle.dump(h, f)
+        np.testing.assert_array_equal(self.store().get()['homography'], h)
+
+    def test_unusable_legacy_files_are_ignored(self):
+        with open(self.homography_path, 'wb') as f:
+            f.write(b'')
+        with open(self.envelope_settings_path, 'wb') as f:
+            pickle.dump((1.0, 0.0, 0.0), f)
+        store = self.store()
+        self.assertIsNone(store.get())
+        self.assertFalse(os.path.exists(self.path))
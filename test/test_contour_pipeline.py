@@ -0,0 +1,53 @@
+import os
+import unittest
+
+import cv2
+import numpy as np
+
+from cp_interpreter import ContourPipeline
+
+# python -m unittest discover -s test in top-level dir, with axidraw/ on
+# PYTHONPATH
+
+FORM_PATH = os.path.join(os.path.dirname(__file__), '..', 'scripts',\
+                         'images', 'form.png')
+ENVELOPE_HW_PX = (800, 600)
+
+def shifted(img, dx, dy):
+    m = np.float32([[1, 0, dx], [0, 1, dy]])
+    return cv2.warpAffine(img, m, (img.shape[1], img.shape[0]),\
+                          borderMode=cv2.BORDER_REPLICATE)
+
+class ContourPipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.img = cv2.imread(FORM_PATH)
+        self.pipeline = ContourPipeline()
+        self.contours, self.corners = self.pipeline.run(self.img,\
+                                                        ENVELOPE_HW_PX)
+
+    def test_unchanged_frame_is_skipped(self):
+        result = self.pipeline.run(self.img.copy(), ENVELOPE_HW_PX)
+        self.assertEqual(self.pipeline.stats['skipped'], 1)
+        self.assertIs(result[1], self.corners)
+
+    def test_shifted_frame_is_tracked(self):
+        contours, corners = self.pipeline.run(shifted(self.img, 3, 0),\
+                                              ENVELOPE_HW_PX)
+        stats = self.pipeline.stats
+        self.assertEqual(stats['skipped'], 0)
+        self.assertEqual(stats['envelope_tracked'], 1)
+        self.assertEqual(stats['envelope_searches'], 1)
+        np.testing.assert_allclose(corners - self.corners,\
+                                   np.tile([3, 0], (4, 1)), atol=0.5)
+        # Nothing moved relative to the envelope, so the contours are kept
+        self.assertEqual(stats['contours_reused'], 1)
+        self.assertIs(contours, self.contours)
+
+    def test_shift_inside_envelope_is_detected(self):
+        img = self.img.copy()
+        img[200:1500, 200:1100] = shifted(self.img, 3, 0)[200:1500, 200:1100]
+        self.pipeline.run(img, ENVELOPE_HW_PX)
+        stats = self.pipeline.stats
+        self.assertEqual(stats['processed'], 2)
+        self.assertEqual(stats['contours_reused'], 0)
@@ -0,0 +1,101 @@
+import io
+import threading
+import time
+import unittest
+
+from cp_interpreter import FramedRpcServer
+
+# python -m unittest discover -s test in top-level dir, with axidraw/ on
+# PYTHONPATH
+
+def frame(rpc_id, command, payload=b''):
+    return f'{rpc_id} {command} {len(payload)}\n'.encode('utf-8') + payload
+
+def parse_responses(data):
+    """
+    Returns the (id, status, payload) responses in DATA, in the order sent.
+    """
+    stream = io.BytesIO(data)
+    responses = []
+    while True:
+        header = stream.readline()
+        if not header:
+            return responses
+        rpc_id, status, length = header.decode('utf-8').split()
+        responses.append((rpc_id, status, stream.read(int(length))))
+
+class RecordingInterpreter:
+    """
+    Stands in for Interpreter. 'echo' returns its payload, 'slow' returns
+    its payload after a delay, 'fail' raises, 'choose_point' blocks until
+    a 'release' request arrives. Records the thread each request ran on.
+    """
+    def __init__(self):
+        self.released = threading.Event()
+        self.threads = {}
+
+    def rpc_echo(self, arg):
+        return arg
+
+    def rpc_slow(self, arg):
+        time.sleep(0.2)
+        return arg
+
+    def rpc_fail(self, arg):
+        raise ValueError('bad payload')
+
+    def rpc_release(self, arg):
+        self.released.set()
+        return ''
+
+    def rpc_choose_point(self, arg):
+        self.threads['choose_point'] = threading.current_thread()
+        if not self.released.wait(timeout=5):
+            raise TimeoutError('Never released.')
+        return '1.0,2.0'
+
+def serve(requests, interpreter=None):
+    out_stream = io.BytesIO()
+    server = FramedRpcServer(interpreter or RecordingInterpreter(),\
+                             io.BytesIO(b''.join(requests)), out_stream)
+    server.serve_forever()
+    return parse_responses(out_stream.getvalue())
+
+class FramedRpcServerTestCase(unittest.TestCase):
+
+    def test_payloads_are_read_by_length(self):
+        payload = b'<svg>\nline two\n</svg>'
+        responses = serve([frame('1', 'echo', payload), frame('2', 'echo')])
+        self.assertEqual(sorted(responses),
+                         [('1', 'ok', payload), ('2', 'ok', b'')])
+
+    def test_malformed_header_is_dropped(self):
+        responses = serve([b'garbage\n', frame('7', 'echo', b'x')])
+        self.assertEqual(responses, [('7', 'ok', b'x')])
+
+    def test_errors_are_reported_under_their_id(self):
+        responses = serve([frame('a', 'fail'), frame('b', 'nope')])
+        self.assertEqual(sorted(responses), [
+            ('a', 'error', b'ValueError: bad payload'),
+            ('b', 'error', b'Unknown command: nope'),
+        ])
+
+    def test_responses_are_routed_by_id(self):
+        responses = serve([frame('slow', 'slow', b'first'),
+                           frame('fast', 'echo', b'second')])
+        # The fast request overtakes the slow one but keeps its own ID
+        self.assertEqual(responses, [('fast', 'ok', b'second'),
+                                     ('slow', 'ok', b'first')])
+
+    def test_main_thread_command_does_not_block_reading(self):
+        interpreter = RecordingInterpreter()
+        responses = serve([frame('1', 'choose_point'), frame('2', 'release')],
+                          interpreter)
+        self.assertEqual(responses, [('2', 'ok', b''),
+                                     ('1', 'ok', b'1.0,2.0')])
+        self.assertIs(interpreter.threads['choose_point'],
+                      threading.main_thread())
+
+    def test_bye_stops_reading(self):
+        responses = serve([frame('1', 'bye'), frame('2', 'echo', b'late')])
+        self.assertEqual(responses, [('1', 'ok', b'Bye!')])
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from scripts.loader import Loader, PackedContours
+
+# python -m unittest discover -s test in top-level dir, with axidraw/ on
+# PYTHONPATH
+
+IMAGES_DIR = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'images')
+SVG_PATH = os.path.join(IMAGES_DIR, 'box.svg')
+IMG_PATH = os.path.join(IMAGES_DIR, 'shapes.png')
+
+class LoaderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(Loader, 'CACHE_DIR', self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def assertContoursEqual(self, first, second):
+        self.assertEqual(len(first), len(second))
+        for a, b in zip(first, second):
+            np.testing.assert_array_equal(a.reshape((-1, 2)),\
+                                          b.reshape((-1, 2)))
+
+    def damage_cache(self, damage):
+        for name in os.listdir(self.dir):
+            with open(os.path.join(self.dir, name), 'r+b') as f:
+                damage(f)
+
+    def test_truncated_and_empty_svg_cache_is_regenerated(self):
+        expected = Loader.load_svg(SVG_PATH)
+        for damage in (lambda f: f.truncate(os.fstat(f.fileno()).st_size // 2),\
+                       lambda f: f.truncate(0)):
+            self.damage_cache(damage)
+            self.assertContoursEqual(Loader.load_svg(SVG_PATH), expected)
+        # The regenerated entry is readable again
+        cache_path = Loader._cache_path(SVG_PATH, 'svg', (10,))
+        self.assertIsNotNone(Loader._load_cached(cache_path))
+
+    def test_truncated_image_cache_is_regenerated(self):
+        expected = Loader.extract_contours_from_img_files([IMG_PATH])
+        self.damage_cache(lambda f: f.truncate(100))
+        results = Loader.extract_contours_from_img_files([IMG_PATH])
+        self.assertContoursEqual(results[IMG_PATH].to_contours(),\
+                                 expected[IMG_PATH].to_contours())
+
+    def test_failed_save_leaves_no_file(self):
+        packed = PackedContours.from_contours([np.zeros((3, 1, 2))])
+        path = os.path.join(self.dir, 'contours.npz')
+        with mock.patch('scripts.loader.np.savez',\
+                        side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                packed.save(path)
+        self.assertEqual(os.listdir(self.dir), [])
+        packed.save(path)
+        self.assertEqual(os.listdir(self.dir), ['contours.npz'])
+        self.assertEqual(len(PackedContours.load(path)), 1)
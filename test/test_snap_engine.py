@@ -0,0 +1,84 @@
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+from pair import SnapEngine
+
+# python -m unittest discover -s test in top-level dir, with axidraw/ on
+# PYTHONPATH
+
+SNAP_DIST = 30
+
+def snap_x(engine, x, width, y=0, height=100):
+    return engine._snap_axis(engine.x_edges, engine.x_spans, x, width,\
+                             y, height)
+
+class SnapEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # One box spanning x 100..200, y 0..100
+        self.engine = SnapEngine([(100, 0, 200, 100)], SNAP_DIST)
+
+    def test_far_side_snaps_onto_edge_at_or_beyond_it(self):
+        # Right side at 100 and 70 snaps onto the box's left edge
+        self.assertEqual(snap_x(self.engine, 50, 50), 50)
+        self.assertEqual(snap_x(self.engine, 20, 50), 50)
+        # Right side past the edge does not snap back onto it
+        self.assertIsNone(snap_x(self.engine, 55, 50))
+
+    def test_near_side_snaps_only_onto_edge_strictly_behind_it(self):
+        # Left side at 230 snaps back onto the box's right edge
+        self.assertEqual(snap_x(self.engine, 230, 50), 200)
+        # Already on the edge: nothing behind it within reach
+        self.assertIsNone(snap_x(self.engine, 200, 500))
+
+    def test_snaps_within_snap_distance_only(self):
+        self.assertEqual(snap_x(self.engine, 100 - SNAP_DIST - 50, 50),\
+                         50)
+        self.assertIsNone(snap_x(self.engine, 100 - SNAP_DIST - 51, 50))
+        self.assertEqual(snap_x(self.engine, 200 + SNAP_DIST, 50), 200)
+        self.assertIsNone(snap_x(self.engine, 200 + SNAP_DIST + 1, 50))
+
+    def test_closer_edge_wins(self):
+        engine = SnapEngine([(100, 0, 200, 100), (300, 0, 400, 100)],\
+                            SNAP_DIST)
+        # Left side 10 past 200, right side 20 short of 300
+        self.assertEqual(snap_x(engine, 210, 70), 200)
+        # Left side 20 past 200, right side 10 short of 300
+        self.assertEqual(snap_x(engine, 220, 70), 230)
+
+    def test_boxes_far_away_on_the_other_axis_are_ignored(self):
+        engine = SnapEngine([(100, 500, 200, 600)], SNAP_DIST)
+        self.assertIsNone(snap_x(engine, 30, 50, 0, 100))
+        self.assertIsNone(snap_x(engine, 30, 50, 400 - SNAP_DIST - 1, 100))
+        self.assertEqual(snap_x(engine, 30, 50, 400 - SNAP_DIST, 100), 50)
+        self.assertEqual(engine.snap(30, 460, 50, 20), [50, 480])
+        self.assertEqual(engine.snap(30, 0, 50, 20), [None, None])
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        for _ in range(50):
+            boxes = []
+            for _ in range(rng.randint(0, 300)):
+                x, y = rng.randint(0, 1200), rng.randint(0, 700)
+                boxes.append((x, y, x + rng.randint(1, 100),\
+                              y + rng.randint(1, 100)))
+            engine = SnapEngine(np.array(boxes).reshape((-1, 4)), SNAP_DIST)
+            for _ in range(20):
+                x, y = rng.randint(-50, 1300), rng.randint(-50, 750)
+                w, h = rng.randint(1, 200), rng.randint(1, 200)
+                candidates = []
+                for (x0, y0, x1, y1) in boxes:
+                    if y0 > y + h + SNAP_DIST or y1 < y - SNAP_DIST:
+                        continue
+                    for edge in (x0, x1):
+                        if 0 <= edge - (x + w) <= SNAP_DIST:
+                            candidates.append((edge - (x + w), 0, edge - w))
+                        if 0 < x - edge <= SNAP_DIST:
+                            candidates.append((x - edge, 1, edge))
+                expected = min(candidates)[2] if candidates else None
+                self.assertEqual(engine.snap(x, y, w, h)[0], expected)